@@ -0,0 +1,81 @@
+"""client.py - Sends commands to a running amigados-daemon
+
+The daemon keeps the images it works on open, so a command line tool only has
+to pass its arguments over a Unix socket. This module only depends on the
+standard library, which keeps the startup of the tools short.
+"""
+
+import json
+import os
+import socket
+import tempfile
+
+# if this environment variable is set, amigados-makedir, amigados-delete,
+# amigados-copy and amigados-dir send their commands to the daemon. The value
+# is the path of the daemon's socket or 1 for the default path
+DAEMON_ENV = "AMIGADOS_DAEMON"
+
+# seconds to wait for the daemon's answer, a daemon that is shutting down
+# may still accept connections without answering them
+REQUEST_TIMEOUT = 60.0
+
+
+def default_socket_path():
+    return os.path.join(tempfile.gettempdir(), "amigados-daemon-%d.sock" % os.getuid())
+
+
+def socket_path():
+    """returns the socket path selected by the AMIGADOS_DAEMON environment
+    variable, None if the tools should not use the daemon"""
+    value = os.environ.get(DAEMON_ENV, "")
+    if value in ["", "0"]:
+        return None
+    return default_socket_path() if value == "1" else value
+
+
+def send_message(file, message):
+    """messages are single lines of JSON"""
+    file.write(json.dumps(message).encode('utf-8') + b"\n")
+    file.flush()
+
+
+def read_message(file):
+    """returns the next message from file, None at the end of the stream"""
+    line = file.readline()
+    if len(line) == 0:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+def image_location(path):
+    """the daemon may run in a different working directory, so host paths and
+    the image part of AmigaDOS paths ("image:path") are made absolute"""
+    comps = path.split(":")
+    comps[0] = os.path.abspath(comps[0])
+    return ":".join(comps)
+
+
+def request(command, address=None, **args):
+    """sends a command with its arguments to the daemon listening on the socket
+    at address and returns the result. Errors reported by the daemon are raised
+    as Exception"""
+    if address is None:
+        address = socket_path() or default_socket_path()
+    if 'image' in args:
+        args['image'] = os.path.abspath(args['image'])
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(REQUEST_TIMEOUT)
+    try:
+        sock.connect(address)
+        with sock.makefile("rwb") as file:
+            send_message(file, {'command': command, 'args': args})
+            response = read_message(file)
+    except (FileNotFoundError, ConnectionRefusedError, socket.timeout):
+        raise Exception("amigados-daemon is not running (socket '%s')" % address)
+    finally:
+        sock.close()
+    if response is None:
+        raise Exception("amigados-daemon closed the connection")
+    if not response['ok']:
+        raise Exception(response['error'])
+    return response.get('result')
@@ -0,0 +1,279 @@
+"""daemon.py - Keeps Amiga disk images open for the command line tools
+
+Build scripts that call the amigados-* tools many times pay for the interpreter
+startup and for reading and writing the image in every call. The daemon
+listens on a Unix socket and keeps the images it was asked to work on open,
+together with their header and path caches. Modifications stay in memory
+until the daemon was idle for a while, is asked to sync or is shut down, then
+only the modified sectors are written back through the journal.
+
+An image that was changed by another program is reopened, unless the daemon
+has unsaved changes of it, in which case the command fails.
+"""
+
+import os
+import socketserver
+import threading
+import time
+from . import client
+from . import logical
+from . import physical
+
+# modified sectors are written back once no command arrived for this many seconds
+IDLE_SYNC_DELAY = 2.0
+
+
+def _file_state(path):
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class OpenImage:
+    """An image file kept open by the daemon"""
+    def __init__(self, path):
+        self.path = path
+        # complete an interrupted update of the image
+        physical.recover_journal(path)
+        with open(path, "rb") as infile:
+            self.disk = physical.read_adf_image(infile)
+        self.volume = logical.LogicalVolume(self.disk)
+        self.state = _file_state(path)
+
+    def is_dirty(self):
+        return len(self.disk.dirty) > 0
+
+    def is_stale(self):
+        """True if the image file was changed by someone else"""
+        try:
+            return _file_state(self.path) != self.state
+        except OSError:
+            return True
+
+    def sync(self, fsync=False):
+        """writes the modified sectors back to the image file, returns the
+        number of bytes written"""
+        num_bytes = self.disk.write_dirty_atomic(self.path, fsync=fsync)
+        if num_bytes > 0:
+            self.state = _file_state(self.path)
+        return num_bytes
+
+
+def _entry_list(entries):
+    return [[entry.name, entry.is_dir()] for entry in entries]
+
+
+class Daemon:
+    """Executes the commands of the clients on the open images. Commands are
+    executed one at a time, each modifying command in a transaction"""
+    def __init__(self, idle_sync_delay=IDLE_SYNC_DELAY, fsync=False):
+        self.idle_sync_delay = idle_sync_delay
+        self.fsync = fsync
+        self.images = {}
+        self.commands = 0
+        self.server = None
+        self._lock = threading.Lock()
+        self._last_command = time.monotonic()
+        self._stopped = threading.Event()
+        self._handlers = {
+            'ping': self.ping, 'status': self.status, 'sync': self.sync,
+            'close': self.close, 'shutdown': self.shutdown,
+            'makedir': self.makedir, 'delete': self.delete,
+            'copy': self.copy, 'dir': self.dir,
+        }
+
+    def execute(self, message):
+        """executes a command message and returns the response message"""
+        with self._lock:
+            self._last_command = time.monotonic()
+            self.commands += 1
+            try:
+                handler = self._handlers.get(message.get('command'))
+                if handler is None:
+                    raise Exception("Unknown command: '%s'" % message.get('command'))
+                return {'ok': True, 'result': handler(**message.get('args', {}))}
+            except Exception as e:
+                return {'ok': False, 'error': str(e)}
+
+    def image(self, path):
+        """returns the open image at path, it is opened if necessary"""
+        path = os.path.abspath(path)
+        image = self.images.get(path)
+        if image is not None and image.is_stale():
+            if image.is_dirty():
+                raise Exception("'%s' was modified by another program and has unsaved changes" % path)
+            del self.images[path]
+            image = None
+        if image is None:
+            if not os.path.exists(path):
+                raise Exception("Amiga disk image '%s' does not exist" % path)
+            image = OpenImage(path)
+            self.images[path] = image
+        return image
+
+    def sync_all(self, fsync=None):
+        fsync = self.fsync if fsync is None else fsync
+        num_bytes = 0
+        for image in self.images.values():
+            if image.is_dirty():
+                num_bytes += image.sync(fsync)
+        return num_bytes
+
+    # commands
+
+    def ping(self):
+        return "pong"
+
+    def status(self):
+        return {'pid': os.getpid(), 'commands': self.commands,
+                'images': [{'path': path, 'dirty_sectors': len(image.disk.dirty)}
+                           for path, image in sorted(self.images.items())]}
+
+    def sync(self, image=None, fsync=None):
+        """writes back the modified sectors of an image or of all images"""
+        if image is None:
+            return self.sync_all(fsync)
+        return self.image(image).sync(self.fsync if fsync is None else fsync)
+
+    def close(self, image):
+        """writes back and forgets an image"""
+        path = os.path.abspath(image)
+        if path in self.images:
+            self.images[path].sync(self.fsync)
+            del self.images[path]
+
+    def shutdown(self):
+        if self.server is not None:
+            # shutdown() waits for serve_forever() to return, which it can't do
+            # while this request is being handled
+            threading.Thread(target=self.server.shutdown).start()
+
+    def makedir(self, image, path):
+        volume = self.image(image).volume
+        with volume.transaction():
+            volume.makedir(path)
+
+    def delete(self, image, path, recursive=False):
+        volume = self.image(image).volume
+        with volume.transaction():
+            volume.delete(path, recursive=recursive)
+
+    def copy(self, source, dest):
+        """copies like amigados-copy: source and dest are host paths or
+        AmigaDOS paths of the form image:path, at least one is an AmigaDOS path"""
+        src = source.split(":")
+        dst = dest.split(":")
+        reader = None
+        if len(src) > 1:
+            reader = self.image(src[0]).volume.open(src[1])
+        elif not os.path.exists(src[0]):
+            raise Exception("Source path '%s' does not exist" % src[0])
+
+        if len(dst) == 1:
+            if reader is None:
+                raise Exception("Either source or destination has to be an AmigaDOS path")
+            with open(dst[0], "wb") as outfile:
+                reader.copy_to(outfile)
+            return
+
+        dst_volume = self.image(dst[0]).volume
+        with dst_volume.transaction():
+            if reader is None and os.path.isdir(src[0]):
+                dst_volume.import_tree(src[0], dst[1])
+                return
+            if reader is not None:
+                data = reader.read()
+                name = reader.name
+            else:
+                with open(src[0], "rb") as infile:
+                    data = infile.read()
+                name = os.path.basename(src[0])
+            # copying into a directory keeps the source name
+            dst_path = dst[1]
+            try:
+                if dst_volume.header_for_path(dst_path).secondary_type() in [
+                        logical.BLOCK_SEC_TYPE_ROOT, logical.BLOCK_SEC_TYPE_USERDIR]:
+                    dst_path = dst_path + "/" + name
+            except Exception:
+                pass
+            dst_volume.write_file(dst_path, data)
+
+    def dir(self, image, path="/", recursive=False):
+        """returns the volume information and the entries of the directory at
+        path, the paths of all entries below it if recursive or the name and
+        comment if path is a file"""
+        open_image = self.image(image)
+        volume = open_image.volume
+        result = {'volume': volume.root_block().name(),
+                  'filesystem': volume.filesystem_type(),
+                  'sectors': open_image.disk.num_sectors()}
+        path = "/".join(p for p in path.split("/") if p != '')
+        if path != '' and not volume.header_for_path(path).is_directory():
+            header = volume.header_for_path(path)
+            result['file'] = [header.name(), header.file_comment()]
+        elif recursive:
+            result['tree'] = [[entry.path, entry.is_dir()] for entry in volume.walk(path or "/")]
+        else:
+            result['entries'] = _entry_list(volume.scandir(path or "/"))
+        return result
+
+    # idle write back
+
+    def _idle_sync(self):
+        while not self._stopped.wait(self.idle_sync_delay / 4):
+            with self._lock:
+                if time.monotonic() - self._last_command >= self.idle_sync_delay:
+                    try:
+                        self.sync_all()
+                    except Exception as e:
+                        print("ERROR: writing back failed: %s" % e)
+
+    def serve_forever(self, server):
+        """handles the requests of server until the shutdown command, then
+        closes it and writes back all modifications"""
+        self.server = server
+        idle_thread = threading.Thread(target=self._idle_sync, daemon=True)
+        idle_thread.start()
+        try:
+            server.serve_forever()
+        finally:
+            # clients connecting from now on get an error instead of waiting
+            server.server_close()
+            self._stopped.set()
+            idle_thread.join()
+            with self._lock:
+                self.sync_all()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """A connection can send any number of commands, each is answered before
+    the next one is read"""
+    def handle(self):
+        while True:
+            message = client.read_message(self.rfile)
+            if message is None:
+                break
+            client.send_message(self.wfile, self.server.daemon.execute(message))
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def unix_server(daemon, path):
+    """creates the server of daemon listening on the socket at path, run it
+    with daemon.serve_forever(). Only the current user can connect"""
+    if os.path.exists(path):
+        try:
+            client.request("ping", path)
+        except Exception:
+            # left behind by a daemon that did not shut down cleanly
+            os.remove(path)
+        else:
+            raise Exception("amigados-daemon is already running (socket '%s')" % path)
+    umask = os.umask(0o177)
+    try:
+        server = _Server(path, _RequestHandler)
+    finally:
+        os.umask(umask)
+    server.daemon = daemon
+    return server
@@ -0,0 +1,217 @@
+"""dedup.py - Sector and file level deduplication index for Amiga disk images"""
+
+from collections import Counter
+import hashlib
+import os
+import sqlite3
+from . import logical
+from . import physical
+from . import scan
+
+# the size of the sector hashes in bytes
+SECTOR_HASH_SIZE = 16
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha1 TEXT NOT NULL,
+    sector_hashes BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_sha1 ON images (sha1);
+CREATE TABLE IF NOT EXISTS sectors (
+    hash BLOB PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (
+    image_id INTEGER NOT NULL REFERENCES images (id),
+    partition TEXT,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha1 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_image ON files (image_id);
+CREATE INDEX IF NOT EXISTS files_sha1 ON files (sha1);
+"""
+
+
+def sector_hashes(data):
+    """returns the hashes of all the sectors in data, packed into a single
+    bytes object with SECTOR_HASH_SIZE bytes per sector"""
+    view = memoryview(data)
+    return b''.join(hashlib.blake2b(view[offset:offset + physical.FLOPPY_BYTES_PER_SECTOR],
+                                    digest_size=SECTOR_HASH_SIZE).digest()
+                    for offset in range(0, len(view), physical.FLOPPY_BYTES_PER_SECTOR))
+
+
+def _unpack_hashes(packed):
+    return [packed[i:i + SECTOR_HASH_SIZE] for i in range(0, len(packed), SECTOR_HASH_SIZE)]
+
+
+def file_hashes(disk):
+    """generates the partition name, path, size and SHA-1 of every file on the
+    volumes of disk. Files that can't be read are skipped"""
+    for partition, physical_volume in scan.iter_volumes(disk):
+        volume = logical.LogicalVolume(physical_volume)
+        if not volume.boot_block().is_dos():
+            continue
+        for path, record in volume.iter_tree():
+            if record.secondary_type != logical.BLOCK_SEC_TYPE_FILE:
+                continue
+            try:
+                sha1 = hashlib.sha1()
+                with logical.FileReader(volume, volume.header_block_at(record.blocknum)) as reader:
+                    for chunk in reader.chunks():
+                        sha1.update(chunk)
+            except Exception:
+                continue
+            yield partition, path, record.file_size, sha1.hexdigest()
+
+
+class DedupIndex:
+    """An SQLite database of the sector and file hashes of a collection of
+    images. The sector hashes of an image are stored as a single packed blob,
+    the sectors table counts the occurrences of each distinct sector over the
+    whole collection.
+    Images are stored with their absolute paths and are only hashed again when
+    their size or modification time changed"""
+    def __init__(self, db_path):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(SCHEMA)
+        # the (path, message) of each image the last update() couldn't read
+        self.errors = []
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _image_row(self, path):
+        return self.connection.execute(
+            "SELECT id, size, mtime, sha1, sector_hashes FROM images WHERE path = ?",
+            (os.path.abspath(path),)).fetchone()
+
+    def _remove(self, image_id, packed_hashes):
+        counts = Counter(_unpack_hashes(packed_hashes))
+        self.connection.executemany("UPDATE sectors SET count = count - ? WHERE hash = ?",
+                                    [(count, h) for h, count in counts.items()])
+        self.connection.execute("DELETE FROM sectors WHERE count <= 0")
+        self.connection.execute("DELETE FROM files WHERE image_id = ?", (image_id,))
+        self.connection.execute("DELETE FROM images WHERE id = ?", (image_id,))
+
+    def remove_image(self, path):
+        row = self._image_row(path)
+        if row is None:
+            raise Exception("Image '%s' is not in the index" % path)
+        with self.connection:
+            self._remove(row[0], row[4])
+
+    def add_image(self, path):
+        """adds the image at path to the index, or updates it if the image file
+        was modified. Returns False if the index was already up to date"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self._image_row(path)
+        if row is not None and row[1] == stat.st_size and row[2] == stat.st_mtime:
+            return False
+
+        disk = physical.read_adf_image_file(path, readonly=True)
+        packed = sector_hashes(disk.data)
+        sha1 = hashlib.sha1(disk.data).hexdigest()
+        files = list(file_hashes(disk))
+        with self.connection:
+            if row is not None:
+                self._remove(row[0], row[4])
+            image_id = self.connection.execute(
+                "INSERT INTO images (path, size, mtime, sha1, sector_hashes) VALUES (?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime, sha1, packed)).lastrowid
+            counts = Counter(_unpack_hashes(packed))
+            self.connection.executemany(
+                "INSERT INTO sectors (hash, count) VALUES (?, ?) "
+                "ON CONFLICT (hash) DO UPDATE SET count = count + excluded.count",
+                counts.items())
+            self.connection.executemany(
+                "INSERT INTO files (image_id, partition, path, size, sha1) VALUES (?, ?, ?, ?, ?)",
+                [(image_id,) + entry for entry in files])
+        return True
+
+    def update(self, paths):
+        """adds the new and modified images in paths (files or directories) and
+        removes the images whose files no longer exist. Images that can't be
+        read are skipped and recorded in errors.
+        Returns the number of images that were hashed"""
+        count = 0
+        self.errors = []
+        for path in scan.find_images(paths):
+            try:
+                if self.add_image(path):
+                    count += 1
+            except Exception as e:
+                self.errors.append((path, str(e)))
+        for path in self.images():
+            if not os.path.exists(path):
+                self.remove_image(path)
+        return count
+
+    def images(self):
+        return [path for (path,) in self.connection.execute("SELECT path FROM images ORDER BY path")]
+
+    def image_stats(self, path):
+        """returns the number of sectors of the image, how many of them also
+        occur in other images and the same for its files"""
+        row = self._image_row(path)
+        if row is None:
+            raise Exception("Image '%s' is not in the index" % path)
+        image_id, packed = row[0], row[4]
+        # a sector is shared if it occurs more often in the collection than
+        # in the image itself
+        with self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS image_sectors "
+                                    "(hash BLOB PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID")
+            self.connection.execute("DELETE FROM image_sectors")
+            self.connection.executemany("INSERT INTO image_sectors (hash, count) VALUES (?, ?)",
+                                        Counter(_unpack_hashes(packed)).items())
+            (shared_sectors,) = self.connection.execute(
+                "SELECT COALESCE(SUM(own.count), 0) FROM image_sectors AS own "
+                "JOIN sectors ON sectors.hash = own.hash WHERE sectors.count > own.count").fetchone()
+        num_sectors = len(packed) // SECTOR_HASH_SIZE
+        num_files, shared_files = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(EXISTS (SELECT 1 FROM files AS other "
+            "WHERE other.sha1 = f.sha1 AND other.image_id != f.image_id)), 0) "
+            "FROM files AS f WHERE f.image_id = ?", (image_id,)).fetchone()
+        return {'sectors': num_sectors, 'shared_sectors': shared_sectors,
+                'dedup_ratio': shared_sectors / num_sectors if num_sectors > 0 else 0.0,
+                'files': num_files, 'shared_files': shared_files}
+
+    def shared_files(self, path):
+        """returns the files of the image that also exist in other images as
+        tuples (path, other image, path in other image)"""
+        return self.connection.execute(
+            "SELECT f.path, i.path, other.path FROM files AS f "
+            "JOIN images AS own ON own.id = f.image_id "
+            "JOIN files AS other ON other.sha1 = f.sha1 AND other.image_id != f.image_id "
+            "JOIN images AS i ON i.id = other.image_id "
+            "WHERE own.path = ? ORDER BY f.path, i.path, other.path",
+            (os.path.abspath(path),)).fetchall()
+
+    def duplicate_images(self):
+        """returns the groups of images with identical contents"""
+        groups = {}
+        for path, sha1 in self.connection.execute(
+                "SELECT path, sha1 FROM images WHERE sha1 IN "
+                "(SELECT sha1 FROM images GROUP BY sha1 HAVING COUNT(*) > 1) ORDER BY path"):
+            groups.setdefault(sha1, []).append(path)
+        return list(groups.values())
+
+    def summary(self):
+        """returns the total number of sectors in the collection and the number
+        of distinct sectors, which is what it takes to store it once"""
+        total, distinct = self.connection.execute(
+            "SELECT COALESCE(SUM(count), 0), COUNT(*) FROM sectors").fetchone()
+        return {'images': len(self.images()), 'sectors': total, 'distinct_sectors': distinct}
@@ -0,0 +1,258 @@
+"""fsck.py - File system consistency check for Amiga disk volumes"""
+
+from collections import Counter
+from . import logical
+from . import util
+
+# the roles of the blocks that are reachable from the root block
+ROLE_ROOT       = 'root'
+ROLE_USERDIR    = 'userdir'
+ROLE_FILE       = 'file'
+ROLE_LINK       = 'link'
+ROLE_EXTENSION  = 'extension'
+ROLE_DATA       = 'data'
+ROLE_DIRCACHE   = 'dircache'
+ROLE_BITMAP     = 'bitmap'
+ROLE_BITMAP_EXT = 'bitmap_ext'
+
+# the roles of blocks without a checksum, FFS data blocks don't have one either
+ROLES_WITHOUT_CHECKSUM = [ROLE_BITMAP_EXT]
+
+# maps the reference counts to the allocator's flags: 1 = free, 0 = used
+_REFS_TO_FLAGS = bytes([1] + [0] * 255)
+
+
+class FsckReport:
+    """The result of a consistency check. The block lists contain block numbers,
+    errors contains a message for each problem found"""
+    def __init__(self, num_blocks):
+        self.num_blocks = num_blocks
+        self.errors = []
+        self.roles = Counter()
+        self.bad_checksums = []
+        self.cross_linked = []
+        # used in the bitmap, but not reachable
+        self.orphaned = []
+        # reachable, but free in the bitmap
+        self.missing = []
+        # the bitmap flags computed from the reachable blocks
+        self.expected_flags = None
+        self.bitmap_valid = True
+
+    def is_clean(self):
+        return len(self.errors) == 0
+
+    def bitmap_ok(self):
+        return self.bitmap_valid and len(self.orphaned) == 0 and len(self.missing) == 0
+
+
+class _Checker:
+    def __init__(self, volume):
+        self.volume = volume
+        physical_volume = volume.physical_volume
+        self.block_size = volume.block_size()
+        self.reserved = physical_volume.reserved_blocks()
+        self.num_blocks = physical_volume.num_sectors()
+        self.report = FsckReport(self.num_blocks)
+        # the checksums of all blocks are verified in a single pass over the volume
+        self.valid = util.valid_checksums(physical_volume.view(), self.block_size)
+        self.refs = bytearray(self.num_blocks)
+        self.is_ofs = volume.boot_block().filesystem_type() == 'OFS'
+        self.roles_without_checksum = ROLES_WITHOUT_CHECKSUM + ([] if self.is_ofs else [ROLE_DATA])
+
+    def error(self, message):
+        self.report.errors.append(message)
+
+    def reference(self, blocknum, role, referrer):
+        """records a reference to a block, returns True if the block was not
+        referenced before and can be checked"""
+        if blocknum < self.reserved or blocknum >= self.num_blocks:
+            self.error("Block %d referenced by block %d is out of range" % (blocknum, referrer))
+            return False
+        refs = self.refs[blocknum]
+        if refs < 255:
+            self.refs[blocknum] = refs + 1
+        if refs > 0:
+            if refs == 1:
+                self.report.cross_linked.append(blocknum)
+            self.error("Block %d (%s) referenced by block %d is cross-linked" %
+                       (blocknum, role, referrer))
+            return False
+        self.report.roles[role] += 1
+        if role not in self.roles_without_checksum and not self.valid[blocknum]:
+            self.report.bad_checksums.append(blocknum)
+            self.error("Block %d (%s) has an invalid checksum" % (blocknum, role))
+        return True
+
+    def check_header(self, record, primary_type, parent):
+        if record.primary_type != primary_type:
+            self.error("Block %d has type %d, expected %d" %
+                       (record.blocknum, record.primary_type, primary_type))
+            return False
+        if record.header_key != record.blocknum and record.secondary_type != logical.BLOCK_SEC_TYPE_ROOT:
+            self.error("Block %d has the header key %d" % (record.blocknum, record.header_key))
+        if parent is not None and record.parent != parent:
+            self.error("Block %d has the parent %d, expected %d" %
+                       (record.blocknum, record.parent, parent))
+        return True
+
+    def check_bitmap_blocks(self, root_record):
+        root_block = self.volume.root_block()
+        for ext_blocknum in root_block.bitmap_ext_block_numbers():
+            if not self.reference(ext_blocknum, ROLE_BITMAP_EXT, root_record.blocknum):
+                return
+        for blocknum in root_block.bitmap_block_numbers():
+            self.reference(blocknum, ROLE_BITMAP, root_record.blocknum)
+
+    def check_dircache(self, dir_record):
+        """checks the dircache blocks of a directory and that they contain
+        exactly the directory's entries"""
+        blocknum = dir_record.extension
+        referrer = dir_record.blocknum
+        cached = []
+        while blocknum != 0:
+            if not self.reference(blocknum, ROLE_DIRCACHE, referrer):
+                return
+            cache_block = logical.DirCacheBlock(self.volume, blocknum)
+            if cache_block.sector().u32_at(0) != logical.BLOCK_TYPE_DIRCACHE:
+                self.error("Block %d is not a dircache block" % blocknum)
+                return
+            cached.extend(entry.blocknum for entry in cache_block.entries())
+            referrer = blocknum
+            blocknum = cache_block.next_block()
+        children = set()
+        for blocknum in dir_record.hashtable:
+            while self.reserved <= blocknum < self.num_blocks and blocknum not in children:
+                children.add(blocknum)
+                blocknum = self.volume.header_record(blocknum).next_hash
+        if sorted(cached) != sorted(children):
+            self.error("The dircache of directory block %d does not match its entries" %
+                       dir_record.blocknum)
+
+    def check_file(self, record):
+        bytes_per_block = self.block_size - (logical.OFS_DATABLOCK_HEADER_SIZE if self.is_ofs else 0)
+        expected_blocks = -(-record.file_size // bytes_per_block)
+        num_blocks = 0
+        table_record = record
+        while True:
+            table = table_record.hashtable[::-1][0:table_record.high_seq]
+            for blocknum in table:
+                if self.reference(blocknum, ROLE_DATA, table_record.blocknum) and self.is_ofs:
+                    data_block = self.volume.data_block_at(blocknum)
+                    if (data_block.primary_type() != logical.BLOCK_TYPE_DATA or
+                            data_block.header_key() != record.blocknum or
+                            data_block.seq_num() != num_blocks + 1):
+                        self.error("Block %d is not data block %d of file block %d" %
+                                   (blocknum, num_blocks + 1, record.blocknum))
+                num_blocks += 1
+            if table_record.extension == 0:
+                break
+            if not self.reference(table_record.extension, ROLE_EXTENSION, table_record.blocknum):
+                break
+            table_record = self.volume.header_record(table_record.extension)
+            if not self.check_header(table_record, logical.BLOCK_TYPE_LIST, record.blocknum):
+                break
+        if num_blocks != expected_blocks:
+            self.error("File block %d has %d data blocks, but needs %d for %d bytes" %
+                       (record.blocknum, num_blocks, expected_blocks, record.file_size))
+
+    def check_tree(self, root_record):
+        pending = [root_record]
+        while len(pending) > 0:
+            dir_record = pending.pop()
+            if dir_record.extension != 0:
+                self.check_dircache(dir_record)
+            for slot in dir_record.hashtable:
+                blocknum = slot
+                referrer = dir_record.blocknum
+                while blocknum != 0:
+                    sec_type = self.volume.header_record(blocknum).secondary_type \
+                        if self.reserved <= blocknum < self.num_blocks else None
+                    if sec_type == logical.BLOCK_SEC_TYPE_USERDIR:
+                        role = ROLE_USERDIR
+                    elif sec_type == logical.BLOCK_SEC_TYPE_FILE:
+                        role = ROLE_FILE
+                    else:
+                        role = ROLE_LINK
+                    if not self.reference(blocknum, role, referrer):
+                        break
+                    record = self.volume.header_record(blocknum)
+                    if not self.check_header(record, logical.BLOCK_TYPE_HEADER, dir_record.blocknum):
+                        break
+                    if role == ROLE_USERDIR:
+                        pending.append(record)
+                    elif role == ROLE_FILE:
+                        self.check_file(record)
+                    elif sec_type not in [logical.BLOCK_SEC_TYPE_SOFTLINK, logical.BLOCK_SEC_TYPE_LINKDIR,
+                                          logical.BLOCK_SEC_TYPE_LINKFILE]:
+                        self.error("Block %d has the unknown secondary type %d" % (blocknum, sec_type))
+                    referrer = blocknum
+                    blocknum = record.next_hash
+
+    def check_bitmap(self):
+        report = self.report
+        report.expected_flags = bytearray(bytes(self.refs).translate(_REFS_TO_FLAGS))
+        report.expected_flags[0:self.reserved] = bytes(self.reserved)
+        root_block = self.volume.root_block()
+        if root_block.bitmap_flag() != logical.ROOT_BLOCK_VALID_BITMAP:
+            report.bitmap_valid = False
+            self.error("The bitmap is marked as invalid")
+            return
+        try:
+            # the volume's allocator can hold allocations that were not synced
+            # yet, so the bitmap blocks are decoded again
+            flags = logical.BlockAllocator(self.volume).flags
+        except Exception as e:
+            report.bitmap_valid = False
+            self.error("Can't read the bitmap: %s" % e)
+            return
+        if flags[self.reserved:self.num_blocks] == report.expected_flags[self.reserved:]:
+            return
+        for blocknum in range(self.reserved, self.num_blocks):
+            if flags[blocknum] != report.expected_flags[blocknum]:
+                if flags[blocknum] == 0:
+                    report.orphaned.append(blocknum)
+                else:
+                    report.missing.append(blocknum)
+        if len(report.orphaned) > 0:
+            self.error("%d blocks are used in the bitmap, but not reachable" % len(report.orphaned))
+        if len(report.missing) > 0:
+            self.error("%d reachable blocks are free in the bitmap" % len(report.missing))
+
+    def check(self):
+        root_block = self.volume.root_block()
+        root_record = root_block.record()
+        if not self.reference(root_block.blocknum, ROLE_ROOT, 0):
+            return self.report
+        if (self.check_header(root_record, logical.BLOCK_TYPE_HEADER, None) and
+                root_record.secondary_type == logical.BLOCK_SEC_TYPE_ROOT):
+            self.check_bitmap_blocks(root_record)
+            self.check_tree(root_record)
+        else:
+            self.error("Block %d is not a root block" % root_block.blocknum)
+        self.check_bitmap()
+        return self.report
+
+
+def check_volume(volume):
+    """checks the consistency of a logical volume: all blocks are classified
+    by following the directory tree from the root block, the checksums of
+    all blocks are verified and the bitmap is compared to the blocks that are
+    actually reachable. Returns an FsckReport"""
+    if not volume.boot_block().is_dos():
+        raise Exception("Not an AmigaDOS volume")
+    return _Checker(volume).check()
+
+
+def repair_bitmap(volume, report):
+    """replaces the bitmap of the volume with the one rebuilt by check_volume().
+    This frees the orphaned blocks and allocates the missing ones, problems in the
+    directory tree (e.g. cross-linked blocks) are not repaired"""
+    root_block = volume.root_block()
+    if root_block.bitmap_flag() != logical.ROOT_BLOCK_VALID_BITMAP:
+        root_block.sector().set_u32_at(root_block.block_size() + logical.ROOT_BLOCK_SIZE_OFFSET_BITMAP_FLAG,
+                                       logical.ROOT_BLOCK_VALID_BITMAP & 0xffffffff)
+        root_block.update_checksum()
+    allocator = volume.allocator()
+    allocator.replace_flags(report.expected_flags)
+    allocator.sync()
@@ -0,0 +1,251 @@
+"""index.py - Persistent metadata index of Amiga disk volumes"""
+
+from array import array
+import json
+import os
+import struct
+import sys
+from . import logical
+from . import util
+
+# the index of an image is stored next to it in a sidecar file
+INDEX_SUFFIX = ".adfindex"
+INDEX_MAGIC = b'ADFIDX01'
+
+# the names and type codes of the arrays of an index. block_offsets has an
+# additional element, the data blocks of entry i are blocks[block_offsets[i]:block_offsets[i + 1]]
+INDEX_ARRAYS = [('blocknums', util.U32_TYPECODE), ('parents', 'i'), ('types', 'b'),
+                ('sizes', util.U32_TYPECODE), ('days', util.U32_TYPECODE), ('minutes', 'H'),
+                ('ticks', 'H'), ('block_offsets', 'Q'), ('blocks', util.U32_TYPECODE)]
+
+# names can't contain a slash, so it separates them in the index file
+NAME_SEPARATOR = "/"
+
+
+def _file_blocks(volume, record):
+    """returns the data block numbers of a file from the tables of its header
+    and extension blocks"""
+    result = []
+    table = record
+    visited = set()
+    while True:
+        result.extend(table.hashtable[::-1][0:table.high_seq])
+        if table.extension == 0 or table.extension in visited:
+            return result
+        visited.add(table.extension)
+        table = volume.header_record(table.extension)
+
+
+class VolumeIndex:
+    """The metadata of all the files and directories of a volume: name, parent,
+    secondary type, size, modification time and data blocks of each header.
+    The fields are stored in arrays, indexed by the entry number. Entry 0 is the
+    root directory, directories come before their entries.
+    An index is a snapshot of the volume, it does not follow modifications"""
+    def __init__(self, international=False):
+        self.international = international
+        self.names = []
+        for name, typecode in INDEX_ARRAYS:
+            setattr(self, name, array(typecode))
+        self.block_offsets.append(0)
+        self._children = None
+        self._lookup = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _add(self, record, parent, blocks):
+        self.names.append(record.name)
+        self.blocknums.append(record.blocknum)
+        self.parents.append(parent)
+        self.types.append(record.secondary_type)
+        self.sizes.append(record.file_size if record.secondary_type == logical.BLOCK_SEC_TYPE_FILE else 0)
+        self.days.append(record.days)
+        self.minutes.append(record.minutes)
+        self.ticks.append(record.ticks)
+        self.blocks.extend(blocks)
+        self.block_offsets.append(len(self.blocks))
+
+    @staticmethod
+    def build(volume):
+        """walks the directory tree of the volume once and records all entries"""
+        index = VolumeIndex(volume.is_international())
+        index._add(volume.root_block().record(), -1, [])
+        dir_entries = {'': 0}
+        for path, record in volume.iter_tree():
+            parent = dir_entries[path.rpartition("/")[0]]
+            if record.secondary_type == logical.BLOCK_SEC_TYPE_FILE:
+                index._add(record, parent, _file_blocks(volume, record))
+            else:
+                if record.secondary_type == logical.BLOCK_SEC_TYPE_USERDIR:
+                    dir_entries[path] = len(index)
+                index._add(record, parent, [])
+        return index
+
+    def save(self, path, key):
+        """writes the index to the file at path. key identifies the state of
+        the volume, see image_key(). The file is replaced atomically"""
+        header = {'key': key, 'international': self.international,
+                  'byteorder': sys.byteorder, 'count': len(self),
+                  'arrays': [[name, typecode, getattr(self, name).itemsize, len(getattr(self, name))]
+                             for name, typecode in INDEX_ARRAYS]}
+        header_data = json.dumps(header).encode('utf-8')
+        names = NAME_SEPARATOR.join(self.names).encode('latin-1')
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(INDEX_MAGIC + struct.pack(">II", len(header_data), len(names)))
+            outfile.write(header_data)
+            outfile.write(names)
+            for name, typecode in INDEX_ARRAYS:
+                getattr(self, name).tofile(outfile)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path, key=None):
+        """reads the index from the file at path. Returns None if the file does
+        not exist, can't be read or was written for a different key"""
+        try:
+            with open(path, "rb") as infile:
+                data = infile.read()
+            if data[0:len(INDEX_MAGIC)] != INDEX_MAGIC:
+                return None
+            offset = len(INDEX_MAGIC)
+            header_size, names_size = struct.unpack_from(">II", data, offset)
+            offset += 8
+            header = json.loads(data[offset:offset + header_size].decode('utf-8'))
+            offset += header_size
+            if key is not None and header['key'] != key:
+                return None
+            index = VolumeIndex(header['international'])
+            names = data[offset:offset + names_size].decode('latin-1')
+            index.names = names.split(NAME_SEPARATOR) if header['count'] > 0 else []
+            offset += names_size
+            for name, typecode, itemsize, length in header['arrays']:
+                values = array(typecode)
+                if values.itemsize != itemsize:
+                    return None
+                values.frombytes(data[offset:offset + itemsize * length])
+                if header['byteorder'] != sys.byteorder:
+                    values.byteswap()
+                setattr(index, name, values)
+                offset += itemsize * length
+            if len(index.names) != header['count'] or len(index.block_offsets) != header['count'] + 1:
+                return None
+            return index
+        except (OSError, ValueError, KeyError, struct.error):
+            return None
+
+    def children(self, entry):
+        """returns the entry numbers of the entries of a directory"""
+        if self._children is None:
+            children = [[] for i in range(len(self))]
+            for i, parent in enumerate(self.parents):
+                if parent >= 0:
+                    children[parent].append(i)
+            self._children = children
+        return self._children[entry]
+
+    def lookup(self, path):
+        """returns the entry number of the file or directory at path"""
+        if self._lookup is None:
+            self._lookup = {(parent, util.upper_name(name, self.international)): i
+                            for i, (parent, name) in enumerate(zip(self.parents, self.names))}
+        entry = 0
+        for comp in [p for p in path.split("/") if p != '']:
+            entry = self._lookup.get((entry, util.upper_name(comp, self.international)))
+            if entry is None:
+                raise Exception("can't find file/dir '%s'" % path)
+        return entry
+
+    def path(self, entry):
+        comps = []
+        while entry > 0:
+            comps.append(self.names[entry])
+            entry = self.parents[entry]
+        return "/".join(reversed(comps))
+
+    def is_dir(self, entry):
+        return self.types[entry] in [logical.BLOCK_SEC_TYPE_ROOT, logical.BLOCK_SEC_TYPE_USERDIR]
+
+    def is_file(self, entry):
+        return self.types[entry] == logical.BLOCK_SEC_TYPE_FILE
+
+    def last_modification_time(self, entry):
+        return util.amigados_time_to_datetime(self.days[entry], self.minutes[entry], self.ticks[entry])
+
+    def data_blocks(self, entry):
+        return self.blocks[self.block_offsets[entry]:self.block_offsets[entry + 1]].tolist()
+
+    def iter_tree(self, path="/"):
+        """generates the paths and entry numbers of all the files and
+        directories below path, directories before their entries"""
+        top = self.lookup(path)
+        pending = [(self.path(top), top)]
+        while len(pending) > 0:
+            dirpath, dir_entry = pending.pop()
+            for entry in self.children(dir_entry):
+                childpath = self.names[entry] if dirpath == '' else dirpath + "/" + self.names[entry]
+                yield childpath, entry
+                if self.types[entry] == logical.BLOCK_SEC_TYPE_USERDIR:
+                    pending.append((childpath, entry))
+
+    def find(self, query, path="/"):
+        """returns an iterator over the paths and entry numbers of the files and
+        directories below path that match the logical.FindQuery"""
+        top = self.lookup(path)
+        return self._find(query, [(self.path(top), top, 0)])
+
+    def _find(self, query, pending):
+        while len(pending) > 0:
+            dirpath, dir_entry, depth = pending.pop()
+            for entry in self.children(dir_entry):
+                name = self.names[entry]
+                childpath = name if dirpath == '' else dirpath + "/" + name
+                if query.matches(depth, name, self.types[entry], self.sizes[entry],
+                                 (self.days[entry], self.minutes[entry], self.ticks[entry]),
+                                 self.international):
+                    yield childpath, entry
+                if (self.types[entry] == logical.BLOCK_SEC_TYPE_USERDIR and
+                        query.descend(depth, name, self.international)):
+                    pending.append((childpath, entry, depth + 1))
+
+    def total_size(self, path="/"):
+        """returns the number of bytes in the files below path"""
+        top = self.lookup(path)
+        if top == 0:
+            return sum(self.sizes)
+        if not self.is_dir(top):
+            return self.sizes[top]
+        return sum(self.sizes[entry] for childpath, entry in self.iter_tree(path))
+
+
+def image_key(image_path, volume):
+    """identifies the state of a volume in an image file by the file's size and
+    modification time and the checksum of the volume's root block, which
+    changes with every modification of the volume"""
+    stat = os.stat(image_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+            'root_checksum': volume.root_block().stored_checksum()}
+
+
+def index_path(image_path, partition=None):
+    """the path of the sidecar file of a volume of an image"""
+    if partition is None:
+        return image_path + INDEX_SUFFIX
+    return "%s.%s%s" % (image_path, partition, INDEX_SUFFIX)
+
+
+def load_index(volume, image_path, partition=None):
+    """returns the index of a volume of the image file at image_path. It is
+    loaded from the sidecar file if that is up to date, otherwise it is built
+    and the sidecar file is written, if the image's directory is writable"""
+    key = image_key(image_path, volume)
+    path = index_path(image_path, partition)
+    index = VolumeIndex.load(path, key)
+    if index is None:
+        index = VolumeIndex.build(volume)
+        try:
+            index.save(path, key)
+        except OSError:
+            pass
+    return index
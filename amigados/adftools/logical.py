@@ -1,13 +1,21 @@
 """logical.py - Logical view on an Amiga disk"""
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from . import physical
+import io
+import os
+import struct
 from . import util
 
 BOOT_BLOCK_FLAG_FFS               = 1
 BOOT_BLOCK_FLAG_INTL_ONLY         = 2
 BOOT_BLOCK_FLAG_DIRCACHE_AND_INTL = 4
 
+# the boot code is always loaded from the first 1024 bytes, independent
+# of the block size of the volume
+BOOT_BLOCK_SIZE = 1024
+
 # Special blocks
 BLOCK_ID_BOOT       = "DOS"
 BLOCK_ID_RIGID_DISK = "RDSK"
@@ -32,10 +40,12 @@ ROOT_BLOCK_OFFSET_HASHTABLE_SIZE  = 12
 
 ROOT_BLOCK_SIZE_OFFSET_BITMAP_FLAG           = -200
 ROOT_BLOCK_SIZE_OFFSET_BITMAP_PAGES          = -196
+ROOT_BLOCK_SIZE_OFFSET_BITMAP_EXT            = -96
 ROOT_BLOCK_SIZE_OFFSET_LAST_DISK_ALTERATION  = -40
 ROOT_BLOCK_SIZE_OFFSET_FILESYS_CREATION_TIME = -28
 
 ROOT_BLOCK_VALID_BITMAP = -1
+ROOT_BLOCK_NUM_BITMAP_PAGES = 25
 
 HEADER_BLOCK_OFFSET_HEADER_KEY = 4
 HEADER_BLOCK_OFFSET_HIGH_SEQ   = 8
@@ -44,6 +54,8 @@ HEADER_BLOCK_OFFSET_FIRST_DATA = 16
 HEADER_BLOCK_OFFSET_CHECKSUM   = 20
 HEADER_BLOCK_OFFSET_HASHTABLE  = 24
 
+HEADER_BLOCK_SIZE_OFFSET_PROTECTION    = -192
+HEADER_BLOCK_SIZE_OFFSET_BYTE_SIZE     = -188
 HEADER_BLOCK_SIZE_OFFSET_LAST_MODIFIED = -92
 HEADER_BLOCK_SIZE_OFFSET_COMMENT_LEN   = -184
 HEADER_BLOCK_SIZE_OFFSET_COMMENT       = -183
@@ -56,6 +68,31 @@ HEADER_BLOCK_SIZE_OFFSET_SECTYPE       = -4
 
 BITMAP_BLOCK_OFFSET_CHECKSUM = 0
 
+DIRCACHE_BLOCK_OFFSET_PARENT      = 8
+DIRCACHE_BLOCK_OFFSET_NUM_RECORDS = 12
+DIRCACHE_BLOCK_OFFSET_NEXT        = 16
+DIRCACHE_BLOCK_OFFSET_RECORDS     = 24
+
+# the fixed part of a dircache record, followed by the name, the comment
+# length and the comment
+DIRCACHE_RECORD_FORMAT = ">IIIHHHHHbB"
+DIRCACHE_RECORD_HEADER_SIZE = 24
+
+DATA_BLOCK_OFFSET_HEADER_KEY = 4
+DATA_BLOCK_OFFSET_SEQ_NUM    = 8
+DATA_BLOCK_OFFSET_DATA_SIZE  = 12
+DATA_BLOCK_OFFSET_NEXT_DATA  = 16
+
+MAX_NAME_LENGTH = 30
+
+# default maximum number of decoded header blocks cached per volume
+HEADER_CACHE_SIZE = 4096
+# default maximum number of resolved paths cached per volume
+PATH_CACHE_SIZE = 65536
+
+# the extended attribute extract_tree() stores file comments in
+XATTR_COMMENT = "user.amigados.comment"
+
 class DiskBlock:
     def __init__(self, logical_volume):
         self.logical_volume = logical_volume
@@ -72,8 +109,7 @@ class BootBlock(DiskBlock):
         super().__init__(logical_volume)
 
     def block_size(self):
-        # TODO: this is currently hardcoded to floppy disks
-        return physical.FLOPPY_BYTES_PER_SECTOR * physical.FLOPPY_TRACKS_PER_CYLINDER
+        return BOOT_BLOCK_SIZE
 
     def data(self):
         return self.logical_volume.physical_volume.data[0:self.block_size()]
@@ -97,6 +133,13 @@ class BootBlock(DiskBlock):
     def flags(self):
         return self.physical_volume()[3] & 0x07
 
+    def uses_dircache(self):
+        return (self.flags() & BOOT_BLOCK_FLAG_DIRCACHE_AND_INTL) != 0
+
+    def is_international(self):
+        """international mode is also implied by the dircache flag"""
+        return (self.flags() & (BOOT_BLOCK_FLAG_INTL_ONLY | BOOT_BLOCK_FLAG_DIRCACHE_AND_INTL)) != 0
+
     def filesystem_type(self):
         return "FFS" if (self.flags() & 1) == 1 else "OFS"
 
@@ -107,6 +150,102 @@ class BootBlock(DiskBlock):
         return self.logical_volume.physical_volume.u32_at(4)
 
 
+class HeaderRecord:
+    """The decoded fields of a header block. Records are immutable snapshots,
+    the HeaderCache drops them when their block is modified"""
+    __slots__ = ('blocknum', 'primary_type', 'header_key', 'high_seq', 'hashtable',
+                 'protection', 'file_size', 'comment', 'days', 'minutes', 'ticks',
+                 'name', 'next_hash', 'parent', 'extension', 'secondary_type')
+
+    def __init__(self, blocknum, data):
+        size = len(data)
+        self.blocknum = blocknum
+        self.primary_type, self.header_key, self.high_seq = struct.unpack_from(">III", data, 0)
+        self.hashtable = struct.unpack_from(">%dI" % (size // 4 - 56), data,
+                                            HEADER_BLOCK_OFFSET_HASHTABLE)
+        self.protection, self.file_size = struct.unpack_from(">II", data,
+                                                             size + HEADER_BLOCK_SIZE_OFFSET_PROTECTION)
+        comm_len = data[size + HEADER_BLOCK_SIZE_OFFSET_COMMENT_LEN]
+        self.comment = bytes(data[size + HEADER_BLOCK_SIZE_OFFSET_COMMENT:
+                                  size + HEADER_BLOCK_SIZE_OFFSET_COMMENT + comm_len]).decode('latin-1')
+        self.days, self.minutes, self.ticks = struct.unpack_from(">III", data,
+                                                                 size + HEADER_BLOCK_SIZE_OFFSET_LAST_MODIFIED)
+        name_len = data[size + HEADER_BLOCK_SIZE_OFFSET_NAME_LEN]
+        self.name = bytes(data[size + HEADER_BLOCK_SIZE_OFFSET_NAME:
+                               size + HEADER_BLOCK_SIZE_OFFSET_NAME + name_len]).decode('latin-1')
+        (self.next_hash, self.parent, self.extension,
+         self.secondary_type) = struct.unpack_from(">IIIi", data, size + HEADER_BLOCK_SIZE_OFFSET_NEXT_HASH)
+
+    def last_modification_time(self):
+        return util.amigados_time_to_datetime(self.days, self.minutes, self.ticks)
+
+
+class HeaderCache:
+    """A size bounded LRU cache of decoded header records, indexed by block number.
+    Register invalidate() as a write listener of the physical volume to keep it
+    coherent"""
+    def __init__(self, logical_volume, max_size=HEADER_CACHE_SIZE):
+        self.logical_volume = logical_volume
+        self.max_size = max_size
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, blocknum):
+        record = self.records.get(blocknum)
+        if record is not None:
+            self.records.move_to_end(blocknum)
+            self.hits += 1
+            return record
+        self.misses += 1
+        record = HeaderRecord(blocknum, self.logical_volume.physical_volume.sector(blocknum).data)
+        self.records[blocknum] = record
+        if len(self.records) > self.max_size:
+            self.records.popitem(last=False)
+        return record
+
+    def invalidate(self, blocknum):
+        self.records.pop(blocknum, None)
+
+    def clear(self):
+        self.records.clear()
+
+
+class PathCache:
+    """A case-insensitive cache of paths to header block numbers. It also contains
+    negative entries (None) for paths that don't exist. Paths are represented
+    as tuples of upper case path components, international volumes also
+    upper case the Latin-1 letters.
+    The cache is not aware of modifications, the operations that change
+    the directory structure need to call invalidate()"""
+    def __init__(self, max_size=PATH_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path, international=False):
+        return tuple(util.upper_name(p, international) for p in path.split("/") if p != '')
+
+    def put(self, key, blocknum):
+        if len(self.entries) >= self.max_size:
+            self.entries.clear()
+        self.entries[key] = blocknum
+
+    def invalidate(self, key):
+        """removes the entry for key and all the entries below it"""
+        num_comps = len(key)
+        for cached_key in [k for k in self.entries if k[0:num_comps] == key]:
+            del self.entries[cached_key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
 class HeaderBlock(DiskBlock):
     """A logical view on header blocks. Those are the first block of a directory
     or file."""
@@ -123,12 +262,15 @@ class HeaderBlock(DiskBlock):
     def data(self):
         return self.sector().data
 
+    def record(self):
+        """the decoded fields of this block"""
+        return self.logical_volume.header_record(self.blocknum)
+
     def primary_type(self):
-        return self.sector().u32_at(0)
+        return self.record().primary_type
 
     def secondary_type(self):
-        sector = self.sector()
-        return sector.i32_at(sector.size_in_bytes() - 4)
+        return self.record().secondary_type
 
     def is_file(self):
         return self.secondary_type() == BLOCK_SEC_TYPE_FILE
@@ -137,16 +279,10 @@ class HeaderBlock(DiskBlock):
         return self.secondary_type() == BLOCK_SEC_TYPE_USERDIR
 
     def header_key(self):
-        return self.sector().u32_at(HEADER_BLOCK_OFFSET_HEADER_KEY)
+        return self.record().header_key
 
     def name(self):
-        sector = self.sector()
-        soffset = sector.size_in_bytes() + HEADER_BLOCK_SIZE_OFFSET_NAME_LEN
-        slen = sector[soffset]
-        result = ""
-        for i in range(slen):
-            result += chr(sector[soffset + i + 1])
-        return result
+        return self.record().name
 
     def _amigados_time_at(self, offset):
         sector = self.sector()
@@ -164,7 +300,7 @@ class HeaderBlock(DiskBlock):
         sector.set_u32_at(sector.size_in_bytes() + offset + 8, ticks)
 
     def last_modification_time(self):
-        return self._amigados_time_at(HEADER_BLOCK_SIZE_OFFSET_LAST_MODIFIED)
+        return self.record().last_modification_time()
 
     def update_last_modification_time(self):
         now = datetime.now()
@@ -186,22 +322,17 @@ class HeaderBlock(DiskBlock):
         self.update_checksum()
 
     def file_comment(self):
-        sector = self.sector()
-        comm_len = sector[self.block_size() + HEADER_BLOCK_SIZE_OFFSET_COMMENT_LEN]
-        result = ""
-        for i in range(comm_len):
-            result += chr(sector[self.block_size() + HEADER_BLOCK_SIZE_OFFSET_COMMENT + i])
-        return result
+        return self.record().comment
 
     def parent(self):
-        return self.sector().u32_at(self.block_size() + HEADER_BLOCK_SIZE_OFFSET_PARENT)
+        return self.record().parent
 
     def set_parent(self, blocknum):
         return self.sector().set_u32_at(self.block_size() + HEADER_BLOCK_SIZE_OFFSET_PARENT,
                                         blocknum)
 
     def next_hash(self):
-        return self.sector().u32_at(self.block_size() + HEADER_BLOCK_SIZE_OFFSET_NEXT_HASH)
+        return self.record().next_hash
 
     def set_next_hash(self, blocknum):
         return self.sector().set_u32_at(self.block_size() + HEADER_BLOCK_SIZE_OFFSET_NEXT_HASH,
@@ -211,36 +342,31 @@ class HeaderBlock(DiskBlock):
     # Directory header block only
     def is_empty(self):
         # inspect the hash table
-        for i in range(self.hashtable_size()):
-            ht_entry = self.hashtable_entry_at(i)
-            if ht_entry != 0:
-                return False
-        return True
+        return not any(self.record().hashtable)
 
     def find_header(self, filename):
-        hash_index = util.compute_hash(filename, self.block_size())
+        international = self.logical_volume.is_international()
+        hash_index = util.compute_hash(filename, self.block_size(), international)
         sector_num = self.hashtable_entry_at(hash_index)
-        header = self.logical_volume.header_block_at(sector_num)
-        while (header.name().upper() != filename.upper() and
-               header.next_hash() != 0):
+        upper_name = util.upper_name(filename, international)
+        while sector_num != 0:
+            header = self.logical_volume.header_block_at(sector_num)
+            if util.upper_name(header.name(), international) == upper_name:
+                return header
             # follow hash chain
-            header = self.logical_volume.header_block_at(header.next_hash())
-        if header.name().upper() != filename.upper():
-            raise Exception("can't find file/dir '%s'" % filename)
-
-        return header
+            sector_num = header.next_hash()
+        raise Exception("can't find file/dir '%s'" % filename)
 
     def hashtable_size(self):
-        """This is hard coded, because header blocks don't contain the size.
-        Adjust according to the disk type"""
-        return 72
+        """header blocks don't contain the size, the hash table takes up the
+        space that is left by the other fields"""
+        return self.block_size() // 4 - 56
 
     def hashtable_entry_at(self, index):
-        sector = self.sector()
         if index > self.hashtable_size():
             raise IndexError("Index out of bounds: %d, hash table size: %d" %
                              (index, self.hashtable_size()))
-        return sector.u32_at(HEADER_BLOCK_OFFSET_HASHTABLE + (index * 4))
+        return self.record().hashtable[index]
 
     def append_hashtable_entry_at(self, index, blocknum):
         """add block number to the bucket at the specified hash table index"""
@@ -258,6 +384,7 @@ class HeaderBlock(DiskBlock):
             while curblock.next_hash() != 0:
                 curblock = self.logical_volume.header_block_at(curblock.next_hash())
             curblock.set_next_hash(blocknum)
+            curblock.update_checksum()
 
     def delete_hashtable_entry_at(self, index, blocknum):
         """delete block number from the bucket at the specified hash table index"""
@@ -282,7 +409,7 @@ class HeaderBlock(DiskBlock):
             prev_hash.update_checksum()
 
     def delete_child_from_hashtable(self, child_header):
-        hash_index = util.compute_hash(child_header.name(), self.block_size())
+        hash_index = self.logical_volume.hash_name(child_header.name())
         self.delete_hashtable_entry_at(hash_index, child_header.header_key())
 
 
@@ -308,25 +435,96 @@ class HeaderBlock(DiskBlock):
         self.update_last_modification_time()
         self.update_checksum()
 
+    def set_last_modification_time(self, dt):
+        days, minutes, ticks = util.datetime_to_amigados_time(dt)
+        self._set_amigados_time_at(HEADER_BLOCK_SIZE_OFFSET_LAST_MODIFIED,
+                                   days, minutes, ticks)
+
     #################################
     # File header block only
+    def _set_data_block_table(self, data_blocks):
+        """stores the data block numbers in the block's table, which is filled
+        backwards from the end of the block"""
+        sector = self.sector()
+        for i, blocknum in enumerate(data_blocks):
+            sector.set_u32_at((self.block_size() - DATABLOCK_OFFSET) - (i * 4), blocknum)
+        sector.set_u32_at(HEADER_BLOCK_OFFSET_HIGH_SEQ, len(data_blocks))
+
+    def set_extension(self, blocknum):
+        self.sector().set_u32_at(self.block_size() + HEADER_BLOCK_SIZE_OFFSET_EXT, blocknum)
+
+    def init_file(self, name, parent_block, file_size, data_blocks, extension=0,
+                  modified=None):
+        """Initialize this block as a new file header block. data_blocks are the
+        data block numbers stored in the header itself, the others are stored in
+        the extension blocks"""
+        sector = self.sector()
+        sector.clear_data()
+        sector.set_u32_at(0, BLOCK_TYPE_HEADER)
+        sector.set_u32_at(HEADER_BLOCK_OFFSET_HEADER_KEY, self.blocknum)
+        sector.set_u32_at(self.block_size() + HEADER_BLOCK_SIZE_OFFSET_SECTYPE,
+                          BLOCK_SEC_TYPE_FILE & 0xffffffff)
+        self._set_data_block_table(data_blocks)
+        sector.set_u32_at(HEADER_BLOCK_OFFSET_FIRST_DATA, data_blocks[0] if len(data_blocks) > 0 else 0)
+        sector.set_u32_at(self.block_size() + HEADER_BLOCK_SIZE_OFFSET_BYTE_SIZE, file_size)
+        self.set_extension(extension)
+        self._set_name(name)
+        self.set_parent(parent_block)
+        if modified is None:
+            self.update_last_modification_time()
+        else:
+            self.set_last_modification_time(modified)
+        self.update_checksum()
+
+    def init_extension(self, file_header_block, data_blocks, extension=0):
+        """Initialize this block as an extension block of a file, which stores
+        more data block numbers"""
+        sector = self.sector()
+        sector.clear_data()
+        sector.set_u32_at(0, BLOCK_TYPE_LIST)
+        sector.set_u32_at(HEADER_BLOCK_OFFSET_HEADER_KEY, self.blocknum)
+        sector.set_u32_at(self.block_size() + HEADER_BLOCK_SIZE_OFFSET_SECTYPE,
+                          BLOCK_SEC_TYPE_FILE & 0xffffffff)
+        self._set_data_block_table(data_blocks)
+        self.set_parent(file_header_block)
+        self.set_extension(extension)
+        self.update_checksum()
+
     def high_seq(self):
         """number of data block pointers"""
-        return self.sector().u32_at(HEADER_BLOCK_OFFSET_HIGH_SEQ)
+        return self.record().high_seq
 
     def file_size(self):
-        return self.sector().u32_at(self.block_size() - 188)
+        return self.record().file_size
 
-    def data_blocks(self):
-        """Returns all the data block numbers of this file
-        TODO: handle extension blocks for large files"""
+    def extension(self):
+        """block number of the first extension block, 0 if there is none"""
+        return self.record().extension
+
+    def extension_blocks(self):
+        """Returns the block numbers of the extension blocks of this file"""
         result = []
-        sector = self.sector()
-        for i in range(self.high_seq()):
-            datablock_num = sector.u32_at((self.block_size() - DATABLOCK_OFFSET) - (i * 4))
-            result.append(datablock_num)
+        blocknum = self.extension()
+        while blocknum != 0:
+            result.append(blocknum)
+            blocknum = self.logical_volume.header_record(blocknum).extension
         return result
 
+    def iter_data_blocks(self):
+        """Generates the data block numbers of this file. The data block tables
+        of the header and the extension blocks are read as they are needed"""
+        table_blocknum = self.blocknum
+        while table_blocknum != 0:
+            record = self.logical_volume.header_record(table_blocknum)
+            sector = self.physical_volume().sector(table_blocknum)
+            for i in range(min(record.high_seq, len(record.hashtable))):
+                yield sector.u32_at((self.block_size() - DATABLOCK_OFFSET) - (i * 4))
+            table_blocknum = record.extension
+
+    def data_blocks(self):
+        """Returns all the data block numbers of this file"""
+        return list(self.iter_data_blocks())
+
 
 class RootBlock(HeaderBlock):
     """A logical view on the root block, a special header block, which is at a
@@ -347,6 +545,29 @@ class RootBlock(HeaderBlock):
         self._set_amigados_time_at(ROOT_BLOCK_SIZE_OFFSET_LAST_DISK_ALTERATION,
                                    days, minutes, ticks)
 
+    def init_root(self, name, bitmap_blocks, bitmap_ext=0):
+        """Initialize this block as the root block of an empty volume.
+        bitmap_blocks are the block numbers of the first 25 bitmap blocks,
+        bitmap_ext is the first bitmap extension block"""
+        sector = self.sector()
+        sector.clear_data()
+        sector.set_u32_at(0, BLOCK_TYPE_HEADER)
+        sector.set_u32_at(ROOT_BLOCK_OFFSET_HASHTABLE_SIZE, self.block_size() // 4 - 56)
+        sector.set_u32_at(self.block_size() + ROOT_BLOCK_SIZE_OFFSET_BITMAP_FLAG,
+                          ROOT_BLOCK_VALID_BITMAP & 0xffffffff)
+        for i, blocknum in enumerate(bitmap_blocks[0:ROOT_BLOCK_NUM_BITMAP_PAGES]):
+            sector.set_u32_at(self.block_size() + ROOT_BLOCK_SIZE_OFFSET_BITMAP_PAGES + i * 4,
+                              blocknum)
+        sector.set_u32_at(self.block_size() + ROOT_BLOCK_SIZE_OFFSET_BITMAP_EXT, bitmap_ext)
+        sector.set_u32_at(self.block_size() + HEADER_BLOCK_SIZE_OFFSET_SECTYPE, BLOCK_SEC_TYPE_ROOT)
+        self._set_name(name)
+        days, minutes, ticks = util.datetime_to_amigados_time(datetime.now())
+        for offset in [HEADER_BLOCK_SIZE_OFFSET_LAST_MODIFIED,
+                       ROOT_BLOCK_SIZE_OFFSET_LAST_DISK_ALTERATION,
+                       ROOT_BLOCK_SIZE_OFFSET_FILESYS_CREATION_TIME]:
+            self._set_amigados_time_at(offset, days, minutes, ticks)
+        self.update_checksum()
+
     def mark_disk_as_modified(self):
         self.update_last_disk_modification_time()
         self.update_checksum()
@@ -361,45 +582,61 @@ class RootBlock(HeaderBlock):
         return BitmapBlock(self.logical_volume,
                            self.sector().u32_at(self.block_size() + ROOT_BLOCK_SIZE_OFFSET_BITMAP_PAGES))
 
-    def block_allocation(self):
+    def bitmap_block_numbers(self, num_blocks=None):
+        """returns the block numbers of the bitmap blocks in order. Those are
+        stored in the root block's bitmap page table, which is continued
+        in a chain of bitmap extension blocks. If num_blocks is specified, at
+        most num_blocks block numbers are returned"""
+        result = []
         sector = self.sector()
-        bm_pages = []
-        if self.bitmap_flag() == ROOT_BLOCK_VALID_BITMAP:
-            # we only need 1 bitmap block on a floppy disk
-            bitmap_block = self.bitmap_block0()
-            bm_sector = bitmap_block.sector()
-            block_idx = 2
-            free_blocks = []
-            used_blocks = []
-            for bytenum in range(4, bitmap_block.block_size(), 4):
-                l = bm_sector.u32_at(bytenum)
-
-                # don't try to check more than we have !!!
-                if block_idx > self.physical_volume().num_sectors():
-                    break
-
-                mask = 0x80000000
-                for i in range(32):
-                    if (mask & l) == mask:
-                        free_blocks.append(block_idx)
-                    else:
-                        used_blocks.append(block_idx)
-                    mask >>= 1
-                    block_idx += 1
-                    if block_idx > self.physical_volume().num_sectors():
-                        break
+        for i in range(ROOT_BLOCK_NUM_BITMAP_PAGES):
+            blocknum = sector.u32_at(self.block_size() + ROOT_BLOCK_SIZE_OFFSET_BITMAP_PAGES + i * 4)
+            if blocknum == 0 or len(result) == num_blocks:
+                return result
+            result.append(blocknum)
+
+        # the last long word of an extension block links to the next one
+        ext_blocknum = sector.u32_at(self.block_size() + ROOT_BLOCK_SIZE_OFFSET_BITMAP_EXT)
+        visited = set()
+        while ext_blocknum != 0 and ext_blocknum not in visited:
+            visited.add(ext_blocknum)
+            ext_sector = self.physical_volume().sector(ext_blocknum)
+            for offset in range(0, ext_sector.size_in_bytes() - 4, 4):
+                blocknum = ext_sector.u32_at(offset)
+                if blocknum == 0 or len(result) == num_blocks:
+                    return result
+                result.append(blocknum)
+            ext_blocknum = ext_sector.u32_at(ext_sector.size_in_bytes() - 4)
+        return result
+
+    def bitmap_ext_block_numbers(self):
+        """returns the block numbers of the chain of bitmap extension blocks"""
+        result = []
+        ext_blocknum = self.sector().u32_at(self.block_size() + ROOT_BLOCK_SIZE_OFFSET_BITMAP_EXT)
+        while ext_blocknum != 0 and ext_blocknum not in result:
+            result.append(ext_blocknum)
+            ext_sector = self.physical_volume().sector(ext_blocknum)
+            ext_blocknum = ext_sector.u32_at(ext_sector.size_in_bytes() - 4)
+        return result
+
+    def bitmap_blocks(self, num_blocks=None):
+        return [BitmapBlock(self.logical_volume, blocknum)
+                for blocknum in self.bitmap_block_numbers(num_blocks)]
 
-        return free_blocks, used_blocks
+    def block_allocation(self):
+        """returns the lists of free and used block numbers"""
+        allocator = self.logical_volume.allocator()
+        return allocator.free_blocks(), allocator.used_blocks()
 
     def allocate_block(self, blocknum):
-        free_blocks, used_blocks = self.block_allocation()
-        if not blocknum in free_blocks:
-            raise Exception("ERROR: can't allocate block %d - already used !!!" % blocknum)
-        # we only need 1 bitmap block on a floppy disk
-        self.bitmap_block0().mark_block_used(blocknum)
+        allocator = self.logical_volume.allocator()
+        allocator.allocate(blocknum)
+        allocator.sync()
 
     def free_block(self, blocknum):
-        self.bitmap_block0().mark_block_free(blocknum)
+        allocator = self.logical_volume.allocator()
+        allocator.free(blocknum)
+        allocator.sync()
 
 
 class BitmapBlock(DiskBlock):
@@ -430,8 +667,9 @@ class BitmapBlock(DiskBlock):
         wordnum = int((blocknum - 2) / 32)
         bytenum = (wordnum + 1) * 4
         bitnum = (blocknum - 2) % 32
-        # clear the bit by shifting + inverting
-        mask = 0x80000000 >> bitnum
+        # clear the bit by shifting + inverting. The first block of a long
+        # word is represented by the least significant bit
+        mask = 1 << bitnum
         mask ^= 0xffffffff
 
         sector = self.sector()
@@ -449,7 +687,7 @@ class BitmapBlock(DiskBlock):
         bytenum = (wordnum + 1) * 4
         bitnum = (blocknum - 2) % 32
         # set 1 bit and shift to create an or-mask
-        mask = 0x80000000 >> bitnum
+        mask = 1 << bitnum
         sector = self.sector()
         orig = sector.u32_at(bytenum)
         sector.set_u32_at(bytenum, mask | orig)
@@ -458,6 +696,365 @@ class BitmapBlock(DiskBlock):
         sector.set_u32_at(BITMAP_BLOCK_OFFSET_CHECKSUM, self.computed_checksum())
 
 
+class DirCacheEntry:
+    """A directory entry as stored in a dircache block. It has the same field
+    names as HeaderRecord, so listings can use both"""
+    __slots__ = ('blocknum', 'file_size', 'protection', 'days', 'minutes', 'ticks',
+                 'secondary_type', 'name', 'comment')
+
+    def __init__(self, blocknum, file_size, protection, days, minutes, ticks,
+                 secondary_type, name, comment):
+        self.blocknum = blocknum
+        self.file_size = file_size
+        self.protection = protection
+        self.days = days
+        self.minutes = minutes
+        self.ticks = ticks
+        self.secondary_type = secondary_type
+        self.name = name
+        self.comment = comment
+
+    @staticmethod
+    def from_record(record):
+        file_size = record.file_size if record.secondary_type == BLOCK_SEC_TYPE_FILE else 0
+        return DirCacheEntry(record.blocknum, file_size, record.protection, record.days,
+                             record.minutes, record.ticks, record.secondary_type,
+                             record.name, record.comment)
+
+    def last_modification_time(self):
+        return util.amigados_time_to_datetime(self.days, self.minutes, self.ticks)
+
+    def size_in_block(self):
+        """records are padded to an even size"""
+        size = DIRCACHE_RECORD_HEADER_SIZE + len(self.name) + 1 + len(self.comment)
+        return size + (size & 1)
+
+    def pack(self):
+        name = self.name.encode('latin-1')
+        comment = self.comment.encode('latin-1')
+        result = struct.pack(DIRCACHE_RECORD_FORMAT, self.blocknum, self.file_size,
+                             self.protection, 0, 0, self.days, self.minutes, self.ticks,
+                             self.secondary_type, len(name))
+        result += name + bytes([len(comment)]) + comment
+        return result + bytes(len(result) & 1)
+
+
+class DirEntry:
+    """An entry of a directory as generated by LogicalVolume.scandir() and
+    walk(). It only holds the fields of the directory listing, the modification
+    time is decoded when it is asked for and the header block is only read
+    by header()"""
+    __slots__ = ('volume', 'path', 'name', 'blocknum', 'secondary_type', 'size',
+                 'protection', 'comment', 'days', 'minutes', 'ticks')
+
+    def __init__(self, volume, dirpath, record):
+        self.volume = volume
+        self.path = record.name if dirpath == '' else dirpath + "/" + record.name
+        self.name = record.name
+        self.blocknum = record.blocknum
+        self.secondary_type = record.secondary_type
+        self.size = record.file_size if record.secondary_type == BLOCK_SEC_TYPE_FILE else 0
+        self.protection = record.protection
+        self.comment = record.comment
+        self.days = record.days
+        self.minutes = record.minutes
+        self.ticks = record.ticks
+
+    def is_dir(self):
+        return self.secondary_type == BLOCK_SEC_TYPE_USERDIR
+
+    def is_file(self):
+        return self.secondary_type == BLOCK_SEC_TYPE_FILE
+
+    def is_link(self):
+        return self.secondary_type in [BLOCK_SEC_TYPE_SOFTLINK, BLOCK_SEC_TYPE_LINKDIR,
+                                       BLOCK_SEC_TYPE_LINKFILE]
+
+    def last_modification_time(self):
+        return util.amigados_time_to_datetime(self.days, self.minutes, self.ticks)
+
+    def header(self):
+        return self.volume.header_block_at(self.blocknum)
+
+    def __repr__(self):
+        return "<DirEntry '%s'>" % self.path
+
+
+class FindQuery:
+    """The criteria of a search with LogicalVolume.find() or VolumeIndex.find().
+    pattern is a path pattern relative to the start directory, each of its
+    components is an AmigaDOS pattern matched against one level of the tree, so
+    directories that can't contain matches are skipped. name is a pattern that
+    is matched against the names at any level. The modification time bounds are
+    datetime objects, entry_type is 'file' or 'dir'.
+    The patterns are compiled once per hash mode, so a query can be used for
+    many volumes"""
+    def __init__(self, pattern=None, name=None, min_size=None, max_size=None,
+                 after=None, before=None, entry_type=None):
+        self.pattern = pattern
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.after = util.amigados_time_key(after) if after is not None else None
+        self.before = util.amigados_time_key(before) if before is not None else None
+        if entry_type not in [None, 'file', 'dir']:
+            raise Exception("Unknown entry type '%s'" % entry_type)
+        self.entry_type = entry_type
+        self._compiled = {}
+        # fail early on invalid patterns
+        self._patterns(False)
+
+    def _patterns(self, international):
+        """returns the compiled components of the path pattern and the compiled
+        name pattern"""
+        if international not in self._compiled:
+            components = None
+            if self.pattern is not None:
+                components = [util.compile_pattern(p, international)
+                              for p in self.pattern.split("/") if p != '']
+            name = util.compile_pattern(self.name, international) if self.name is not None else None
+            self._compiled[international] = (components, name)
+        return self._compiled[international]
+
+    def descend(self, depth, name, international=False):
+        """whether the directory name at depth (0 for the entries of the start
+        directory) can contain matches"""
+        components = self._patterns(international)[0]
+        if components is None:
+            return True
+        return (depth + 1 < len(components) and
+                components[depth].fullmatch(util.upper_name(name, international)) is not None)
+
+    def matches(self, depth, name, secondary_type, size, date, international=False):
+        """date is the modification time as the tuple (days, minutes, ticks)"""
+        if self.entry_type == 'file' and secondary_type != BLOCK_SEC_TYPE_FILE:
+            return False
+        if self.entry_type == 'dir' and secondary_type != BLOCK_SEC_TYPE_USERDIR:
+            return False
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        if self.after is not None and date <= self.after:
+            return False
+        if self.before is not None and date >= self.before:
+            return False
+        components, name_pattern = self._patterns(international)
+        if components is None and name_pattern is None:
+            return True
+        upper_name = util.upper_name(name, international)
+        if components is not None and (depth != len(components) - 1 or
+                                       components[depth].fullmatch(upper_name) is None):
+            return False
+        return name_pattern is None or name_pattern.fullmatch(upper_name) is not None
+
+
+class DirCacheBlock(DiskBlock):
+    """A block of the directory cache of DCFS volumes. The cache blocks of a
+    directory form a list starting at the extension field of the directory's
+    header, they contain the names and the most important fields of its
+    entries, so a directory can be listed without reading the entries' headers"""
+    def __init__(self, logical_volume, blocknum):
+        super().__init__(logical_volume)
+        self.blocknum = blocknum
+
+    def block_size(self):
+        return self.sector().size_in_bytes()
+
+    def sector(self):
+        return self.physical_volume().sector(self.blocknum)
+
+    def records_size(self):
+        """the number of bytes available for records"""
+        return self.block_size() - DIRCACHE_BLOCK_OFFSET_RECORDS
+
+    def num_records(self):
+        return self.sector().u32_at(DIRCACHE_BLOCK_OFFSET_NUM_RECORDS)
+
+    def next_block(self):
+        return self.sector().u32_at(DIRCACHE_BLOCK_OFFSET_NEXT)
+
+    def set_next_block(self, blocknum):
+        self.sector().set_u32_at(DIRCACHE_BLOCK_OFFSET_NEXT, blocknum)
+        self.update_checksum()
+
+    def entries(self):
+        data = self.sector().data
+        result = []
+        offset = DIRCACHE_BLOCK_OFFSET_RECORDS
+        for i in range(self.num_records()):
+            (blocknum, file_size, protection, uid, gid, days, minutes, ticks,
+             secondary_type, name_len) = struct.unpack_from(DIRCACHE_RECORD_FORMAT, data, offset)
+            name_offset = offset + DIRCACHE_RECORD_HEADER_SIZE
+            name = bytes(data[name_offset:name_offset + name_len]).decode('latin-1')
+            comment_len = data[name_offset + name_len]
+            comment = bytes(data[name_offset + name_len + 1:
+                                 name_offset + name_len + 1 + comment_len]).decode('latin-1')
+            entry = DirCacheEntry(blocknum, file_size, protection, days, minutes, ticks,
+                                  secondary_type, name, comment)
+            result.append(entry)
+            offset += entry.size_in_block()
+        return result
+
+    def fits(self, entries):
+        return sum(entry.size_in_block() for entry in entries) <= self.records_size()
+
+    def set_entries(self, entries):
+        records = b''.join(entry.pack() for entry in entries)
+        if len(records) > self.records_size():
+            raise Exception("Dircache records don't fit into block %d" % self.blocknum)
+        sector = self.sector()
+        sector.write_at(DIRCACHE_BLOCK_OFFSET_RECORDS,
+                        records + bytes(self.records_size() - len(records)))
+        sector.set_u32_at(DIRCACHE_BLOCK_OFFSET_NUM_RECORDS, len(entries))
+        self.update_checksum()
+
+    def init_dircache(self, parent_block, entries=[], next_block=0):
+        """Initialize this block as a dircache block of the directory parent_block"""
+        sector = self.sector()
+        sector.clear_data()
+        sector.set_u32_at(0, BLOCK_TYPE_DIRCACHE)
+        sector.set_u32_at(HEADER_BLOCK_OFFSET_HEADER_KEY, self.blocknum)
+        sector.set_u32_at(DIRCACHE_BLOCK_OFFSET_PARENT, parent_block)
+        sector.set_u32_at(DIRCACHE_BLOCK_OFFSET_NEXT, next_block)
+        self.set_entries(entries)
+
+    def update_checksum(self):
+        self.sector().set_u32_at(HEADER_BLOCK_OFFSET_CHECKSUM,
+                                 util.headerblock_checksum(self.sector().data, self.block_size()))
+
+
+# translation tables between bitmap bytes and one byte per block flags
+# (1 = free), the first block of a byte is represented by the least significant bit
+_BITMAP_BYTE_TO_FLAGS = [bytes((b >> i) & 1 for i in range(8)) for b in range(256)]
+_FLAGS_TO_BITMAP_BYTE = {flags: b for b, flags in enumerate(_BITMAP_BYTE_TO_FLAGS)}
+
+
+def _swap_longwords(data):
+    """reverses the byte order of each long word, so the bytes of the bitmap
+    are ordered from the lowest to the highest block"""
+    result = bytearray(len(data))
+    for i in range(4):
+        result[i::4] = data[3 - i::4]
+    return result
+
+
+class BlockAllocator:
+    """An in-memory index of the volume's block bitmap.
+    All bitmap blocks of the volume are loaded once into a single logical bitmap
+    with one flag byte per block, so testing, allocating and freeing a block is
+    a constant time operation and searching for (contiguous) free blocks is done
+    by bytearray.find().
+    Only the modified bitmap blocks are written back to the volume and
+    checksummed, and only when sync() is called."""
+    def __init__(self, logical_volume):
+        self.logical_volume = logical_volume
+        root_block = logical_volume.root_block()
+        if root_block.bitmap_flag() != ROOT_BLOCK_VALID_BITMAP:
+            raise Exception("Volume bitmap is not valid")
+        self.reserved = logical_volume.physical_volume.reserved_blocks()
+        self.num_blocks = logical_volume.physical_volume.num_sectors()
+        self.blocks_per_bitmap_block = (root_block.block_size() - 4) * 8
+        num_bitmap_blocks = -(-(self.num_blocks - self.reserved) // self.blocks_per_bitmap_block)
+        self.bitmap_blocks = root_block.bitmap_blocks(num_bitmap_blocks)
+        if len(self.bitmap_blocks) < num_bitmap_blocks:
+            raise Exception("Volume needs %d bitmap blocks, but only %d are defined" %
+                            (num_bitmap_blocks, len(self.bitmap_blocks)))
+        # indexes of the bitmap blocks that need to be written back
+        self._dirty_bitmap_blocks = set()
+        self._load()
+
+    def _load(self):
+        # the reserved blocks are never free
+        flags = bytearray(self.reserved)
+        for bitmap_block in self.bitmap_blocks:
+            swapped = _swap_longwords(bitmap_block.data()[4:])
+            flags.extend(b''.join(map(_BITMAP_BYTE_TO_FLAGS.__getitem__, swapped)))
+        self.flags = flags
+
+    def _check_blocknum(self, blocknum):
+        if blocknum < self.reserved or blocknum >= self.num_blocks:
+            raise Exception("Block number %d out of range" % blocknum)
+
+    def _set_flag(self, blocknum, value):
+        self.flags[blocknum] = value
+        self._dirty_bitmap_blocks.add((blocknum - self.reserved) // self.blocks_per_bitmap_block)
+
+    def is_free(self, blocknum):
+        self._check_blocknum(blocknum)
+        return self.flags[blocknum] == 1
+
+    def free_blocks(self):
+        return [i for i in range(self.reserved, self.num_blocks) if self.flags[i] == 1]
+
+    def used_blocks(self):
+        return [i for i in range(self.reserved, self.num_blocks) if self.flags[i] == 0]
+
+    def num_free_blocks(self):
+        return self.flags.count(1, self.reserved, self.num_blocks)
+
+    def find_free_run(self, count, near=None):
+        """returns the first block number of count contiguous free blocks.
+        The search starts at the block near and wraps around to the beginning
+        of the volume. Returns None if there is no such run"""
+        if near is None:
+            near = self.reserved
+        near = min(max(near, self.reserved), self.num_blocks)
+        pattern = b'\x01' * count
+        blocknum = self.flags.find(pattern, near, self.num_blocks)
+        if blocknum < 0:
+            blocknum = self.flags.find(pattern, self.reserved, min(near + count - 1, self.num_blocks))
+        return blocknum if blocknum >= 0 else None
+
+    def allocate(self, blocknum=None, near=None):
+        """marks the specified block as used. If no block number is specified,
+        the free block closest after near is used. Returns the block number"""
+        if blocknum is None:
+            blocknum = self.find_free_run(1, near)
+            if blocknum is None:
+                raise Exception("ERROR: can't allocate block - volume is full !!!")
+        elif not self.is_free(blocknum):
+            raise Exception("ERROR: can't allocate block %d - already used !!!" % blocknum)
+        self._set_flag(blocknum, 0)
+        return blocknum
+
+    def allocate_run(self, count, near=None):
+        """allocates count contiguous blocks. Returns the list of block numbers"""
+        start = self.find_free_run(count, near)
+        if start is None:
+            raise Exception("ERROR: can't allocate %d contiguous blocks !!!" % count)
+        for blocknum in range(start, start + count):
+            self._set_flag(blocknum, 0)
+        return list(range(start, start + count))
+
+    def free(self, blocknum):
+        self._check_blocknum(blocknum)
+        self._set_flag(blocknum, 1)
+
+    def replace_flags(self, flags):
+        """replaces the complete bitmap, e.g. with one rebuilt from the blocks in
+        use. All bitmap blocks are written on the next sync()"""
+        if len(flags) != self.num_blocks:
+            raise Exception("Expected %d flags, but got %d" % (self.num_blocks, len(flags)))
+        # the flags past the end of the volume keep their value
+        self.flags[self.reserved:self.num_blocks] = flags[self.reserved:self.num_blocks]
+        self._dirty_bitmap_blocks.update(range(len(self.bitmap_blocks)))
+
+    def sync(self):
+        """writes the modified bitmap blocks back to the volume and updates their
+        checksums"""
+        for index in sorted(self._dirty_bitmap_blocks):
+            bitmap_block = self.bitmap_blocks[index]
+            start = self.reserved + index * self.blocks_per_bitmap_block
+            flags = self.flags[start:start + self.blocks_per_bitmap_block]
+            swapped = bytes(_FLAGS_TO_BITMAP_BYTE[bytes(flags[i:i + 8])]
+                            for i in range(0, len(flags), 8))
+            sector = bitmap_block.sector()
+            sector.write_at(4, _swap_longwords(swapped))
+            sector.set_u32_at(BITMAP_BLOCK_OFFSET_CHECKSUM, bitmap_block.computed_checksum())
+        self._dirty_bitmap_blocks.clear()
+
+
 class DataBlock(HeaderBlock):
     """A logical view on header blocks. Those are the first block of a directory
     or file."""
@@ -465,36 +1062,355 @@ class DataBlock(HeaderBlock):
         super().__init__(logical_volume, blocknum)
 
     def seq_num(self):
-        return self.sector().u32_at(8)
+        return self.sector().u32_at(DATA_BLOCK_OFFSET_SEQ_NUM)
 
     def data_size(self):
-        return self.sector().u32_at(12)
+        return self.sector().u32_at(DATA_BLOCK_OFFSET_DATA_SIZE)
+
+    def init_ofs_data(self, file_header_block, seq_num, data, next_data):
+        """Initialize this block as an OFS data block"""
+        sector = self.sector()
+        sector.clear_data()
+        sector.write_at(OFS_DATABLOCK_HEADER_SIZE, data)
+        sector.set_u32_at(0, BLOCK_TYPE_DATA)
+        sector.set_u32_at(DATA_BLOCK_OFFSET_HEADER_KEY, file_header_block)
+        sector.set_u32_at(DATA_BLOCK_OFFSET_SEQ_NUM, seq_num)
+        sector.set_u32_at(DATA_BLOCK_OFFSET_DATA_SIZE, len(data))
+        sector.set_u32_at(DATA_BLOCK_OFFSET_NEXT_DATA, next_data)
+        self.update_checksum()
 
 
 DATABLOCK_OFFSET = 204
 
+# OFS data blocks start with a header, FFS data blocks only contain data
+OFS_DATABLOCK_HEADER_SIZE = 24
+
+
+class FileReader(io.RawIOBase):
+    """A read-only, seekable file object for a file on a logical volume.
+    The data is read directly from the volume's sectors one block at a time and
+    the data block tables in the extension blocks are only followed when needed"""
+    def __init__(self, logical_volume, header):
+        super().__init__()
+        self.logical_volume = logical_volume
+        self.header = header
+        self.name = header.name()
+        self.size = header.file_size()
+        block_size = header.block_size()
+        fs_type = logical_volume.filesystem_type()
+        if fs_type == 'OFS':
+            self.data_offset = OFS_DATABLOCK_HEADER_SIZE
+        elif fs_type == 'FFS':
+            self.data_offset = 0
+        else:
+            raise Exception("Unsupported file system type: %s" % fs_type)
+        self.bytes_per_block = block_size - self.data_offset
+        self.pointers_per_table = block_size // 4 - 56
+        # the header and the extension blocks found so far and their
+        # decoded data block tables
+        self._table_blocks = [header.blocknum]
+        self._tables = {}
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def num_blocks(self):
+        return -(-self.size // self.bytes_per_block)
+
+    def _table(self, table_index):
+        """returns the data block numbers listed in the header block (table_index 0)
+        or in an extension block"""
+        table = self._tables.get(table_index)
+        if table is None:
+            while len(self._table_blocks) <= table_index:
+                ext_blocknum = self.logical_volume.header_record(self._table_blocks[-1]).extension
+                if ext_blocknum == 0:
+                    raise Exception("File '%s' is missing an extension block" % self.name)
+                self._table_blocks.append(ext_blocknum)
+            blocknum = self._table_blocks[table_index]
+            record = self.logical_volume.header_record(blocknum)
+            num_pointers = min(record.high_seq, self.pointers_per_table)
+            data = self.logical_volume.physical_volume.sector(blocknum).data
+            # the table is stored backwards, starting at the end of the block
+            table = struct.unpack_from(">%dI" % num_pointers, data,
+                                       len(data) - DATABLOCK_OFFSET - (num_pointers - 1) * 4)[::-1]
+            self._tables[table_index] = table
+        return table
+
+    def load_tables(self):
+        """reads all the data block tables of the file, after that the reader does
+        not need to decode any header or extension blocks"""
+        for table_index in range(-(-self.num_blocks() // self.pointers_per_table)):
+            self._table(table_index)
+
+    def data_blocknum(self, index):
+        """returns the block number of the data block with the specified index"""
+        table_index, slot = divmod(index, self.pointers_per_table)
+        return self._table(table_index)[slot]
+
+    def block_data(self, index):
+        """returns the file data in the data block with the specified index
+        as a memoryview into the volume"""
+        length = min(self.bytes_per_block, self.size - index * self.bytes_per_block)
+        sector = self.logical_volume.physical_volume.sector(self.data_blocknum(index))
+        return sector.data[self.data_offset:self.data_offset + length]
+
+    def extents(self, start_index=0):
+        """generates the runs of consecutive data block numbers starting at the data
+        block with index start_index as tuples (index, first block number, count)"""
+        num_blocks = self.num_blocks()
+        index = start_index
+        while index < num_blocks:
+            first_blocknum = self.data_blocknum(index)
+            count = 1
+            while (index + count < num_blocks and
+                   self.data_blocknum(index + count) == first_blocknum + count):
+                count += 1
+            yield index, first_blocknum, count
+            index += count
+
+    def _chunks_at(self, pos):
+        """generates the file data from pos to the end of the file as memoryviews.
+        On FFS, a run of consecutive data blocks contains nothing but file data, so
+        it is returned as a single memoryview. OFS data blocks have headers, so
+        there is a memoryview per block"""
+        if pos >= self.size:
+            return
+        index, block_offset = divmod(pos, self.bytes_per_block)
+        block_size = self.bytes_per_block + self.data_offset
+        for first_index, first_blocknum, count in self.extents(index):
+            if self.data_offset == 0:
+                length = min(count * block_size, self.size - first_index * block_size)
+                start = first_blocknum * block_size
+                chunks = [self.logical_volume.physical_volume.view()[start:start + length]]
+            else:
+                chunks = (self.block_data(i) for i in range(first_index, first_index + count))
+            for chunk in chunks:
+                if block_offset > 0:
+                    chunk = chunk[block_offset:]
+                    block_offset = 0
+                yield chunk
+
+    def chunks(self):
+        """generates the file data from the current position to the end of the
+        file as memoryviews into the volume"""
+        for chunk in self._chunks_at(self._pos):
+            self._pos += len(chunk)
+            yield chunk
+
+    def copy_to(self, outfile):
+        """writes the file data from the current position to outfile, with a
+        single write for each chunk. Returns the number of bytes written"""
+        num_bytes = 0
+        for chunk in self.chunks():
+            outfile.write(chunk)
+            num_bytes += len(chunk)
+        return num_bytes
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        num_read = 0
+        if len(view) == 0:
+            return 0
+        for chunk in self._chunks_at(self._pos):
+            num_bytes = min(len(chunk), len(view) - num_read)
+            view[num_read:num_read + num_bytes] = chunk[0:num_bytes]
+            num_read += num_bytes
+            if num_read == len(view):
+                break
+        self._pos += num_read
+        return num_read
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(self.size - self._pos, 0)
+        result = bytearray(min(size, max(self.size - self._pos, 0)))
+        num_read = self.readinto(result)
+        return bytes(result[0:num_read])
+
+
+def _host_path(host_dir, record):
+    """the host path of an extracted file or directory. The name comes from
+    the image, names that would lead out of host_dir are rejected"""
+    name = record.name
+    if (name in ['', '.', '..'] or '/' in name or os.sep in name or
+            (os.altsep is not None and os.altsep in name) or
+            os.path.isabs(name) or os.path.splitdrive(name)[0] != ''):
+        raise Exception("Invalid file name '%s' in block %d" % (name, record.blocknum))
+    return os.path.join(host_dir, name)
+
+
+def _set_host_metadata(hostpath, record):
+    """applies the modification time and the comment of a header record
+    to a host file or directory"""
+    timestamp = record.last_modification_time().timestamp()
+    os.utime(hostpath, (timestamp, timestamp))
+    if len(record.comment) > 0 and hasattr(os, 'setxattr'):
+        try:
+            os.setxattr(hostpath, XATTR_COMMENT, record.comment.encode('latin-1'))
+        except OSError:
+            # the host file system does not support extended attributes
+            pass
+
+
+class Transaction:
+    """Groups the modifications of a logical volume in a with block. If the
+    block raises an exception, all modified sectors are restored, otherwise
+    the modifications are kept"""
+    def __init__(self, logical_volume):
+        self.logical_volume = logical_volume
+
+    def __enter__(self):
+        self.logical_volume.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.logical_volume.commit()
+        else:
+            self.logical_volume.rollback()
+        return False
+
+
 class LogicalVolume:
 
-    def __init__(self, physical_volume):
+    def __init__(self, physical_volume, header_cache_size=HEADER_CACHE_SIZE):
         self.physical_volume = physical_volume
-
-    def initialize(self, fs_type="FFS", is_international=False, use_dircache=False):
+        self._allocator = None
+        self.header_cache = HeaderCache(self, header_cache_size)
+        physical_volume.add_write_listener(self.header_cache.invalidate)
+        self.path_cache = PathCache()
+
+    def initialize(self, fs_type="FFS", is_international=False, use_dircache=False,
+                   name="Empty"):
+        """formats the volume: writes the boot block, an empty root directory
+        and a bitmap where all other blocks are free"""
         self.boot_block().initialize(fs_type, is_international, use_dircache)
+        root_block = self.root_block()
+        block_size = root_block.block_size()
+        reserved = self.physical_volume.reserved_blocks()
+        num_blocks = self.physical_volume.num_sectors()
+
+        # the bitmap blocks follow the root block, if there are more than fit
+        # into the root block, the extension blocks follow the bitmap blocks
+        words_per_bitmap_block = block_size // 4 - 1
+        blocks_per_bitmap_block = words_per_bitmap_block * 32
+        num_bitmap_blocks = -(-(num_blocks - reserved) // blocks_per_bitmap_block)
+        num_ext_blocks = -(-max(0, num_bitmap_blocks - ROOT_BLOCK_NUM_BITMAP_PAGES) //
+                           words_per_bitmap_block)
+        bitmap_blocks = list(range(root_block.blocknum + 1,
+                                   root_block.blocknum + 1 + num_bitmap_blocks))
+        ext_blocks = list(range(bitmap_blocks[-1] + 1, bitmap_blocks[-1] + 1 + num_ext_blocks))
+
+        for index, blocknum in enumerate(bitmap_blocks):
+            first_block = reserved + index * blocks_per_bitmap_block
+            words = []
+            for i in range(words_per_bitmap_block):
+                num_valid = min(max(num_blocks - (first_block + i * 32), 0), 32)
+                words.append((1 << num_valid) - 1)
+            checksum = -sum(words) & 0xffffffff
+            self.physical_volume.write_at(blocknum * block_size,
+                                          struct.pack(">I%dI" % len(words), checksum, *words))
+        remaining = bitmap_blocks[ROOT_BLOCK_NUM_BITMAP_PAGES:]
+        for i, blocknum in enumerate(ext_blocks):
+            table = remaining[i * words_per_bitmap_block:(i + 1) * words_per_bitmap_block]
+            next_ext = ext_blocks[i + 1] if i + 1 < len(ext_blocks) else 0
+            table += [0] * (words_per_bitmap_block - len(table))
+            self.physical_volume.write_at(blocknum * block_size,
+                                          struct.pack(">%dII" % len(table), *table, next_ext))
+
+        root_block.init_root(name, bitmap_blocks, ext_blocks[0] if len(ext_blocks) > 0 else 0)
+        self.header_cache.clear()
+        self.path_cache.clear()
+        self._allocator = None
+        allocator = self.allocator()
+        for blocknum in [root_block.blocknum] + bitmap_blocks + ext_blocks:
+            allocator.allocate(blocknum)
+        if self.uses_dircache():
+            self._init_dircache(root_block)
+            root_block.update_checksum()
+        allocator.sync()
+
+    def begin(self):
+        """starts a transaction, see PhysicalVolume.begin()"""
+        self.physical_volume.begin()
+
+    def commit(self):
+        if self._allocator is not None:
+            self._allocator.sync()
+        self.physical_volume.commit()
+
+    def rollback(self):
+        """restores the volume to its state at begin(). The caches and the
+        allocator are reset, since they can refer to the undone modifications"""
+        self.physical_volume.rollback()
+        self.header_cache.clear()
+        self.path_cache.clear()
+        self._allocator = None
+
+    def transaction(self):
+        return Transaction(self)
 
     def filesystem_type(self):
         return self.boot_block().filesystem_type()
 
+    def uses_dircache(self):
+        return self.boot_block().uses_dircache()
+
+    def is_international(self):
+        return self.boot_block().is_international()
+
+    def hash_name(self, name):
+        """returns the hash table index of name, using the hash function
+        selected by the boot block flags"""
+        return util.compute_hash(name, self.block_size(), self.is_international())
+
+    def hash_names(self, names):
+        return util.hash_names(names, self.block_size(), self.is_international())
+
+    def block_size(self):
+        return self.physical_volume.block_size
+
     def boot_block(self):
         return BootBlock(self)
 
     def root_block(self):
-        """returns the root block of this logical volume
-
-        TODO: this works for disks, but might not for HDFs, because
-           1. they can have any size
-           2. we should look at the root block number inside the boot block
-        """
-        return RootBlock(self, int(self.physical_volume.num_sectors() / 2))
+        """returns the root block of this logical volume. Like AmigaDOS, we
+        compute its position from the volume geometry: it is in the middle
+        between the reserved blocks and the last block of the volume"""
+        highest_block = self.physical_volume.num_sectors() - 1
+        return RootBlock(self, (self.physical_volume.reserved_blocks() + highest_block) // 2)
+
+    def allocator(self):
+        """returns the block allocator of this volume. It is created on first use"""
+        if self._allocator is None:
+            self._allocator = BlockAllocator(self)
+        return self._allocator
+
+    def header_record(self, sector_num):
+        """returns the decoded fields of the header block at sector_num"""
+        return self.header_cache.get(sector_num)
 
     def header_block_at(self, sector_num):
         return HeaderBlock(self, sector_num)
@@ -503,73 +1419,534 @@ class LogicalVolume:
         return DataBlock(self, sector_num)
 
     def header_for_path(self, path):
-        path = [p for p in path.split("/") if p != '']
+        key = PathCache.key(path, self.is_international())
+        if len(key) == 0:
+            return self.root_block()
+
+        path_cache = self.path_cache
+        if key in path_cache.entries:
+            path_cache.hits += 1
+            blocknum = path_cache.entries[key]
+            if blocknum is None:
+                raise Exception("can't find file/dir '%s'" % path)
+            return self.header_block_at(blocknum)
+
+        # resolve the path starting at the longest cached parent directory
+        path_cache.misses += 1
         cur_header = self.root_block()
-        for pathcomp in path:
-            cur_header = cur_header.find_header(pathcomp)
+        start = 0
+        for i in range(len(key) - 1, 0, -1):
+            blocknum = path_cache.entries.get(key[0:i])
+            if blocknum is not None:
+                cur_header = self.header_block_at(blocknum)
+                start = i
+                break
+        for i in range(start, len(key)):
+            try:
+                cur_header = cur_header.find_header(key[i])
+            except Exception:
+                path_cache.put(key[0:i + 1], None)
+                path_cache.put(key, None)
+                raise Exception("can't find file/dir '%s'" % path)
+            path_cache.put(key[0:i + 1], cur_header.blocknum)
         return cur_header
 
+    def open(self, path):
+        """opens the file at path for reading"""
+        file_header = self.header_for_path(path)
+        if not file_header.is_file():
+            raise Exception("'%s' is not a file" % path)
+        return FileReader(self, file_header)
+
     def file_data(self, path):
         result = bytearray()
-        file_header = self.header_for_path(path)
-        data_blocks = file_header.data_blocks()
-        remain_size = file_header.file_size()
-        # Now concatenate the data from the data blocks. Be aware that OFS
-        # and FFS data blocks have different formats
-        if self.filesystem_type() == 'OFS':
-            for i in data_blocks:
-                data_block = self.data_block_at(i)
-                result.extend(data_block.data()[24:24+data_block.data_size()])
-
-        elif self.filesystem_type() == 'FFS':
-            # data_blocks only contain data, no size
-            for i in data_blocks:
-                data_block = self.data_block_at(i)
-                if remain_size >= data_block.block_size():
-                    result.extend(data_block.data())
-                    remain_size -= data_block.block_size()
-                else:
-                    result.extend(data_block.data()[0:remain_size])
-                    remain_size = 0
-        else:
-            raise Exception("Unsupported file system type: %s" % self.filesystem_type())
+        with self.open(path) as reader:
+            for chunk in reader.chunks():
+                result.extend(chunk)
         return result
 
-    def makedir(self, pathstr):
+    def _split_path(self, pathstr):
+        """splits the path into the parent directory header and the name"""
         path = [p for p in pathstr.split("/") if len(p) > 0]
-
-        # Can't create root directory
         if len(path) == 0:
-            raise Exception("Can't create directory '/'")
+            raise Exception("Path '%s' does not have a name" % pathstr)
+        parent_dir = self.header_for_path('/'.join(path[:-1]))
+        if parent_dir.secondary_type() not in [BLOCK_SEC_TYPE_ROOT, BLOCK_SEC_TYPE_USERDIR]:
+            raise Exception("'%s' is not a directory" % '/'.join(path[:-1]))
+        return parent_dir, path[-1]
+
+    def _check_name(self, name):
+        if len(name) == 0 or len(name) > MAX_NAME_LENGTH:
+            raise Exception("Invalid name length: '%s'" % name)
+        if '/' in name or ':' in name:
+            raise Exception("Invalid character in name: '%s'" % name)
+        try:
+            name.encode('latin-1')
+        except UnicodeEncodeError:
+            raise Exception("Name can't be represented on an Amiga volume: '%s'" % name)
+
+    def _child_exists(self, parent_dir, name):
+        try:
+            parent_dir.find_header(name)
+            return True
+        except Exception:
+            return False
+
+    def blocks_for_file(self, file_size):
+        """returns the number of blocks a file of file_size bytes occupies,
+        including the header and the extension blocks"""
+        block_size = self.block_size()
+        bytes_per_block = block_size
+        if self.filesystem_type() == 'OFS':
+            bytes_per_block -= OFS_DATABLOCK_HEADER_SIZE
+        pointers_per_table = block_size // 4 - 56
+        num_data_blocks = -(-file_size // bytes_per_block)
+        num_ext_blocks = max(0, -(-num_data_blocks // pointers_per_table) - 1)
+        return 1 + num_data_blocks + num_ext_blocks
+
+    def _allocate_blocks(self, count, near):
+        """allocates count blocks, contiguous if possible"""
+        allocator = self.allocator()
+        if allocator.find_free_run(count, near) is not None:
+            return allocator.allocate_run(count, near)
+        if allocator.num_free_blocks() < count:
+            raise Exception("Not enough space on volume: %d blocks needed" % count)
+        result = []
+        for i in range(count):
+            result.append(allocator.allocate(near=near))
+            near = result[-1]
+        return result
 
-        # TODO: Check for valid paths
-        parent_dirpath = '/'.join(path[:-1])
-        parent_dir = self.header_for_path(parent_dirpath)
-        dirname = path[0]
+    def _init_dircache(self, dir_header):
+        """creates the first, empty dircache block of a directory"""
+        blocknum = self.allocator().allocate(near=dir_header.blocknum)
+        DirCacheBlock(self, blocknum).init_dircache(dir_header.blocknum)
+        dir_header.set_extension(blocknum)
+
+    def _dircache_add(self, dir_header, entry):
+        """adds an entry to the last dircache block of a directory, a new block is
+        appended if it does not fit"""
+        blocks = self.dircache_blocks(dir_header)
+        if len(blocks) == 0:
+            return
+        last_block = DirCacheBlock(self, blocks[-1])
+        entries = last_block.entries() + [entry]
+        if last_block.fits(entries):
+            last_block.set_entries(entries)
+        else:
+            blocknum = self.allocator().allocate(near=last_block.blocknum)
+            DirCacheBlock(self, blocknum).init_dircache(dir_header.blocknum, [entry])
+            last_block.set_next_block(blocknum)
+
+    def _dircache_remove(self, dir_header, blocknum):
+        """removes the entry of the header block blocknum from the dircache of a
+        directory. Blocks that become empty are unlinked, except for the first"""
+        prev_block = None
+        for cache_blocknum in self.dircache_blocks(dir_header):
+            cache_block = DirCacheBlock(self, cache_blocknum)
+            entries = cache_block.entries()
+            remaining = [entry for entry in entries if entry.blocknum != blocknum]
+            if len(remaining) < len(entries):
+                if len(remaining) == 0 and prev_block is not None:
+                    prev_block.set_next_block(cache_block.next_block())
+                    self.allocator().free(cache_blocknum)
+                else:
+                    cache_block.set_entries(remaining)
+                return
+            prev_block = cache_block
+
+    def _dircache_update(self, dir_header, entry):
+        """replaces the dircache entry for the same header block as entry"""
+        for cache_blocknum in self.dircache_blocks(dir_header):
+            cache_block = DirCacheBlock(self, cache_blocknum)
+            entries = cache_block.entries()
+            for i, cur_entry in enumerate(entries):
+                if cur_entry.blocknum == entry.blocknum:
+                    entries[i] = entry
+                    if cache_block.fits(entries):
+                        cache_block.set_entries(entries)
+                    else:
+                        self._dircache_remove(dir_header, entry.blocknum)
+                        self._dircache_add(dir_header, entry)
+                    return
+
+    def _create_directory(self, parent_dir, dirname, hash_index=None):
+        """creates a directory in parent_dir. The bitmap and the parent's
+        checksum are not updated, see _commit()"""
+        self._check_name(dirname)
+        if self._child_exists(parent_dir, dirname):
+            raise Exception("'%s' already exists" % dirname)
 
         # 1. reserve a dir header block and initialize it
-        #    this includes updating the bitmap
-        # 2. add the new header to the hash table of the dir block
-        root_block = self.root_block()
-        free_blocks, used_blocks = root_block.block_allocation()
-        dirblock_num = free_blocks[0]
-        root_block.allocate_block(dirblock_num)
+        # 2. hook the block into the parent directory's hashtable
+        dirblock_num = self.allocator().allocate(near=parent_dir.blocknum)
         dirblock = self.header_block_at(dirblock_num)
         dirblock.init_directory(dirname, parent_dir.blocknum)
-
-        # 3. hook the block into the parent directory's hashtable
-        # and make sure the parent is hooked up, too
-        hash_index = util.compute_hash(dirname, dirblock.block_size())
+        if self.uses_dircache():
+            self._init_dircache(dirblock)
+            dirblock.update_checksum()
+        if hash_index is None:
+            hash_index = self.hash_name(dirname)
         parent_dir.append_hashtable_entry_at(hash_index, dirblock_num)
+        self._dircache_add(parent_dir, DirCacheEntry.from_record(dirblock.record()))
+        return dirblock
+
+    def _create_file(self, parent_dir, name, data, modified=None, near=None, hash_index=None):
+        """creates a file in parent_dir and writes its data. The header, data and
+        extension blocks are allocated as one contiguous run if possible.
+        The bitmap and the parent's checksum are not updated, see _commit()"""
+        self._check_name(name)
+        if self._child_exists(parent_dir, name):
+            raise Exception("'%s' already exists" % name)
+        block_size = parent_dir.block_size()
+        is_ofs = self.filesystem_type() == 'OFS'
+        bytes_per_block = block_size - OFS_DATABLOCK_HEADER_SIZE if is_ofs else block_size
+        pointers_per_table = block_size // 4 - 56
+        num_data_blocks = -(-len(data) // bytes_per_block)
+
+        blocks = self._allocate_blocks(self.blocks_for_file(len(data)),
+                                       parent_dir.blocknum if near is None else near)
+        header_num = blocks[0]
+        data_blocks = blocks[1:1 + num_data_blocks]
+        ext_blocks = blocks[1 + num_data_blocks:]
+
+        # 1. write the data blocks
+        if is_ofs:
+            for i, blocknum in enumerate(data_blocks):
+                next_data = data_blocks[i + 1] if i + 1 < len(data_blocks) else 0
+                self.data_block_at(blocknum).init_ofs_data(
+                    header_num, i + 1, data[i * bytes_per_block:(i + 1) * bytes_per_block], next_data)
+        else:
+            # FFS data blocks contain only data, so a run of consecutive blocks
+            # is written at once
+            i = 0
+            while i < len(data_blocks):
+                count = 1
+                while i + count < len(data_blocks) and data_blocks[i + count] == data_blocks[i] + count:
+                    count += 1
+                chunk = data[i * block_size:(i + count) * block_size]
+                padding = bytes(count * block_size - len(chunk))
+                self.physical_volume.write_at(data_blocks[i] * block_size, bytes(chunk) + padding)
+                i += count
+
+        # 2. write the extension blocks, each one holds the next part of the table
+        for i, blocknum in enumerate(ext_blocks):
+            table = data_blocks[(i + 1) * pointers_per_table:(i + 2) * pointers_per_table]
+            next_ext = ext_blocks[i + 1] if i + 1 < len(ext_blocks) else 0
+            self.header_block_at(blocknum).init_extension(header_num, table, next_ext)
+
+        # 3. write the header and hook it into the parent directory's hashtable
+        header = self.header_block_at(header_num)
+        header.init_file(name, parent_dir.blocknum, len(data), data_blocks[0:pointers_per_table],
+                         ext_blocks[0] if len(ext_blocks) > 0 else 0, modified)
+        if hash_index is None:
+            hash_index = self.hash_name(name)
+        parent_dir.append_hashtable_entry_at(hash_index, header_num)
+        self._dircache_add(parent_dir, DirCacheEntry.from_record(header.record()))
+        return header
 
-        # 4. update last modified time to file system
-        # 5. if root was parent directory, update the time, too
-        # 6. update the checksums for parent and root block
-        parent_dir.update_last_modification_time()
+    def _commit(self, modified_dirs):
+        """final step of a modification: write back the bitmap, update the
+        modification time and checksum of the modified directories and the disk"""
+        root_block = self.root_block()
+        for dir_header in modified_dirs:
+            dir_header.update_last_modification_time()
+            dir_header.update_checksum()
+            if dir_header.blocknum != root_block.blocknum:
+                self._dircache_update(self.header_block_at(dir_header.parent()),
+                                      DirCacheEntry.from_record(dir_header.record()))
+        self.allocator().sync()
         root_block.update_last_disk_modification_time()
-        parent_dir.update_checksum()
         root_block.update_checksum()
 
+    def makedir(self, pathstr):
+        path = [p for p in pathstr.split("/") if len(p) > 0]
+
+        # Can't create root directory
+        if len(path) == 0:
+            raise Exception("Can't create directory '/'")
+
+        parent_dir, dirname = self._split_path(pathstr)
+        dirblock = self._create_directory(parent_dir, dirname)
+        self.path_cache.invalidate(PathCache.key(pathstr, self.is_international()))
+        self._commit([parent_dir])
+        return dirblock
+
+    def write_file(self, pathstr, data, modified=None):
+        """creates the file at pathstr with the specified data. An existing file
+        is replaced"""
+        parent_dir, name = self._split_path(pathstr)
+        if self._child_exists(parent_dir, name):
+            if not parent_dir.find_header(name).is_file():
+                raise Exception("'%s' exists and is not a file" % pathstr)
+            self.delete(pathstr)
+        header = self._create_file(parent_dir, name, data, modified)
+        self.path_cache.invalidate(PathCache.key(pathstr, self.is_international()))
+        self._commit([parent_dir])
+        return header
+
+    def import_tree(self, host_dir, amiga_dir="/"):
+        """copies the directory tree host_dir into the directory amiga_dir.
+        Existing directories are merged, but an existing entry with the name of
+        a file is an error. Name collisions and the space for the whole tree are
+        checked before anything is written, files are laid out one after another
+        in contiguous runs, and the bitmap and the checksums of the modified
+        directories are only written once at the end.
+        Returns the number of files and directories created"""
+        parent_dir = self.header_for_path(amiga_dir)
+        if parent_dir.secondary_type() not in [BLOCK_SEC_TYPE_ROOT, BLOCK_SEC_TYPE_USERDIR]:
+            raise Exception("'%s' is not a directory" % amiga_dir)
+
+        # 1. plan: collect the tree and the number of blocks it needs
+        plan = []
+        blocks_needed = 0
+        dircache_records_size = parent_dir.block_size() - DIRCACHE_BLOCK_OFFSET_RECORDS
+        # the existing directories the host directories are merged into
+        existing_dirs = {'.': parent_dir}
+        for dirpath, dirnames, filenames in os.walk(host_dir):
+            dirnames.sort()
+            reldir = os.path.relpath(dirpath, host_dir)
+            existing_dir = existing_dirs.get(reldir)
+            # host names that only differ in case are the same name on the volume
+            planned_names = set()
+            for name in dirnames + filenames:
+                key = util.upper_name(name, self.is_international())
+                if key in planned_names:
+                    raise Exception("'%s' collides with another name in the same directory" %
+                                    self._import_path(amiga_dir, os.path.join(reldir, name)))
+                planned_names.add(key)
+            for dirname in dirnames:
+                self._check_name(dirname)
+                relpath = os.path.normpath(os.path.join(reldir, dirname))
+                plan.append((relpath, True))
+                if existing_dir is not None and self._child_exists(existing_dir, dirname):
+                    header = existing_dir.find_header(dirname)
+                    if not header.is_directory():
+                        raise Exception("'%s' exists and is not a directory" %
+                                        self._import_path(amiga_dir, relpath))
+                    existing_dirs[relpath] = header
+                else:
+                    blocks_needed += 2 if self.uses_dircache() else 1
+            for filename in sorted(filenames):
+                self._check_name(filename)
+                relpath = os.path.normpath(os.path.join(reldir, filename))
+                if existing_dir is not None and self._child_exists(existing_dir, filename):
+                    raise Exception("'%s' already exists" % self._import_path(amiga_dir, relpath))
+                plan.append((relpath, False))
+                blocks_needed += self.blocks_for_file(os.path.getsize(os.path.join(dirpath, filename)))
+            if self.uses_dircache():
+                # the records of the new entries can need additional dircache blocks
+                records = [DirCacheEntry(0, 0, 0, 0, 0, 0, 0, name, '')
+                           for name in dirnames + filenames]
+                blocks_needed += -(-sum(record.size_in_block() for record in records) //
+                                   dircache_records_size)
+        if blocks_needed > self.allocator().num_free_blocks():
+            raise Exception("Not enough space on volume: %d blocks needed, %d free" %
+                            (blocks_needed, self.allocator().num_free_blocks()))
+
+        # 2. create the directories and files
+        dirs = {'.': parent_dir}
+        modified_dirs = {parent_dir.blocknum: parent_dir}
+        near = parent_dir.blocknum
+        hashes = self.hash_names([os.path.basename(relpath) for relpath, is_dir in plan])
+        for (relpath, is_dir), hash_index in zip(plan, hashes):
+            parent = dirs[os.path.dirname(relpath) or '.']
+            name = os.path.basename(relpath)
+            if is_dir:
+                if self._child_exists(parent, name) and parent.find_header(name).is_directory():
+                    dirs[relpath] = parent.find_header(name)
+                else:
+                    dirs[relpath] = self._create_directory(parent, name, hash_index)
+            else:
+                hostpath = os.path.join(host_dir, relpath)
+                with open(hostpath, "rb") as infile:
+                    data = infile.read()
+                modified = datetime.fromtimestamp(os.path.getmtime(hostpath))
+                header = self._create_file(parent, name, data, modified, near=near,
+                                           hash_index=hash_index)
+                near = header.blocknum + self.blocks_for_file(len(data))
+            modified_dirs[parent.blocknum] = parent
+
+        # 3. commit once
+        self.path_cache.clear()
+        self._commit(modified_dirs.values())
+        return len(plan)
+
+    def _import_path(self, amiga_dir, relpath):
+        """the AmigaDOS path of an entry of a host tree imported into amiga_dir"""
+        return "/".join(p for p in amiga_dir.split("/") + relpath.split(os.sep) if p != '')
+
+    def _child_records(self, dir_record):
+        """generates the header records of the entries in a directory, following
+        the hash chains"""
+        for blocknum in dir_record.hashtable:
+            while blocknum != 0:
+                record = self.header_record(blocknum)
+                yield record
+                blocknum = record.next_hash
+
+    def dircache_blocks(self, dir_header):
+        """returns the block numbers of the dircache blocks of a directory"""
+        result = []
+        blocknum = dir_header.record().extension if self.uses_dircache() else 0
+        while blocknum != 0 and blocknum not in result:
+            result.append(blocknum)
+            blocknum = DirCacheBlock(self, blocknum).next_block()
+        return result
+
+    def directory_entries(self, dir_header):
+        """returns the entries of a directory as DirCacheEntry objects. On DCFS
+        volumes they are read from the dircache blocks, otherwise from the
+        header blocks of the entries"""
+        blocks = self.dircache_blocks(dir_header)
+        if len(blocks) > 0:
+            return [entry for blocknum in blocks for entry in DirCacheBlock(self, blocknum).entries()]
+        return [DirCacheEntry.from_record(record) for record in self._child_records(dir_header.record())]
+
+    def _directory_records(self, dir_header):
+        """generates the dircache entries or the header records of a directory"""
+        record = dir_header.record()
+        blocknum = record.extension if self.uses_dircache() else 0
+        if blocknum == 0:
+            yield from self._child_records(record)
+            return
+        visited = set()
+        while blocknum != 0 and blocknum not in visited:
+            visited.add(blocknum)
+            cache_block = DirCacheBlock(self, blocknum)
+            yield from cache_block.entries()
+            blocknum = cache_block.next_block()
+
+    def _directory_header(self, path):
+        dir_header = self.header_for_path(path)
+        if dir_header.secondary_type() not in [BLOCK_SEC_TYPE_ROOT, BLOCK_SEC_TYPE_USERDIR]:
+            raise Exception("'%s' is not a directory" % path)
+        return dir_header
+
+    def scandir(self, path="/"):
+        """returns an iterator over the entries of the directory at path as
+        DirEntry objects. Entries that share a hash table slot are found by
+        following the hash chains"""
+        dir_header = self._directory_header(path)
+        dirpath = path.strip("/")
+        return (DirEntry(self, dirpath, record) for record in self._directory_records(dir_header))
+
+    def walk(self, path="/"):
+        """returns an iterator over the DirEntry objects of all the files and
+        directories below path, directories before their entries. Only the
+        directories that still have to be visited are kept in memory"""
+        pending = [(path.strip("/"), self._directory_header(path))]
+        return self._walk(pending)
+
+    def find(self, query, path="/"):
+        """returns an iterator over the DirEntry objects of the files and
+        directories below path that match the FindQuery. The tree is walked in
+        a single pass, directories that can't contain matches are not read"""
+        pending = [(path.strip("/"), self._directory_header(path), 0)]
+        return self._find(query, pending)
+
+    def _find(self, query, pending):
+        international = self.is_international()
+        while len(pending) > 0:
+            dirpath, dir_header, depth = pending.pop()
+            for record in self._directory_records(dir_header):
+                entry = DirEntry(self, dirpath, record)
+                if query.matches(depth, entry.name, entry.secondary_type, entry.size,
+                                 (entry.days, entry.minutes, entry.ticks), international):
+                    yield entry
+                if entry.is_dir() and query.descend(depth, entry.name, international):
+                    pending.append((entry.path, self.header_block_at(entry.blocknum), depth + 1))
+
+    def _walk(self, pending):
+        while len(pending) > 0:
+            dirpath, dir_header = pending.pop()
+            for record in self._directory_records(dir_header):
+                entry = DirEntry(self, dirpath, record)
+                yield entry
+                if entry.is_dir():
+                    pending.append((entry.path, self.header_block_at(entry.blocknum)))
+
+    def iter_tree(self, path="/"):
+        """generates the paths and the header records of all the files and
+        directories below path, parents before their children"""
+        pending = [(path.strip("/"), self.header_for_path(path).record())]
+        while len(pending) > 0:
+            dirpath, dir_record = pending.pop()
+            for record in self._child_records(dir_record):
+                childpath = record.name if dirpath == '' else dirpath + "/" + record.name
+                yield childpath, record
+                if record.secondary_type == BLOCK_SEC_TYPE_USERDIR:
+                    pending.append((childpath, record))
+
+    def extract_tree(self, amiga_path, host_dir, max_workers=None):
+        """copies the file or directory tree at amiga_path into the host
+        directory host_dir. The tree is walked once and the data block tables are
+        decoded while walking, the file data is then written from a pool of threads
+        which read directly from the volume's sectors.
+        Modification times are preserved and comments are stored as the extended
+        attribute XATTR_COMMENT where the host supports it.
+        Returns the number of files and directories extracted"""
+        top = self.header_for_path(amiga_path).record()
+        if top.secondary_type == BLOCK_SEC_TYPE_ROOT:
+            top_dir = host_dir
+        else:
+            top_dir = _host_path(host_dir, top)
+
+        # 1. walk the tree, create the directories and collect the files
+        dirs = []
+        files = []
+        pending = [(top, top_dir)]
+        while len(pending) > 0:
+            record, hostpath = pending.pop()
+            if record.secondary_type == BLOCK_SEC_TYPE_FILE:
+                reader = FileReader(self, self.header_block_at(record.blocknum))
+                reader.load_tables()
+                files.append((record, hostpath, reader))
+            elif record.secondary_type in [BLOCK_SEC_TYPE_ROOT, BLOCK_SEC_TYPE_USERDIR]:
+                os.makedirs(hostpath, exist_ok=True)
+                dirs.append((record, hostpath))
+                for child in self._child_records(record):
+                    pending.append((child, _host_path(hostpath, child)))
+
+        # 2. write the files
+        def extract_file(record, hostpath, reader):
+            with open(hostpath, "wb") as outfile:
+                reader.copy_to(outfile)
+            _set_host_metadata(hostpath, record)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(extract_file, *entry) for entry in files]
+            for future in futures:
+                future.result()
+
+        # 3. directory times last, the files written above modified them.
+        # The root block's date is the disk's, so we don't use it
+        for record, hostpath in reversed(dirs):
+            if record.secondary_type != BLOCK_SEC_TYPE_ROOT:
+                _set_host_metadata(hostpath, record)
+        return len(dirs) + len(files)
+
+    def tree_blocks(self, record):
+        """returns the numbers of all the blocks that belong to a file or a
+        directory tree, in post-order: the data and extension blocks of a file
+        before its header, the children of a directory before the directory"""
+        result = []
+        pending = [(record, False)]
+        while len(pending) > 0:
+            record, expanded = pending.pop()
+            if record.secondary_type == BLOCK_SEC_TYPE_USERDIR and not expanded:
+                pending.append((record, True))
+                pending.extend((child, False) for child in self._child_records(record))
+                continue
+            if record.secondary_type == BLOCK_SEC_TYPE_USERDIR:
+                result.extend(self.dircache_blocks(self.header_block_at(record.blocknum)))
+            if record.secondary_type == BLOCK_SEC_TYPE_FILE:
+                header = self.header_block_at(record.blocknum)
+                result.extend(header.iter_data_blocks())
+                result.extend(header.extension_blocks())
+            result.append(record.blocknum)
+        return result
+
     def delete(self, pathstr, recursive=False):
         path = [p for p in pathstr.split("/") if len(p) > 0]
 
@@ -581,42 +1958,30 @@ class LogicalVolume:
         targetpath = '/'.join(path)
         target_header = self.header_for_path(targetpath)
         root_block = self.root_block()
+        allocator = self.allocator()
         parent = self.header_block_at(target_header.parent())
 
         if target_header.is_file():
-            # 1. Delete file
-            # a. delete header from parent's hash table
-            parent.delete_child_from_hashtable(target_header)
-
-            # b. free all the bitmap bits the file occupies. This includes the header
-            # block and all the data blocks
-            # TODO: for some reason, the blocks don't seem to be all freed actually
-            for data_block in target_header.data_blocks():
-                root_block.free_block(data_block)
-            root_block.free_block(target_header.header_key())
-
+            # 1. Delete file: the header, extension and data blocks
+            blocks = self.tree_blocks(target_header.record())
         elif target_header.is_directory():
             # 2. Delete directory
-            if target_header.is_empty():
-                # Unlink from parent and delete from bitmap
-                parent.delete_child_from_hashtable(target_header)
-                root_block.free_block(target_header.header_key())
-            elif not recursive:
+            if not target_header.is_empty() and not recursive:
                 # throw exception, because we don't delete recursive
                 raise Exception("Directory '%s' is not empty - can't delete" % pathstr)
-            else:
-                # TODO:
-                #   a. Recursively delete all the children
-                #   b. Delete this directory by deleting the header and freeing the bitmap bits
-                # Pseudo code
-                # for each child
-                #   delete child
-                # delete this node
-                raise Exception("TODO: deleting directories not implemented yet")
+            blocks = self.tree_blocks(target_header.record())
         else:
             raise Exception("TODO: deleting secondary type %d not implemented yet" %
                             target_header.secondary_type())
 
-        # final step: mark parent and disk as modified
-        parent.mark_as_modified()
-        root_block.mark_disk_as_modified()
+        # only the top of the tree needs to be unlinked, the hash tables
+        # below it are deleted with it. The freed blocks are only marked in
+        # the allocator, which writes each affected bitmap block once in sync()
+        parent.delete_child_from_hashtable(target_header)
+        self._dircache_remove(parent, target_header.blocknum)
+        for blocknum in blocks:
+            allocator.free(blocknum)
+
+        # final step: write back the bitmap, mark parent and disk as modified
+        self.path_cache.invalidate(PathCache.key(targetpath, self.is_international()))
+        self._commit([parent])
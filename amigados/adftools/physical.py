@@ -1,11 +1,24 @@
 """physical.py - Physical aspects of an Amiga Volume"""
+import io
+import mmap
+import os
 import struct
+import weakref
+import zlib
 
 class Sector:
     """Sector is a partial view on a physical volume"""
-    def __init__(self, data, offset):
+    def __init__(self, data, offset, volume=None):
         self.data = data  # array of bytes
         self.offset = offset
+        # the volume is notified about modifications to this sector
+        self.volume = volume
+
+    def _mark_dirty(self):
+        """has to be called before the sector is modified, so the volume can
+        save its previous contents"""
+        if self.volume is not None:
+            self.volume.mark_dirty(self.offset)
 
     def __getitem__(self, bytenum):
         return self.data[bytenum]
@@ -14,6 +27,7 @@ class Sector:
         return len(self.data)
 
     def __setitem__(self, bytenum, value):
+        self._mark_dirty()
         self.data[bytenum] = value
 
     def u16_at(self, bytenum):
@@ -26,17 +40,26 @@ class Sector:
         return struct.unpack(">i", self.data[bytenum:bytenum + 4])[0]
 
     def set_u32_at(self, bytenum, value):
-        struct.pack_into(">I", self.data.obj, self.offset + bytenum, value)
+        self._mark_dirty()
+        struct.pack_into(">I", self.data, bytenum, value)
+
+    def write_at(self, bytenum, data):
+        self._mark_dirty()
+        self.data[bytenum:bytenum + len(data)] = data
 
     def clear_data(self):
-        for i in range(self.size_in_bytes()):
-            self.data[i] = 0
+        self._mark_dirty()
+        self.data[:] = bytes(self.size_in_bytes())
 
 
 FLOPPY_CYLINDERS_PER_DISK = 80
 FLOPPY_BYTES_PER_SECTOR = 512
 FLOPPY_TRACKS_PER_CYLINDER = 2
 
+# the block sizes supported by the file system
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 32768
+
 # Double Density Disk numbers
 DDD_SECTORS_PER_TRACK = 11
 DDD_SECTORS_TOTAL = FLOPPY_CYLINDERS_PER_DISK * FLOPPY_TRACKS_PER_CYLINDER * DDD_SECTORS_PER_TRACK
@@ -47,16 +70,158 @@ HDD_SECTORS_PER_TRACK = 22
 HDD_SECTORS_TOTAL = FLOPPY_CYLINDERS_PER_DISK * FLOPPY_TRACKS_PER_CYLINDER * HDD_SECTORS_PER_TRACK
 HDD_IMAGE_SIZE = FLOPPY_BYTES_PER_SECTOR * HDD_SECTORS_TOTAL
 
-class FloppyDisk:
-    def __init__(self):
-        self.data = None
+# number of blocks reserved for the boot block on a DOS volume
+DEFAULT_RESERVED_BLOCKS = 2
+
+# Rigid Disk Block
+RDB_ID_RIGID_DISK = b'RDSK'
+RDB_ID_PARTITION = b'PART'
+RDB_SCAN_BLOCKS = 16
+RDB_END_OF_LIST = 0xffffffff
+
+RDB_OFFSET_SUMMED_LONGS = 4
+RDB_OFFSET_BLOCK_BYTES = 16
+RDB_OFFSET_PARTITION_LIST = 28
+RDB_OFFSET_CYLINDERS = 64
+RDB_OFFSET_SECTORS = 68
+RDB_OFFSET_HEADS = 72
+
+PART_OFFSET_NEXT = 16
+PART_OFFSET_FLAGS = 20
+PART_OFFSET_DRIVE_NAME = 36
+PART_OFFSET_ENVIRONMENT = 128
+
+# long word indexes into the DosEnvec of a partition block
+DOSENVEC_SIZE_BLOCK = 1
+DOSENVEC_SURFACES = 3
+DOSENVEC_SECTORS_PER_BLOCK = 4
+DOSENVEC_BLOCKS_PER_TRACK = 5
+DOSENVEC_RESERVED = 6
+DOSENVEC_LOW_CYL = 9
+DOSENVEC_HIGH_CYL = 10
+DOSENVEC_BOOT_PRI = 15
+DOSENVEC_DOS_TYPE = 16
+
+PART_FLAG_BOOTABLE = 1
+PART_FLAG_NO_MOUNT = 2
+
+# the journal is written next to the image file
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_MAGIC = b'ADFJRNL1'
+JOURNAL_END = b'JRNLEND1'
+
+def _check_block_size(block_size):
+    if (block_size < MIN_BLOCK_SIZE or block_size > MAX_BLOCK_SIZE or
+            (block_size & (block_size - 1)) != 0):
+        raise Exception("Unsupported block size %d" % block_size)
+
+
+class PhysicalVolume:
+    """Base class for physical volumes. The volume data is either a bytearray
+    or a memory mapped image file, sectors are handed out as views into it.
+    A sector is a file system block of block_size bytes"""
+    def __init__(self, data=None, block_size=FLOPPY_BYTES_PER_SECTOR):
+        _check_block_size(block_size)
+        self.data = data
+        self.block_size = block_size
+        self._view = None
+        self._view_source = None
+        # numbers of the sectors that were modified since the last write
+        self.dirty = set()
+        # references to the functions that are called with the sector number
+        # on modifications, see add_write_listener()
+        self.write_listeners = []
+        # the previous contents of the sectors modified in the current
+        # transaction, None if there is no transaction
+        self._undo = None
+        self._undo_dirty = None
 
     def __getitem__(self, bytenum):
         return self.data[bytenum]
 
     def __setitem__(self, bytenum, value):
+        self.mark_dirty(bytenum)
         self.data[bytenum] = value
 
+    def add_write_listener(self, listener):
+        """listener is called with the sector number on modifications. Bound
+        methods are only weakly referenced, so the volume doesn't keep the
+        objects listening to it alive"""
+        if hasattr(listener, '__self__'):
+            self.write_listeners.append(weakref.WeakMethod(listener))
+        else:
+            self.write_listeners.append(lambda: listener)
+
+    def _notify_write(self, sector_num):
+        collected = False
+        for listener_ref in self.write_listeners:
+            listener = listener_ref()
+            if listener is None:
+                collected = True
+            else:
+                listener(sector_num)
+        if collected:
+            self.write_listeners = [listener_ref for listener_ref in self.write_listeners
+                                    if listener_ref() is not None]
+
+    def mark_dirty(self, bytenum):
+        """marks the sector containing the specified byte as modified. This has
+        to be called before the modification"""
+        sector_num = bytenum // self.block_size
+        if self._undo is not None and sector_num not in self._undo:
+            start = sector_num * self.block_size
+            self._undo[sector_num] = bytes(self.view()[start:start + self.block_size])
+        self.dirty.add(sector_num)
+        self._notify_write(sector_num)
+
+    def in_transaction(self):
+        return self._undo is not None
+
+    def begin(self):
+        """starts a transaction: the previous contents of all sectors modified
+        from now on are kept until commit() or rollback()"""
+        if self._undo is not None:
+            raise Exception("A transaction is already in progress")
+        self._undo = {}
+        self._undo_dirty = set(self.dirty)
+
+    def commit(self):
+        """ends the transaction and keeps the modifications"""
+        if self._undo is None:
+            raise Exception("No transaction in progress")
+        self._undo = None
+        self._undo_dirty = None
+
+    def rollback(self):
+        """ends the transaction and restores the sectors modified in it.
+        Returns the numbers of the restored sectors"""
+        if self._undo is None:
+            raise Exception("No transaction in progress")
+        undo = self._undo
+        self._undo = None
+        view = self.view()
+        for sector_num, data in undo.items():
+            start = sector_num * self.block_size
+            view[start:start + self.block_size] = data
+            self._notify_write(sector_num)
+        self.dirty = self._undo_dirty
+        self._undo_dirty = None
+        return list(undo)
+
+    def dirty_sectors(self):
+        return sorted(self.dirty)
+
+    def write_at(self, bytenum, data):
+        """copies data into the volume starting at bytenum and marks the
+        affected sectors as modified"""
+        if len(data) == 0:
+            return
+        first_sector = bytenum // self.block_size
+        last_sector = (bytenum + len(data) - 1) // self.block_size
+        for sector_num in range(first_sector, last_sector + 1):
+            self.mark_dirty(sector_num * self.block_size)
+        self.view()[bytenum:bytenum + len(data)] = data
+
     def i32_at(self, bytenum):
         """returns signed 32 bit integer value"""
         return struct.unpack(">i", self.data[bytenum:bytenum + 4])[0]
@@ -65,42 +230,412 @@ class FloppyDisk:
         """returns signed 32 bit integer value"""
         return struct.unpack(">I", self.data[bytenum:bytenum + 4])[0]
 
+    def view(self):
+        """a memoryview on the complete volume data"""
+        # the data can be replaced after construction, so we make sure the
+        # cached view still refers to it
+        if self._view is None or self._view_source is not self.data:
+            self._view = memoryview(self.data)
+            self._view_source = self.data
+        return self._view
+
     def sector(self, sector_num):
-        idx = sector_num * FLOPPY_BYTES_PER_SECTOR
+        idx = sector_num * self.block_size
         # slicing the bytearray creates an independent copy, but we want a
-        # Sector be a view that writes to the underlying array, so we create
-        # memoryview, and slice it to achive the dessired effect
-        return Sector(memoryview(self.data)[idx:idx + FLOPPY_BYTES_PER_SECTOR], idx)
+        # Sector be a view that writes to the underlying array, so we
+        # slice a memoryview to achieve the desired effect. For memory mapped
+        # images this means only the pages of the sector are ever touched
+        return Sector(self.view()[idx:idx + self.block_size], idx, self)
+
+    def num_sectors(self):
+        return len(self.data) // self.block_size
+
+    def reserved_blocks(self):
+        """number of blocks at the start of the volume reserved for the boot block"""
+        return DEFAULT_RESERVED_BLOCKS
 
-    def write_image(file):
+    def dirty_ranges(self):
+        """returns the modified sectors as a list of (start, end) byte ranges.
+        Adjacent sectors are merged into a single range"""
+        result = []
+        for sector_num in self.dirty_sectors():
+            start = sector_num * self.block_size
+            end = start + self.block_size
+            if len(result) > 0 and result[-1][1] == start:
+                result[-1] = (result[-1][0], end)
+            else:
+                result.append((start, end))
+        return result
+
+    def write_image(self, file, fsync=False):
+        """writes the complete volume to the file"""
         file.write(self.data)
+        self.dirty.clear()
+        if fsync:
+            _fsync(file)
+
+    def write_dirty(self, file, fsync=False):
+        """writes only the modified sectors back to the image file, which is
+        expected to be opened in "r+b" mode. Returns the number of bytes written"""
+        num_bytes = 0
+        view = self.view()
+        for start, end in self.dirty_ranges():
+            _write_at(file, view[start:end], start)
+            num_bytes += end - start
+        self.dirty.clear()
+        if fsync:
+            _fsync(file)
+        return num_bytes
+
+    def write_dirty_atomic(self, path, fsync=True):
+        """writes the modified sectors back to the image file at path. They are
+        written to a journal file first, if the update of the image is
+        interrupted, recover_journal() completes it. Without fsync, this only
+        protects against the process being interrupted, not against a system crash.
+        Returns the number of bytes written"""
+        ranges = self.dirty_ranges()
+        if len(ranges) == 0:
+            return 0
+        view = self.view()
+        journal_path = path + JOURNAL_SUFFIX
+        with open(journal_path, "wb") as journal:
+            header = JOURNAL_MAGIC + struct.pack(">I", len(ranges))
+            journal.write(header)
+            crc = zlib.crc32(header)
+            for start, end in ranges:
+                entry = struct.pack(">QI", start, end - start)
+                journal.write(entry)
+                journal.write(view[start:end])
+                crc = zlib.crc32(view[start:end], zlib.crc32(entry, crc))
+            journal.write(struct.pack(">I", crc) + JOURNAL_END)
+            if fsync:
+                _fsync(journal)
+        with open(path, "r+b") as outfile:
+            num_bytes = self.write_dirty(outfile, fsync=fsync)
+        os.remove(journal_path)
+        return num_bytes
+
+
+class FloppyDisk(PhysicalVolume):
+    def __init__(self, data=None):
+        super().__init__(data)
 
 
 class DoubleDensityDisk(FloppyDisk):
-    def __init__(self):
-        self.data = bytearray(DDD_IMAGE_SIZE)
+    def __init__(self, data=None):
+        super().__init__(data if data is not None else bytearray(DDD_IMAGE_SIZE))
 
     def num_sectors(self):
         return DDD_SECTORS_TOTAL
 
 
 class HighDensityDisk(FloppyDisk):
-    def __init__(self):
-        self.data = bytearray(HDD_IMAGE_SIZE)
+    def __init__(self, data=None):
+        super().__init__(data if data is not None else bytearray(HDD_IMAGE_SIZE))
 
     def num_sectors(self):
         return HDD_SECTORS_TOTAL
 
-def read_adf_image(file):
-    filedata = bytearray()
-    data = file.read()
-    filedata.extend(data)
+
+class HardDisk(PhysicalVolume):
+    """A hard disk image (HDF) of arbitrary size. The block size of an
+    image without a Rigid Disk Block can be specified, partitions read it from
+    their DosEnvec"""
+    def __init__(self, data, block_size=FLOPPY_BYTES_PER_SECTOR):
+        super().__init__(data, block_size)
+
+
+class PartitionVolume(PhysicalVolume):
+    """A partition of a hard disk. The data is a view into the disk's data, so
+    opening a partition does not touch the data of the other partitions.
+    Modifications are recorded in the disk, so they are written back with
+    the disk's write_dirty(). The partition's blocks can be larger than the
+    disk's sectors, then each block covers several of them"""
+    def __init__(self, disk, partition):
+        self.disk = disk
+        self.partition = partition
+        self.offset = partition.start_offset()
+        end = self.offset + partition.size_in_bytes()
+        if end > len(disk.data):
+            raise Exception("Partition '%s' exceeds the disk size" % partition.name)
+        if self.offset % disk.block_size != 0 or partition.block_size % disk.block_size != 0:
+            raise Exception("Partition '%s' is not aligned to the disk sectors" % partition.name)
+        super().__init__(disk.view()[self.offset:end], partition.block_size)
+
+    def mark_dirty(self, bytenum):
+        blocknum = bytenum // self.block_size
+        start = self.offset + blocknum * self.block_size
+        for disk_bytenum in range(start, start + self.block_size, self.disk.block_size):
+            self.disk.mark_dirty(disk_bytenum)
+        self._notify_write(blocknum)
+
+    def in_transaction(self):
+        return self.disk.in_transaction()
+
+    def begin(self):
+        self.disk.begin()
+
+    def commit(self):
+        self.disk.commit()
+
+    def _blocks_of(self, disk_sectors):
+        """maps disk sector numbers to the numbers of the partition's blocks"""
+        sectors_per_block = self.block_size // self.disk.block_size
+        first = self.offset // self.disk.block_size
+        end = first + self.num_sectors() * sectors_per_block
+        return sorted(set((sector_num - first) // sectors_per_block
+                          for sector_num in disk_sectors if first <= sector_num < end))
+
+    def rollback(self):
+        restored = self._blocks_of(self.disk.rollback())
+        for sector_num in restored:
+            self._notify_write(sector_num)
+        return restored
+
+    def dirty_sectors(self):
+        return self._blocks_of(self.disk.dirty_sectors())
+
+    def reserved_blocks(self):
+        return self.partition.reserved
+
+    def write_dirty(self, file, fsync=False):
+        return self.disk.write_dirty(file, fsync)
+
+    def write_dirty_atomic(self, path, fsync=True):
+        return self.disk.write_dirty_atomic(path, fsync)
+
+
+def _is_valid_rdb_block(sector, block_id):
+    """checks the id and the checksum, which is defined such that the sum over
+    the summed long words is 0"""
+    if bytes(sector.data[0:4]) != block_id:
+        return False
+    num_longs = sector.u32_at(RDB_OFFSET_SUMMED_LONGS)
+    if num_longs < 3 or num_longs * 4 > sector.size_in_bytes():
+        return False
+    longs = struct.unpack(">%dI" % num_longs, sector.data[0:num_longs * 4])
+    return sum(longs) & 0xffffffff == 0
+
+
+class Partition:
+    """A partition as defined by a partition (PART) block in the Rigid Disk Block"""
+    def __init__(self, sector):
+        name_len = sector[PART_OFFSET_DRIVE_NAME]
+        self.name = bytes(sector.data[PART_OFFSET_DRIVE_NAME + 1:
+                                      PART_OFFSET_DRIVE_NAME + 1 + name_len]).decode('latin-1')
+        self.flags = sector.u32_at(PART_OFFSET_FLAGS)
+        env = [sector.u32_at(PART_OFFSET_ENVIRONMENT + i * 4) for i in range(DOSENVEC_DOS_TYPE + 1)]
+        # the geometry is given in sectors, a file system block can consist
+        # of several sectors
+        self.sector_size = env[DOSENVEC_SIZE_BLOCK] * 4
+        self.block_size = self.sector_size * max(env[DOSENVEC_SECTORS_PER_BLOCK], 1)
+        self.surfaces = env[DOSENVEC_SURFACES]
+        self.blocks_per_track = env[DOSENVEC_BLOCKS_PER_TRACK]
+        self.reserved = env[DOSENVEC_RESERVED]
+        self.low_cyl = env[DOSENVEC_LOW_CYL]
+        self.high_cyl = env[DOSENVEC_HIGH_CYL]
+        self.boot_pri = struct.unpack(">i", struct.pack(">I", env[DOSENVEC_BOOT_PRI]))[0]
+        self.dos_type = env[DOSENVEC_DOS_TYPE]
+
+    def blocks_per_cylinder(self):
+        return self.surfaces * self.blocks_per_track
+
+    def start_block(self):
+        return self.low_cyl * self.blocks_per_cylinder()
+
+    def num_blocks(self):
+        return (self.high_cyl - self.low_cyl + 1) * self.blocks_per_cylinder()
+
+    def start_offset(self):
+        """the byte offset of the partition on the disk"""
+        return self.start_block() * self.sector_size
+
+    def size_in_bytes(self):
+        return self.num_blocks() * self.sector_size
+
+    def is_bootable(self):
+        return (self.flags & PART_FLAG_BOOTABLE) != 0
+
+    def dos_type_str(self):
+        """the DOS type as it is usually written, e.g. DOS\\1 for FFS"""
+        dos_type = struct.pack(">I", self.dos_type)
+        return dos_type[0:3].decode('latin-1') + "\\%d" % dos_type[3]
+
+    def __repr__(self):
+        return "Partition('%s', cylinders %d-%d, %d blocks, %s)" % (
+            self.name, self.low_cyl, self.high_cyl, self.num_blocks(), self.dos_type_str())
+
+
+class RigidDiskBlock:
+    """The Rigid Disk Block (RDSK) describes the geometry and the partitions of a
+    hard disk"""
+    def __init__(self, disk, blocknum):
+        self.disk = disk
+        self.blocknum = blocknum
+        sector = disk.sector(blocknum)
+        self.block_bytes = sector.u32_at(RDB_OFFSET_BLOCK_BYTES)
+        self.cylinders = sector.u32_at(RDB_OFFSET_CYLINDERS)
+        self.sectors = sector.u32_at(RDB_OFFSET_SECTORS)
+        self.heads = sector.u32_at(RDB_OFFSET_HEADS)
+        self._partitions = None
+
+    def partitions(self):
+        """follows the list of partition blocks, it is read only once"""
+        if self._partitions is None:
+            result = []
+            blocknum = self.disk.sector(self.blocknum).u32_at(RDB_OFFSET_PARTITION_LIST)
+            visited = set()
+            while (blocknum != RDB_END_OF_LIST and blocknum not in visited
+                   and blocknum < self.disk.num_sectors()):
+                visited.add(blocknum)
+                sector = self.disk.sector(blocknum)
+                if not _is_valid_rdb_block(sector, RDB_ID_PARTITION):
+                    raise Exception("Invalid partition block at %d" % blocknum)
+                result.append(Partition(sector))
+                blocknum = sector.u32_at(PART_OFFSET_NEXT)
+            self._partitions = result
+        return self._partitions
+
+    def partition(self, name):
+        for partition in self.partitions():
+            if partition.name.upper() == name.upper():
+                return partition
+        raise Exception("Partition '%s' not found" % name)
+
+    def partition_volume(self, name_or_index):
+        """returns the physical volume of a partition, which can be specified
+        by its name or its index"""
+        if isinstance(name_or_index, int):
+            partition = self.partitions()[name_or_index]
+        else:
+            partition = self.partition(name_or_index)
+        try:
+            _check_block_size(partition.block_size)
+        except Exception:
+            raise Exception("Unsupported block size %d in partition '%s'" %
+                            (partition.block_size, partition.name))
+        return PartitionVolume(self.disk, partition)
+
+
+def read_rigid_disk_block(disk):
+    """scans the first blocks of the disk for a Rigid Disk Block.
+    Returns None if the disk does not have one"""
+    for blocknum in range(min(RDB_SCAN_BLOCKS, disk.num_sectors())):
+        if _is_valid_rdb_block(disk.sector(blocknum), RDB_ID_RIGID_DISK):
+            return RigidDiskBlock(disk, blocknum)
+    return None
+
+
+def _write_at(file, data, offset):
+    """positioned write, does not change the file position if the platform
+    supports it"""
+    if hasattr(os, 'pwrite') and hasattr(file, 'fileno'):
+        file.flush()
+        fileno = file.fileno()
+        while len(data) > 0:
+            num_written = os.pwrite(fileno, data, offset)
+            data = data[num_written:]
+            offset += num_written
+    else:
+        file.seek(offset)
+        file.write(data)
+
+
+def _fsync(file):
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def _read_journal(journal_path):
+    """returns the (offset, data) entries of a complete journal, or None if the
+    journal is incomplete or damaged"""
+    with open(journal_path, "rb") as journal:
+        data = journal.read()
+    header_size = len(JOURNAL_MAGIC) + 4
+    trailer_size = 4 + len(JOURNAL_END)
+    if (len(data) < header_size + trailer_size or not data.startswith(JOURNAL_MAGIC)
+            or not data.endswith(JOURNAL_END)):
+        return None
+    (crc,) = struct.unpack_from(">I", data, len(data) - trailer_size)
+    if zlib.crc32(data[0:len(data) - trailer_size]) != crc:
+        return None
+    (num_entries,) = struct.unpack_from(">I", data, len(JOURNAL_MAGIC))
+    entries = []
+    pos = header_size
+    for i in range(num_entries):
+        offset, length = struct.unpack_from(">QI", data, pos)
+        pos += 12
+        entries.append((offset, data[pos:pos + length]))
+        pos += length
+    return entries
+
+
+def recover_journal(path):
+    """completes an interrupted write_dirty_atomic() of the image file at path.
+    A journal that was not completely written is discarded, the image was not
+    modified in that case. Call this before opening the image.
+    Returns True if the journal was applied"""
+    journal_path = path + JOURNAL_SUFFIX
+    if not os.path.exists(journal_path):
+        return False
+    entries = _read_journal(journal_path)
+    if entries is not None:
+        with open(path, "r+b") as outfile:
+            for offset, data in entries:
+                _write_at(outfile, data, offset)
+            _fsync(outfile)
+    os.remove(journal_path)
+    return entries is not None
+
+
+def _map_image_file(file, readonly):
+    """memory maps the image file. Returns None if the file object can't be mapped,
+    e.g. because it is an in-memory stream"""
+    try:
+        fileno = file.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    if os.fstat(fileno).st_size == 0:
+        return None
+    # ACCESS_COPY maps the file MAP_PRIVATE: writes go to private copies of the
+    # touched pages and never reach the file unless explicitly written back
+    access = mmap.ACCESS_READ if readonly else mmap.ACCESS_COPY
+    return mmap.mmap(fileno, 0, access=access)
+
+
+def read_adf_image(file, readonly=False):
+    """Reads an ADF or HDF image. If possible, the image file is memory mapped
+    instead of read into memory, so opening even a large image is cheap and only
+    the sectors that are actually accessed are loaded.
+    With readonly=True, the volume can't be modified, otherwise modifications
+    are copy-on-write and are not reflected in the file"""
+    data = _map_image_file(file, readonly)
+    if data is None:
+        data = file.read()
+        data = bytes(data) if readonly else bytearray(data)
 
     if len(data) == DDD_IMAGE_SIZE:
-        result = DoubleDensityDisk()
+        result = DoubleDensityDisk(data)
     elif len(data) == HDD_IMAGE_SIZE:
-        result = HighDensityDisk()
+        result = HighDensityDisk(data)
+    elif len(data) > 0 and len(data) % FLOPPY_BYTES_PER_SECTOR == 0:
+        result = HardDisk(data)
     else:
         raise Exception("Wrong image size !!! (expected %d but was %d)" % (DDD_IMAGE_SIZE, len(data)))
-    result.data = filedata
     return result
+
+
+def read_adf_image_file(path, readonly=False):
+    """Reads the ADF or HDF image file at path like read_adf_image(). If an
+    update of the file was interrupted, the pending journal is applied to the
+    image in memory, so tools that only read see the completed update. The file
+    itself is not modified, recover_journal() does that"""
+    journal_path = path + JOURNAL_SUFFIX
+    entries = _read_journal(journal_path) if os.path.exists(journal_path) else None
+    with open(path, "rb") as infile:
+        disk = read_adf_image(infile, readonly=readonly and entries is None)
+    if entries is not None:
+        view = disk.view()
+        for offset, data in entries:
+            view[offset:offset + len(data)] = data
+    return disk
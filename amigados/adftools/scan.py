@@ -0,0 +1,144 @@
+"""scan.py - Batch scanning of Amiga disk image collections"""
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+from . import index
+from . import logical
+from . import physical
+
+IMAGE_EXTENSIONS = ['.adf', '.hdf']
+
+# the number of images sent to a worker process at a time
+SCAN_CHUNK_SIZE = 16
+
+
+def _scan_volume(physical_volume, partition=None):
+    volume = logical.LogicalVolume(physical_volume)
+    result = {'partition': partition, 'name': None, 'filesystem': None,
+              'dirs': [], 'files': []}
+    if not volume.boot_block().is_dos():
+        return result
+    result['filesystem'] = volume.filesystem_type()
+    result['name'] = volume.root_block().name()
+    for path, record in volume.iter_tree():
+        if record.secondary_type == logical.BLOCK_SEC_TYPE_USERDIR:
+            result['dirs'].append(path)
+        elif record.secondary_type == logical.BLOCK_SEC_TYPE_FILE:
+            result['files'].append({'path': path, 'size': record.file_size})
+    return result
+
+
+def iter_volumes(disk):
+    """generates the partition name and the physical volume of each volume on
+    a disk. A disk without a Rigid Disk Block is a single volume without a
+    partition name"""
+    rdb = physical.read_rigid_disk_block(disk)
+    if rdb is None:
+        yield None, disk
+    else:
+        for i, partition in enumerate(rdb.partitions()):
+            yield partition.name, rdb.partition_volume(i)
+
+
+def scan_image(path):
+    """reads the image file at path and returns a dictionary with its size,
+    SHA-1 checksum and the volume name, file system type, directories and files
+    of each volume on it. The volumes of a hard disk image are its partitions.
+    If the image can't be read, the dictionary contains an 'error' entry instead"""
+    result = {'image': path}
+    try:
+        disk = physical.read_adf_image_file(path, readonly=True)
+        result['size'] = len(disk.data)
+        result['sha1'] = hashlib.sha1(disk.data).hexdigest()
+        result['volumes'] = [_scan_volume(volume, partition)
+                             for partition, volume in iter_volumes(disk)]
+    except Exception as e:
+        result = {'image': path, 'error': str(e)}
+    return result
+
+
+def find_images(paths):
+    """generates the image files in paths, directories are searched recursively
+    for files with an extension in IMAGE_EXTENSIONS"""
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def read_checkpoint(checkpoint_path):
+    """returns the set of image paths recorded in the checkpoint file"""
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path) as infile:
+        return set(line.rstrip("\n") for line in infile if len(line) > 1)
+
+
+def scan_images(paths, outfile, checkpoint_path=None, max_workers=None):
+    """scans the images in paths with a pool of worker processes and writes a
+    JSON line for each image to outfile as soon as its result is available.
+    An image is appended to the checkpoint file after its result was written,
+    images that are already in the checkpoint file are skipped, so an
+    interrupted scan can be resumed. Returns the number of images scanned"""
+    done = read_checkpoint(checkpoint_path)
+    todo = [path for path in find_images(paths) if path not in done]
+    checkpoint = open(checkpoint_path, "a") if checkpoint_path is not None else None
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(scan_image, todo, chunksize=SCAN_CHUNK_SIZE):
+                outfile.write(json.dumps(result) + "\n")
+                if checkpoint is not None:
+                    outfile.flush()
+                    checkpoint.write(result['image'] + "\n")
+                    checkpoint.flush()
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    return len(todo)
+
+
+def find_in_image(path, query, use_index=False):
+    """returns the files and directories on the volumes of the image file at
+    path that match the logical.FindQuery as tuples (partition, path, size).
+    With use_index, the query is evaluated against the volume's metadata index,
+    see index.load_index()"""
+    result = []
+    disk = physical.read_adf_image_file(path, readonly=True)
+    for partition, physical_volume in iter_volumes(disk):
+        volume = logical.LogicalVolume(physical_volume)
+        if not volume.boot_block().is_dos():
+            continue
+        if use_index:
+            vol_index = index.load_index(volume, path, partition)
+            result.extend((partition, entry_path, vol_index.sizes[entry])
+                          for entry_path, entry in vol_index.find(query))
+        else:
+            result.extend((partition, entry.path, entry.size) for entry in volume.find(query))
+    return result
+
+
+def _find_in_image(args):
+    path, query, use_index = args
+    try:
+        return path, find_in_image(path, query, use_index), None
+    except Exception as e:
+        return path, [], str(e)
+
+
+def find_in_images(paths, query, use_index=False, max_workers=None):
+    """searches the images in paths (files or directories) with a pool of
+    worker processes. Generates a tuple (image, matches, error) per image in the
+    order of the images, see find_in_image() for the matches"""
+    todo = [(path, query, use_index) for path in find_images(paths)]
+    if len(todo) <= 1 or max_workers == 1:
+        yield from map(_find_in_image, todo)
+        return
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(_find_in_image, todo, chunksize=SCAN_CHUNK_SIZE)
@@ -0,0 +1,276 @@
+"""server.py - Read-only access to Amiga disk volumes for host tools
+
+The volume is served over HTTP or, if fusepy is installed, mounted as a FUSE
+file system. Both front ends share a VolumeFS, which answers path lookups from
+an in-memory VolumeIndex and keeps the decoded block tables of recently read
+files.
+"""
+
+from collections import OrderedDict
+import email.utils
+import errno
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import stat
+import threading
+import urllib.parse
+from . import index
+from . import logical
+
+try:
+    import fuse
+except ImportError:
+    fuse = None
+
+# sequential reads are extended to at least this many bytes
+READAHEAD_SIZE = 128 * 1024
+
+# the number of files whose readers are kept open
+OPEN_FILES_CACHE_SIZE = 64
+
+# the size of the chunks in which the HTTP server sends file data
+HTTP_CHUNK_SIZE = 64 * 1024
+
+
+class _OpenFile:
+    __slots__ = ('reader', 'lock', 'buffer_offset', 'buffer', 'next_offset')
+
+    def __init__(self, reader):
+        self.reader = reader
+        # serializes the reads of this file, other files are read in parallel
+        self.lock = threading.Lock()
+        self.buffer_offset = 0
+        self.buffer = b''
+        self.next_offset = 0
+
+
+class VolumeFS:
+    """Read-only file system operations on a logical volume. Paths are looked up
+    in a VolumeIndex built when the VolumeFS is created, the readers of the most
+    recently read files are kept with their data block tables loaded.
+    A read that continues where the previous read of the file ended is extended
+    to READAHEAD_SIZE bytes, the following reads are served from that buffer.
+    The operations can be called from multiple threads, different files are
+    read concurrently"""
+    def __init__(self, volume, readahead=READAHEAD_SIZE, max_open_files=OPEN_FILES_CACHE_SIZE):
+        self.volume = volume
+        self.readahead = readahead
+        self.max_open_files = max_open_files
+        self.index = index.VolumeIndex.build(volume)
+        # build the lookup tables now, so requests don't race to do it
+        self.index.lookup("/")
+        self.index.children(0)
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.buffer_hits = 0
+
+    def lookup(self, path):
+        try:
+            return self.index.lookup(path)
+        except Exception:
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", path)
+
+    def _stat(self, entry):
+        vol_index = self.index
+        return {'name': vol_index.names[entry], 'is_dir': vol_index.is_dir(entry),
+                'is_file': vol_index.is_file(entry), 'size': vol_index.sizes[entry],
+                'mtime': vol_index.last_modification_time(entry).timestamp()}
+
+    def stat(self, path):
+        """returns a dictionary with the name, size, modification time
+        (a POSIX timestamp) and whether the entry at path is a directory or a
+        file. Links are neither"""
+        return self._stat(self.lookup(path))
+
+    def listdir(self, path):
+        """returns the stat() dictionaries of the entries of the directory at path"""
+        entry = self.lookup(path)
+        if not self.index.is_dir(entry):
+            raise NotADirectoryError(errno.ENOTDIR, "Not a directory", path)
+        return [self._stat(child) for child in self.index.children(entry)]
+
+    def _open_file(self, entry):
+        open_file = self._files.get(entry)
+        if open_file is not None:
+            self._files.move_to_end(entry)
+            return open_file
+        header = self.volume.header_block_at(self.index.blocknums[entry])
+        reader = logical.FileReader(self.volume, header)
+        reader.load_tables()
+        open_file = _OpenFile(reader)
+        self._files[entry] = open_file
+        if len(self._files) > self.max_open_files:
+            self._files.popitem(last=False)
+        return open_file
+
+    def read(self, path, offset, size):
+        """returns up to size bytes of the file at path, starting at offset"""
+        entry = self.lookup(path)
+        if not self.index.is_file(entry):
+            raise IsADirectoryError(errno.EISDIR, "Not a file", path)
+        file_size = self.index.sizes[entry]
+        size = max(0, min(size, file_size - offset))
+        if size == 0:
+            return b''
+        with self._lock:
+            self.reads += 1
+            open_file = self._open_file(entry)
+        with open_file.lock:
+            start = offset - open_file.buffer_offset
+            buffer_hit = start >= 0 and start + size <= len(open_file.buffer)
+            if not buffer_hit:
+                length = max(size, self.readahead) if offset == open_file.next_offset else size
+                open_file.reader.seek(offset)
+                open_file.buffer = open_file.reader.read(length)
+                open_file.buffer_offset = offset
+                start = 0
+            open_file.next_offset = offset + size
+            result = open_file.buffer[start:start + size]
+        if buffer_hit:
+            with self._lock:
+                self.buffer_hits += 1
+        return result
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """GET returns the data of a file, with support for byte ranges, or the
+    entries of a directory as JSON"""
+    server_version = "amigados-serve"
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def _respond(self, send_body):
+        volume_fs = self.server.volume_fs
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        try:
+            info = volume_fs.stat(path)
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        if not info['is_dir'] and not info['is_file']:
+            self.send_error(501, "Links are not supported")
+            return
+        if info['is_dir']:
+            body = json.dumps(volume_fs.listdir(path)).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+
+        start, end = 0, info['size']
+        byte_range = self.headers.get("Range")
+        if byte_range is not None:
+            byte_range = _parse_range(byte_range, info['size'])
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % info['size'])
+                self.end_headers()
+                return
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, info['size']))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", email.utils.formatdate(info['mtime'], usegmt=True))
+        self.end_headers()
+        if send_body:
+            pos = start
+            while pos < end:
+                chunk = volume_fs.read(path, pos, min(HTTP_CHUNK_SIZE, end - pos))
+                if len(chunk) == 0:
+                    break
+                self.wfile.write(chunk)
+                pos += len(chunk)
+
+
+def _parse_range(value, size):
+    """parses a single byte range, returns (start, end) with end exclusive or
+    None if the range can't be satisfied"""
+    if not value.startswith("bytes=") or ',' in value:
+        return None
+    first, _, last = value[len("bytes="):].partition('-')
+    try:
+        if first == '':
+            start, end = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            end = min(int(last) + 1, size) if last != '' else size
+    except ValueError:
+        return None
+    if start >= end:
+        return None
+    return start, end
+
+
+def http_server(volume_fs, address="127.0.0.1", port=8080, quiet=False):
+    """creates a threaded HTTP server for volume_fs, call serve_forever() on it.
+    Port 0 selects a free port, see server_address"""
+    server = ThreadingHTTPServer((address, port), _RequestHandler)
+    server.daemon_threads = True
+    server.volume_fs = volume_fs
+    server.quiet = quiet
+    return server
+
+
+if fuse is not None:
+    class FuseOperations(fuse.Operations):
+        """The FUSE operations of a read-only volume"""
+        def __init__(self, volume_fs):
+            self.volume_fs = volume_fs
+
+        def getattr(self, path, fh=None):
+            try:
+                info = self.volume_fs.stat(path)
+            except FileNotFoundError:
+                raise fuse.FuseOSError(errno.ENOENT)
+            if info['is_dir']:
+                mode, nlink = stat.S_IFDIR | 0o555, 2
+            else:
+                mode, nlink = stat.S_IFREG | 0o444, 1
+            return {'st_mode': mode, 'st_nlink': nlink, 'st_size': info['size'],
+                    'st_mtime': info['mtime'], 'st_atime': info['mtime'], 'st_ctime': info['mtime']}
+
+        def readdir(self, path, fh):
+            try:
+                return ['.', '..'] + [info['name'] for info in self.volume_fs.listdir(path)]
+            except FileNotFoundError:
+                raise fuse.FuseOSError(errno.ENOENT)
+            except NotADirectoryError:
+                raise fuse.FuseOSError(errno.ENOTDIR)
+
+        def open(self, path, flags):
+            if (flags & (os.O_WRONLY | os.O_RDWR)) != 0:
+                raise fuse.FuseOSError(errno.EROFS)
+            self.getattr(path)
+            return 0
+
+        def read(self, path, size, offset, fh):
+            try:
+                return self.volume_fs.read(path, offset, size)
+            except FileNotFoundError:
+                raise fuse.FuseOSError(errno.ENOENT)
+            except IsADirectoryError:
+                raise fuse.FuseOSError(errno.EISDIR)
+
+
+def mount(volume_fs, mountpoint, foreground=True):
+    """mounts the volume read-only at mountpoint. This needs fusepy"""
+    if fuse is None:
+        raise Exception("Mounting a volume requires fusepy, which is not installed")
+    fuse.FUSE(FuseOperations(volume_fs), mountpoint, foreground=foreground, ro=True)
@@ -1,4 +1,7 @@
+import array
+import re
 import struct
+import sys
 from datetime import datetime
 import time
 
@@ -21,6 +24,16 @@ def amigados_time_to_datetime(days_since_jan_1_78,
     return datetime.fromtimestamp((millis + AMIGADOS_BASE_MILLIS) / 1000)
 
 
+def amigados_time_key(dt):
+    """the inverse of amigados_time_to_datetime(): returns the tuple
+    (days, minutes, ticks) that is converted to dt, so dates can be compared
+    with the time fields of header blocks without converting those"""
+    millis = int(round(dt.timestamp() * 1000)) - AMIGADOS_BASE_MILLIS
+    days, millis = divmod(millis, MILLISECONDS_PER_DAY)
+    minutes, millis = divmod(millis, MILLISECONDS_PER_MINUTE)
+    return (days, minutes, millis // MILLISECONDS_PER_TICK)
+
+
 def datetime_to_amigados_time(dt):
     basetime = datetime(1978, 1, 1)
     days_since_1978_1_1 = (dt - basetime).days
@@ -32,48 +45,196 @@ def datetime_to_amigados_time(dt):
     return (days_since_1978_1_1, minutes_past_midnight, ticks_past_last_minute)
 
 
+# array type code for unsigned 32 bit integers
+U32_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
+# number of blocks that the batch checksum functions process at a time
+CHECKSUM_BATCH_BLOCKS = 2048
+
+
+def _longwords(data, num_bytes):
+    """unpacks the big endian long words of a block in a single call"""
+    return struct.unpack(">%dI" % (num_bytes // 4), data[0:num_bytes])
+
+
+def _longword_array(data):
+    """converts a buffer into an array of host order unsigned 32 bit integers"""
+    result = array.array(U32_TYPECODE)
+    result.frombytes(data)
+    if sys.byteorder == 'little':
+        result.byteswap()
+    return result
+
+
 def bootblock_checksum(data, num_bytes):
     """bootblock checksum function"""
-    result = 0
-    for i in range(0, num_bytes, 4):
-        if i == 4:
-            # ignore the checksum field itself for the computation
-            continue
-        d = struct.unpack(">I", data[i:i + 4])[0]
-        result += d
-
-        # 32-bit overflow, but Python has unlimited range, so we need to
-        # simulate the overflow
-        if result > 0xffffffff:
-            result -= 0xffffffff
+    words = _longwords(data, num_bytes)
+    # ignore the checksum field itself for the computation
+    result = sum(words) - words[1]
+
+    # this is a 32-bit sum where the overflow is added back, so we fold
+    # the carries of the unlimited Python integer back into the lower 32 bits
+    while result > 0xffffffff:
+        result = (result & 0xffffffff) + (result >> 32)
 
     return ~result & 0xffffffff
 
 
 def headerblock_checksum(data, num_bytes, exclude_offset=20):
     """header block checksum function"""
-    result = 0
-    for i in range(0, num_bytes, 4):
-        # ignore the checksum field itself for the computation
-        if i == exclude_offset:
-            continue
-        d = struct.unpack(">I", data[i:i + 4])[0]
-        result += d
-
-        # 32-bit overflow, but Python has unlimited range, so we need to
-        # simulate the overflow
-        if result > 0xffffffff:
-            result = result - 0xffffffff - 1
-
+    words = _longwords(data, num_bytes)
+    # ignore the checksum field itself for the computation
+    result = sum(words) - words[exclude_offset // 4]
     return (-result) & 0xffffffff
 
 
-def compute_hash(name, block_size):
-    """non-international hash function"""
-    hash = len(name)
-    for i in range(len(name)):
-        hash *= 13
-        hash += ord(name[i].upper())
-        hash &= 0x7ff
-    hash %= ((block_size / 4) - 56)
-    return int(hash)
+def _iter_block_sums(data, block_size):
+    """yields the 32-bit sum of the long words for each block in data.
+    The data is converted in batches to limit the memory usage for large images"""
+    words_per_block = block_size // 4
+    batch_size = block_size * CHECKSUM_BATCH_BLOCKS
+    view = memoryview(data)
+    for batch_start in range(0, len(view) - len(view) % block_size, batch_size):
+        batch_end = min(batch_start + batch_size, len(view) - len(view) % block_size)
+        words = _longword_array(view[batch_start:batch_end])
+        for i in range(0, len(words), words_per_block):
+            yield words, i, sum(words[i:i + words_per_block])
+
+
+def headerblock_checksums(data, block_size, exclude_offset=20):
+    """computes the header block checksums for all blocks in data (e.g.
+    a complete image) in one call. Returns a list with a checksum per block"""
+    exclude_index = exclude_offset // 4
+    return [(words[i + exclude_index] - block_sum) & 0xffffffff
+            for words, i, block_sum in _iter_block_sums(data, block_size)]
+
+
+def valid_checksums(data, block_size):
+    """verifies the header block checksums for all blocks in data (e.g.
+    a complete image) in one call. Since the checksum is defined such that the
+    sum over all long words of a block is 0, the position of the checksum
+    field does not matter.
+    Returns a list with a boolean per block"""
+    return [(block_sum & 0xffffffff) == 0
+            for words, i, block_sum in _iter_block_sums(data, block_size)]
+
+
+def _upper_case_table(international):
+    table = bytearray(range(256))
+    for c in range(ord('a'), ord('z') + 1):
+        table[c] = c - 32
+    if international:
+        # the Latin-1 letters, except for the division sign
+        for c in range(0xe0, 0xff):
+            if c != 0xf7:
+                table[c] = c - 32
+    return bytes(table)
+
+
+# translation tables for bytes.translate(), AmigaDOS names are Latin-1
+UPPER_CASE_TABLE = _upper_case_table(False)
+INTL_UPPER_CASE_TABLE = _upper_case_table(True)
+
+
+def upper_name(name, international=False):
+    """upper cases a name the way AmigaDOS does when it compares names"""
+    table = INTL_UPPER_CASE_TABLE if international else UPPER_CASE_TABLE
+    return name.encode('latin-1').translate(table).decode('latin-1')
+
+
+def hash_names(names, block_size, international=False):
+    """computes the hash table indexes of all names in one call"""
+    table = INTL_UPPER_CASE_TABLE if international else UPPER_CASE_TABLE
+    num_slots = block_size // 4 - 56
+    result = []
+    for name in names:
+        data = name.encode('latin-1').translate(table)
+        hash = len(data)
+        for c in data:
+            hash = (hash * 13 + c) & 0x7ff
+        result.append(hash % num_slots)
+    return result
+
+
+def compute_hash(name, block_size, international=False):
+    """hash function of the directory hash tables, the international version
+    also treats the Latin-1 letters case-insensitively"""
+    return hash_names([name], block_size, international)[0]
+
+
+def _pattern_item(pattern, pos):
+    """translates the pattern item at pos, returns the regex and the position
+    after the item"""
+    c = pattern[pos]
+    if c == '?':
+        return '.', pos + 1
+    if c == '*':
+        return '.*', pos + 1
+    if c == '%':
+        return '', pos + 1
+    if c == '#':
+        if pos + 1 >= len(pattern):
+            raise Exception("'#' without an item in pattern '%s'" % pattern)
+        item, pos = _pattern_item(pattern, pos + 1)
+        return '(?:%s)*' % item, pos
+    if c == '(':
+        regex, pos = _pattern_alternatives(pattern, pos + 1)
+        if pos >= len(pattern) or pattern[pos] != ')':
+            raise Exception("Missing ')' in pattern '%s'" % pattern)
+        return '(?:%s)' % regex, pos + 1
+    if c == '[':
+        end = pattern.find(']', pos + 1)
+        if end < 0:
+            raise Exception("Missing ']' in pattern '%s'" % pattern)
+        chars = pattern[pos + 1:end]
+        negate = chars.startswith('~')
+        if negate:
+            chars = chars[1:]
+        chars = ''.join('\\' + ch if ch in '\\^[]' else ch for ch in chars)
+        return '[%s%s]' % ('^' if negate else '', chars), end + 1
+    if c == "'" and pos + 1 < len(pattern):
+        return re.escape(pattern[pos + 1]), pos + 2
+    return re.escape(c), pos + 1
+
+
+def _pattern_sequence(pattern, pos):
+    """translates the items up to the next alternative"""
+    sequence = ''
+    while pos < len(pattern) and pattern[pos] not in '|)':
+        if pattern[pos] == '~':
+            # the negation applies to the rest of the sequence
+            rest, pos = _pattern_sequence(pattern, pos + 1)
+            sequence += '(?!(?:%s)$).*' % rest
+        else:
+            item, pos = _pattern_item(pattern, pos)
+            sequence += item
+    return sequence, pos
+
+
+def _pattern_alternatives(pattern, pos):
+    """translates the alternatives up to the end of the pattern or the closing
+    parenthesis of the current group"""
+    sequence, pos = _pattern_sequence(pattern, pos)
+    alternatives = [sequence]
+    while pos < len(pattern) and pattern[pos] == '|':
+        sequence, pos = _pattern_sequence(pattern, pos + 1)
+        alternatives.append(sequence)
+    return '|'.join(alternatives), pos
+
+
+def compile_pattern(pattern, international=False):
+    """compiles an AmigaDOS wildcard pattern to a regular expression that
+    matches the complete names which were upper cased with upper_name(), since
+    AmigaDOS patterns are not case sensitive.
+    Supported are ? (any character), #<item> (any number of the item, #? matches
+    anything), (a|b) (alternatives), [a-z] and [~a-z] (character classes),
+    ~ (negates the rest of the pattern), % (the empty string) and ' (quotes the
+    next character). * is accepted as an alias for #?"""
+    regex, pos = _pattern_alternatives(upper_name(pattern, international), 0)
+    if pos < len(pattern):
+        raise Exception("Unbalanced ')' in pattern '%s'" % pattern)
+    return re.compile(regex, re.DOTALL)
+
+
+def has_wildcards(pattern):
+    return any(c in pattern for c in "?#*()|~[%'")
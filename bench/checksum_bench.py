@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""checksum_bench.py - compares the block checksum functions in adftools.util
+with the original long word at a time implementation"""
+
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from amigados.adftools import physical, util
+
+
+def legacy_bootblock_checksum(data, num_bytes):
+    result = 0
+    for i in range(0, num_bytes, 4):
+        if i == 4:
+            continue
+        d = struct.unpack(">I", data[i:i + 4])[0]
+        result += d
+        if result > 0xffffffff:
+            result -= 0xffffffff
+    return ~result & 0xffffffff
+
+
+def legacy_headerblock_checksum(data, num_bytes, exclude_offset=20):
+    result = 0
+    for i in range(0, num_bytes, 4):
+        if i == exclude_offset:
+            continue
+        d = struct.unpack(">I", data[i:i + 4])[0]
+        result += d
+        if result > 0xffffffff:
+            result = result - 0xffffffff - 1
+    return (-result) & 0xffffffff
+
+
+def legacy_image_checksums(data, block_size):
+    return [legacy_headerblock_checksum(data[i:i + block_size], block_size)
+            for i in range(0, len(data), block_size)]
+
+
+def report(name, legacy_time, new_time):
+    print("%-24s legacy: %8.3f ms  new: %8.3f ms  speedup: %6.1fx" %
+          (name, legacy_time * 1000, new_time * 1000, legacy_time / new_time))
+
+
+if __name__ == '__main__':
+    with open(os.path.join(os.path.dirname(__file__), '..', 'testdata', 'wbench1.3.adf'), 'rb') as infile:
+        image = infile.read()
+    block_size = physical.FLOPPY_BYTES_PER_SECTOR
+    rootblock = image[880 * block_size:881 * block_size]
+
+    # make sure we compare equivalent implementations
+    assert legacy_bootblock_checksum(image, 1024) == util.bootblock_checksum(image, 1024)
+    assert legacy_headerblock_checksum(rootblock, block_size) == util.headerblock_checksum(rootblock, block_size)
+    assert legacy_image_checksums(image, block_size) == util.headerblock_checksums(image, block_size)
+
+    number = 200
+    report("boot block",
+           timeit.timeit(lambda: legacy_bootblock_checksum(image, 1024), number=number) / number,
+           timeit.timeit(lambda: util.bootblock_checksum(image, 1024), number=number) / number)
+    report("header block",
+           timeit.timeit(lambda: legacy_headerblock_checksum(rootblock, block_size), number=number) / number,
+           timeit.timeit(lambda: util.headerblock_checksum(rootblock, block_size), number=number) / number)
+    number = 3
+    report("image (%d blocks)" % (len(image) // block_size),
+           timeit.timeit(lambda: legacy_image_checksums(image, block_size), number=number) / number,
+           timeit.timeit(lambda: util.headerblock_checksums(image, block_size), number=number) / number)
@@ -60,4 +60,7 @@ if __name__ == '__main__':
                    'bin/amigados-dalf', 'bin/amigados-bumprev',
                    'bin/amigados-dir', 'bin/amigados-copy',
                    'bin/amigados-makedir', 'bin/amigados-createdisk',
-                   'bin/amigados-delete'])
+                   'bin/amigados-delete', 'bin/amigados-extract',
+                   'bin/amigados-scan', 'bin/amigados-dedup',
+                   'bin/amigados-fsck', 'bin/amigados-find',
+                   'bin/amigados-serve', 'bin/amigados-daemon'])
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""adftools_daemon_test.py"""
+
+import unittest
+import xmlrunner
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from amigados.adftools import client
+from amigados.adftools import daemon
+from amigados.adftools import logical
+from amigados.adftools import physical
+
+
+class ADFToolsDaemonTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for daemon module"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.image_path = os.path.join(self.tmpdir, "wbench.adf")
+        shutil.copyfile("testdata/wbench1.3.adf", self.image_path)
+        self.socket_path = os.path.join(self.tmpdir, "daemon.sock")
+        self.thread = None
+
+    def start_daemon(self, idle_sync_delay=3600):
+        """the daemon does not write back on idle unless a test asks for it"""
+        self.daemon = daemon.Daemon(idle_sync_delay=idle_sync_delay)
+        self.server = daemon.unix_server(self.daemon, self.socket_path)
+        self.thread = threading.Thread(target=self.daemon.serve_forever, args=(self.server,))
+        self.thread.start()
+
+    def tearDown(self):
+        if self.thread is not None:
+            if self.thread.is_alive():
+                client.request("shutdown", self.socket_path)
+                self.thread.join()
+            self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, command, **args):
+        return client.request(command, self.socket_path, **args)
+
+    def open_volume(self):
+        with open(self.image_path, "rb") as infile:
+            return logical.LogicalVolume(physical.read_adf_image(infile))
+
+    def modify_externally(self, dirname):
+        volume = self.open_volume()
+        volume.makedir(dirname)
+        volume.physical_volume.write_dirty_atomic(self.image_path, fsync=False)
+        # make sure the modification time changes on file systems with coarse timestamps
+        stat = os.stat(self.image_path)
+        os.utime(self.image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    def test_commands(self):
+        self.start_daemon()
+        self.assertEqual("pong", self.request("ping"))
+        original = os.path.getmtime(self.image_path)
+        self.request("makedir", image=self.image_path, path="newdir")
+        host_file = os.path.join(self.tmpdir, "hello.txt")
+        with open(host_file, "wb") as outfile:
+            outfile.write(b"hello")
+        self.request("copy", source=host_file, dest=self.image_path + ":newdir")
+
+        result = self.request("dir", image=self.image_path, path="newdir")
+        self.assertEqual("Workbench1.3", result['volume'])
+        self.assertEqual([["hello.txt", False]], result['entries'])
+        result = self.request("dir", image=self.image_path, recursive=True)
+        self.assertTrue(["newdir/hello.txt", False] in result['tree'])
+        with self.assertRaises(Exception):
+            self.request("makedir", image=self.image_path, path="newdir")
+
+        # the modifications are only in the daemon's memory until sync
+        self.assertEqual(original, os.path.getmtime(self.image_path))
+        self.assertTrue(self.request("status")['images'][0]['dirty_sectors'] > 0)
+        self.assertTrue(self.request("sync") > 0)
+        volume = self.open_volume()
+        self.assertEqual(b"hello", bytes(volume.file_data("newdir/hello.txt")))
+
+        copy_path = os.path.join(self.tmpdir, "copy.txt")
+        self.request("copy", source=self.image_path + ":newdir/hello.txt", dest=copy_path)
+        with open(copy_path, "rb") as infile:
+            self.assertEqual(b"hello", infile.read())
+
+    def test_external_modification(self):
+        self.start_daemon()
+        self.request("dir", image=self.image_path)
+        # another program modifies the image, the daemon reopens it
+        self.modify_externally("external")
+        names = [name for name, is_dir in self.request("dir", image=self.image_path)['entries']]
+        self.assertTrue("external" in names)
+
+        # unsaved changes of an image modified by someone else are not overwritten
+        self.request("makedir", image=self.image_path, path="mine")
+        self.modify_externally("theirs")
+        with self.assertRaises(Exception):
+            self.request("dir", image=self.image_path)
+
+    def test_idle_sync_and_shutdown(self):
+        self.start_daemon(idle_sync_delay=0.1)
+        self.request("makedir", image=self.image_path, path="idle")
+        time.sleep(0.5)
+        self.open_volume().header_for_path("idle")
+
+        # everything is written back on shutdown
+        self.daemon.idle_sync_delay = 3600
+        self.request("makedir", image=self.image_path, path="shutdown")
+        self.request("shutdown")
+        self.thread.join()
+        self.open_volume().header_for_path("shutdown")
+        with self.assertRaises(Exception):
+            self.request("ping")
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ADFToolsDaemonTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+      xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+      unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""adftools_dedup_test.py"""
+
+import unittest
+import xmlrunner
+import sys
+import os
+import shutil
+import tempfile
+
+from amigados.adftools import dedup, logical, physical
+
+
+class ADFToolsDedupTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for dedup module"""
+
+    def setUp(self):
+        self.tmpdir = os.path.realpath(tempfile.mkdtemp())
+        self.index = dedup.DedupIndex(os.path.join(self.tmpdir, "index.db"))
+        self.wbench = os.path.join(self.tmpdir, "wbench.adf")
+        shutil.copy("testdata/wbench1.3.adf", self.wbench)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def make_copy(self, name):
+        """a copy of the Workbench disk with the file 'failat' deleted"""
+        with open(self.wbench, "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        logical.LogicalVolume(disk).delete("failat")
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as outfile:
+            disk.write_image(outfile)
+        return path
+
+    def test_sector_hashes(self):
+        data = bytes(512) + b'\x01' * 512 + bytes(512)
+        hashes = dedup.sector_hashes(data)
+        self.assertEqual(3 * dedup.SECTOR_HASH_SIZE, len(hashes))
+        self.assertEqual(hashes[0:dedup.SECTOR_HASH_SIZE], hashes[2 * dedup.SECTOR_HASH_SIZE:])
+
+    def test_dedup_ratios(self):
+        copy = self.make_copy("copy.adf")
+        self.assertEqual(2, self.index.update([self.tmpdir]))
+        stats = self.index.image_stats(copy)
+        self.assertEqual(1760, stats['sectors'])
+        # the root, bitmap and parent blocks differ
+        self.assertTrue(1750 < stats['shared_sectors'] < 1760)
+        self.assertEqual(stats['files'], stats['shared_files'])
+        wbench_stats = self.index.image_stats(self.wbench)
+        self.assertEqual(stats['files'] + 1, wbench_stats['files'])
+        self.assertTrue(("failat", copy, "failat") not in self.index.shared_files(self.wbench))
+        self.assertTrue(("s/Startup-Sequence", copy, "s/Startup-Sequence")
+                        in self.index.shared_files(self.wbench))
+        self.assertEqual([], self.index.duplicate_images())
+
+    def test_incremental_update(self):
+        self.assertEqual(1, self.index.update([self.tmpdir]))
+        self.assertEqual(0, self.index.update([self.tmpdir]))
+        shutil.copy(self.wbench, os.path.join(self.tmpdir, "same.adf"))
+        self.assertEqual(1, self.index.update([self.tmpdir]))
+        self.assertEqual(1, len(self.index.duplicate_images()))
+        self.assertEqual(1.0, self.index.image_stats(self.wbench)['dedup_ratio'])
+        summary = self.index.summary()
+        self.assertEqual(2 * 1760, summary['sectors'])
+
+        os.remove(os.path.join(self.tmpdir, "same.adf"))
+        self.index.update([self.tmpdir])
+        self.assertEqual([self.wbench], self.index.images())
+        self.assertEqual(1760, self.index.summary()['sectors'])
+        self.assertEqual(summary['distinct_sectors'], self.index.summary()['distinct_sectors'])
+
+    def test_unreadable_image(self):
+        # a truncated image whose directory tree points beyond its end
+        broken = os.path.join(self.tmpdir, "broken.adf")
+        with open(self.wbench, "rb") as infile:
+            data = infile.read()
+        with open(broken, "wb") as outfile:
+            outfile.write(data[0:881 * 512])
+        copy = self.make_copy("copy.adf")
+        self.assertEqual(2, self.index.update([self.tmpdir]))
+        self.assertEqual([broken], [path for path, message in self.index.errors])
+        self.assertEqual(sorted([self.wbench, copy]), self.index.images())
+
+    def test_relative_paths(self):
+        cwd = os.getcwd()
+        try:
+            os.chdir(self.tmpdir)
+            self.assertEqual(1, self.index.update(["wbench.adf"]))
+            self.assertEqual([self.wbench], self.index.images())
+            # the same image seen from another directory
+            os.chdir(os.path.dirname(self.tmpdir))
+            self.assertEqual(0, self.index.update([os.path.basename(self.tmpdir)]))
+            self.assertEqual([self.wbench], self.index.images())
+            self.assertEqual(1760, self.index.image_stats(self.wbench)['sectors'])
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ADFToolsDedupTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+      xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+      unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
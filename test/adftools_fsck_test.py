@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""adftools_fsck_test.py"""
+
+import unittest
+import xmlrunner
+import sys
+
+from amigados.adftools import fsck, logical, physical
+
+
+class ADFToolsFsckTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for fsck module"""
+
+    def make_volume(self):
+        disk = physical.DoubleDensityDisk()
+        volume = logical.LogicalVolume(disk)
+        volume.initialize(fs_type="FFS")
+        volume.makedir("s")
+        volume.write_file("s/a", b'a' * 2000)
+        volume.write_file("s/b", b'b' * 1000)
+        return volume
+
+    def test_wbdisk(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile, readonly=True)
+        report = fsck.check_volume(logical.LogicalVolume(disk))
+        # a data block of devs/printer.device is damaged on the image
+        self.assertEqual([265], report.bad_checksums)
+        self.assertEqual(2, len(report.errors))
+        self.assertTrue(report.bitmap_ok())
+        self.assertEqual(183, report.roles[fsck.ROLE_FILE])
+        self.assertEqual(25, report.roles[fsck.ROLE_USERDIR])
+        self.assertEqual(2, report.roles[fsck.ROLE_EXTENSION])
+        self.assertEqual(1760 - 2 - 31, sum(report.roles.values()))
+
+    def test_clean_volume(self):
+        report = fsck.check_volume(self.make_volume())
+        self.assertTrue(report.is_clean())
+        self.assertEqual(6, report.roles[fsck.ROLE_DATA])
+
+    def test_repair_bitmap(self):
+        volume = self.make_volume()
+        allocator = volume.allocator()
+        orphan = allocator.allocate(near=10)
+        header = volume.header_for_path("s/a")
+        allocator.free(header.blocknum)
+        allocator.sync()
+
+        report = fsck.check_volume(volume)
+        self.assertEqual([orphan], report.orphaned)
+        self.assertEqual([header.blocknum], report.missing)
+        fsck.repair_bitmap(volume, report)
+        self.assertTrue(fsck.check_volume(volume).is_clean())
+        self.assertTrue(allocator.is_free(orphan))
+
+    def test_unsynced_allocation(self):
+        volume = self.make_volume()
+        # the bitmap on the volume is checked, not the allocator's flags
+        volume.allocator().allocate(near=10)
+        self.assertTrue(fsck.check_volume(volume).is_clean())
+
+    def test_invalid_bitmap(self):
+        volume = self.make_volume()
+        root_block = volume.root_block()
+        root_block.sector().set_u32_at(root_block.block_size() + logical.ROOT_BLOCK_SIZE_OFFSET_BITMAP_FLAG, 0)
+        root_block.update_checksum()
+        report = fsck.check_volume(logical.LogicalVolume(volume.physical_volume))
+        self.assertFalse(report.bitmap_ok())
+        volume = logical.LogicalVolume(volume.physical_volume)
+        fsck.repair_bitmap(volume, report)
+        self.assertTrue(fsck.check_volume(volume).is_clean())
+
+    def test_cross_linked(self):
+        volume = self.make_volume()
+        data_block = volume.header_for_path("s/a").data_blocks()[0]
+        header = volume.header_for_path("s/b")
+        # the first data block pointer is in the last hash table slot
+        header.sector().set_u32_at(header.block_size() - logical.DATABLOCK_OFFSET, data_block)
+        header.update_checksum()
+        report = fsck.check_volume(volume)
+        self.assertEqual([data_block], report.cross_linked)
+        self.assertFalse(report.is_clean())
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ADFToolsFsckTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+      xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+      unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
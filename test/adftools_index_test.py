@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""adftools_index_test.py"""
+
+import unittest
+import xmlrunner
+import sys
+import os
+import shutil
+import tempfile
+
+from amigados.adftools import index
+from amigados.adftools import logical
+from amigados.adftools import physical
+
+
+class ADFToolsIndexTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for index module"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.image_path = os.path.join(self.tmpdir, "wbench.adf")
+        shutil.copyfile("testdata/wbench1.3.adf", self.image_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def open_volume(self):
+        with open(self.image_path, "rb") as infile:
+            return logical.LogicalVolume(physical.read_adf_image(infile))
+
+    def test_build(self):
+        volume = self.open_volume()
+        vol_index = index.VolumeIndex.build(volume)
+        self.assertEqual(1 + 183 + 25, len(vol_index))
+        self.assertEqual("Workbench1.3", vol_index.names[0])
+        self.assertTrue(vol_index.is_dir(0))
+
+        entry = vol_index.lookup("PREFS/preferences")
+        self.assertEqual("Prefs/Preferences", vol_index.path(entry))
+        self.assertTrue(vol_index.is_file(entry))
+        self.assertEqual(56628, vol_index.sizes[entry])
+        header = volume.header_for_path("Prefs/Preferences")
+        self.assertEqual(header.blocknum, vol_index.blocknums[entry])
+        self.assertEqual(header.data_blocks(), vol_index.data_blocks(entry))
+        self.assertEqual(header.last_modification_time(), vol_index.last_modification_time(entry))
+        with self.assertRaises(Exception):
+            vol_index.lookup("Prefs/missing")
+
+        self.assertEqual(8, len(vol_index.children(vol_index.lookup("s"))))
+        self.assertEqual(sorted(path for path, record in volume.iter_tree()),
+                         sorted(path for path, entry in vol_index.iter_tree()))
+        self.assertEqual(sum(record.file_size for path, record in volume.iter_tree("s")),
+                         vol_index.total_size("s"))
+
+    def test_find(self):
+        volume = self.open_volume()
+        vol_index = index.VolumeIndex.build(volume)
+        for query in [logical.FindQuery(name="#?.library"),
+                      logical.FindQuery(pattern="#?/#?.info", max_size=500),
+                      logical.FindQuery(entry_type='dir')]:
+            self.assertEqual(sorted(entry.path for entry in volume.find(query)),
+                             sorted(path for path, entry in vol_index.find(query)))
+
+    def test_save_and_load(self):
+        volume = self.open_volume()
+        vol_index = index.VolumeIndex.build(volume)
+        path = index.index_path(self.image_path)
+        vol_index.save(path, {'size': 1})
+        self.assertIsNone(index.VolumeIndex.load(path, {'size': 2}))
+        loaded = index.VolumeIndex.load(path, {'size': 1})
+        self.assertEqual(vol_index.names, loaded.names)
+        for name, typecode in index.INDEX_ARRAYS:
+            self.assertEqual(getattr(vol_index, name), getattr(loaded, name))
+        self.assertIsNone(index.VolumeIndex.load(os.path.join(self.tmpdir, "missing")))
+
+    def test_load_index(self):
+        volume = self.open_volume()
+        vol_index = index.load_index(volume, self.image_path)
+        sidecar = index.index_path(self.image_path)
+        self.assertTrue(os.path.exists(sidecar))
+        mtime = os.path.getmtime(sidecar)
+        self.assertEqual(len(vol_index), len(index.load_index(volume, self.image_path)))
+        self.assertEqual(mtime, os.path.getmtime(sidecar))
+
+        # the index is rebuilt after the volume was modified
+        volume.makedir("newdir")
+        with open(self.image_path, "r+b") as outfile:
+            volume.physical_volume.write_dirty(outfile)
+        volume = self.open_volume()
+        vol_index = index.load_index(volume, self.image_path)
+        self.assertTrue(vol_index.is_dir(vol_index.lookup("newdir")))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ADFToolsIndexTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+      xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+      unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -5,8 +5,16 @@
 import unittest
 import xmlrunner
 import sys
+import gc
+import io
+import os
+import shutil
+import tempfile
+from datetime import datetime
 from amigados.adftools import physical
 from amigados.adftools import logical
+from amigados.adftools import fsck
+from amigados.adftools import util
 
 
 class ADFToolsLogicalTest(unittest.TestCase):  # pylint: disable-msg=R0904
@@ -94,6 +102,625 @@ class ADFToolsLogicalTest(unittest.TestCase):  # pylint: disable-msg=R0904
             self.assertTrue(b in free_blocks)
             self.assertFalse(b in used_blocks)
 
+    def test_delete_recursive(self):
+        """delete a directory tree from disk"""
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        with self.assertRaises(Exception):
+            volume.delete("c")
+        header = volume.header_for_path("c")
+        blocks = volume.tree_blocks(header.record())
+        self.assertEqual(header.blocknum, blocks[-1])
+        dir_file = volume.header_for_path("c/dir")
+        self.assertTrue(blocks.index(dir_file.data_blocks()[0]) < blocks.index(dir_file.blocknum))
+
+        volume.delete("c", recursive=True)
+        allocator = volume.allocator()
+        self.assertEqual(31 + len(blocks), allocator.num_free_blocks())
+        with self.assertRaises(Exception):
+            volume.header_for_path("c/dir")
+
+        # the bitmap and the root block are consistent after the delete
+        volume2 = logical.LogicalVolume(disk)
+        self.assertEqual(allocator.free_blocks(), volume2.allocator().free_blocks())
+        bitmap_block = volume2.root_block().bitmap_block0()
+        self.assertEqual(bitmap_block.stored_checksum(), bitmap_block.computed_checksum())
+        root_block = volume2.root_block()
+        self.assertEqual(root_block.stored_checksum(), root_block.computed_checksum())
+
+    def test_transaction(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        orig = bytes(disk.data)
+        with self.assertRaises(Exception):
+            with volume.transaction():
+                volume.makedir("newdir")
+                volume.header_for_path("newdir")
+                volume.delete("c", recursive=True)
+                raise Exception("failed")
+        self.assertEqual(orig, bytes(disk.data))
+        self.assertEqual([], disk.dirty_sectors())
+        self.assertEqual(31, volume.allocator().num_free_blocks())
+        self.assertTrue(volume.header_for_path("c/dir").is_file())
+        with self.assertRaises(Exception):
+            volume.header_for_path("newdir")
+
+        with volume.transaction():
+            volume.makedir("newdir")
+        self.assertTrue(volume.header_for_path("newdir").is_directory())
+        self.assertEqual(30, logical.LogicalVolume(disk).allocator().num_free_blocks())
+
+    def test_allocator_matches_bitmap(self):
+        """the allocator decodes the bitmap with the first block in the lowest bit"""
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        allocator = volume.allocator()
+        self.assertEqual(31, allocator.num_free_blocks())
+        # root, bitmap and a file header are used
+        for blocknum in [880, 1015, 980]:
+            self.assertFalse(allocator.is_free(blocknum))
+        self.assertTrue(allocator.is_free(allocator.free_blocks()[0]))
+
+    def test_allocator_lazy_sync(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        allocator = volume.allocator()
+        bitmap_block = volume.root_block().bitmap_block0()
+        orig_bitmap = bytes(bitmap_block.data())
+
+        blocknum = allocator.allocate(near=880)
+        self.assertFalse(allocator.is_free(blocknum))
+        self.assertEqual(orig_bitmap, bytes(bitmap_block.data()))
+        allocator.sync()
+        self.assertNotEqual(orig_bitmap, bytes(bitmap_block.data()))
+        self.assertEqual(bitmap_block.stored_checksum(), bitmap_block.computed_checksum())
+
+        allocator.free(blocknum)
+        allocator.sync()
+        self.assertEqual(orig_bitmap, bytes(bitmap_block.data()))
+
+    def test_allocator_runs(self):
+        disk = physical.DoubleDensityDisk()
+        volume = logical.LogicalVolume(disk)
+        root_block = volume.root_block()
+        root_block.sector().set_u32_at(root_block.block_size() + logical.ROOT_BLOCK_SIZE_OFFSET_BITMAP_FLAG,
+                                       0xffffffff)
+        root_block.sector().set_u32_at(root_block.block_size() + logical.ROOT_BLOCK_SIZE_OFFSET_BITMAP_PAGES,
+                                       881)
+        bitmap = disk.sector(881)
+        for offset in range(4, bitmap.size_in_bytes(), 4):
+            bitmap.set_u32_at(offset, 0xffffffff)
+        allocator = volume.allocator()
+        allocator.allocate(880)
+        allocator.allocate(881)
+        self.assertEqual(1756, allocator.num_free_blocks())
+        self.assertEqual([882, 883, 884], allocator.allocate_run(3, near=880))
+        self.assertEqual(885, allocator.find_free_run(10, near=880))
+        # wrap around to the start of the volume
+        self.assertEqual(2, allocator.find_free_run(10, near=1755))
+        self.assertIsNone(allocator.find_free_run(2000))
+        with self.assertRaises(Exception):
+            allocator.allocate(882)
+
+    def test_allocator_bitmap_extension(self):
+        """a hard disk sized volume with bitmap blocks in an extension block"""
+        blocks_per_bitmap = 127 * 32
+        num_blocks = 2 + 27 * blocks_per_bitmap
+        disk = physical.HardDisk(bytearray(num_blocks * physical.FLOPPY_BYTES_PER_SECTOR))
+        volume = logical.LogicalVolume(disk)
+        root_block = volume.root_block()
+        root_size = root_block.block_size()
+        root_block.sector().set_u32_at(root_size + logical.ROOT_BLOCK_SIZE_OFFSET_BITMAP_FLAG,
+                                       0xffffffff)
+        bitmap_blocknums = [root_block.blocknum + 1 + i for i in range(27)]
+        for i in range(25):
+            root_block.sector().set_u32_at(root_size + logical.ROOT_BLOCK_SIZE_OFFSET_BITMAP_PAGES + i * 4,
+                                           bitmap_blocknums[i])
+        ext_blocknum = bitmap_blocknums[-1] + 1
+        root_block.sector().set_u32_at(root_size + logical.ROOT_BLOCK_SIZE_OFFSET_BITMAP_EXT,
+                                       ext_blocknum)
+        disk.sector(ext_blocknum).set_u32_at(0, bitmap_blocknums[25])
+        disk.sector(ext_blocknum).set_u32_at(4, bitmap_blocknums[26])
+        for blocknum in bitmap_blocknums:
+            bitmap = disk.sector(blocknum)
+            for offset in range(4, bitmap.size_in_bytes(), 4):
+                bitmap.set_u32_at(offset, 0xffffffff)
+
+        self.assertEqual(bitmap_blocknums, root_block.bitmap_block_numbers())
+        allocator = volume.allocator()
+        self.assertEqual(num_blocks - 2, allocator.num_free_blocks())
+
+        disk.dirty.clear()
+        last_block = num_blocks - 1
+        allocator.allocate(last_block)
+        allocator.sync()
+        # only the last bitmap block is touched
+        self.assertEqual([bitmap_blocknums[26]], disk.dirty_sectors())
+        bitmap_block = logical.BitmapBlock(volume, bitmap_blocknums[26])
+        self.assertEqual(bitmap_block.stored_checksum(), bitmap_block.computed_checksum())
+        self.assertEqual(0x7fffffff, disk.sector(bitmap_blocknums[26]).u32_at(root_size - 4))
+
+        # reload from disk
+        allocator = logical.BlockAllocator(volume)
+        self.assertFalse(allocator.is_free(last_block))
+        self.assertTrue(allocator.is_free(last_block - 1))
+
+    def test_header_cache(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk, header_cache_size=2)
+        header = volume.header_block_at(980)
+        self.assertEqual("failat", header.name())
+        self.assertEqual(1028, header.file_size())
+        self.assertEqual(880, header.parent())
+        self.assertEqual(1, volume.header_cache.misses)
+        self.assertEqual(2, volume.header_cache.hits)
+        self.assertTrue(volume.header_record(980) is volume.header_record(980))
+
+        # the cache is bounded
+        volume.header_block_at(887).name()
+        volume.header_block_at(1117).name()
+        self.assertEqual([887, 1117], list(volume.header_cache.records.keys()))
+
+    def test_header_cache_invalidate_on_write(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        header = volume.header_block_at(980)
+        self.assertEqual(880, header.parent())
+        header.set_parent(887)
+        self.assertEqual(887, header.parent())
+        header._set_name("FailAt")
+        self.assertEqual("FailAt", header.name())
+
+    def test_write_listeners_released(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        for i in range(10):
+            logical.LogicalVolume(disk).root_block().name()
+        gc.collect()
+        # the volumes that are gone are no longer notified
+        volume.makedir("newdir")
+        self.assertEqual(1, len(disk.write_listeners))
+        self.assertEqual(volume.root_block().blocknum, volume.header_for_path("newdir").parent())
+
+    def test_path_cache(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        self.assertEqual(979, volume.header_for_path("c/dir").blocknum)
+        self.assertEqual(979, volume.header_for_path("C/DIR").blocknum)
+        self.assertEqual(887, volume.header_for_path("/c").blocknum)
+        self.assertEqual({'hits': 2, 'misses': 1, 'entries': 2}, volume.path_cache.stats())
+
+        # negative entries
+        with self.assertRaises(Exception):
+            volume.header_for_path("c/nothere")
+        with self.assertRaises(Exception):
+            volume.header_for_path("C/NotHere")
+        self.assertEqual(3, volume.path_cache.stats()['hits'])
+        self.assertIsNone(volume.path_cache.entries[('C', 'NOTHERE')])
+
+    def test_path_cache_makedir_delete(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        with self.assertRaises(Exception):
+            volume.header_for_path("c/newdir")
+        volume.makedir("c/newdir")
+        newdir = volume.header_for_path("c/newdir")
+        self.assertEqual("newdir", newdir.name())
+        self.assertEqual(887, newdir.parent())
+
+        volume.delete("c/newdir")
+        with self.assertRaises(Exception):
+            volume.header_for_path("c/newdir")
+
+    def test_data_blocks_extension(self):
+        """a file that needs an extension block"""
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        header = volume.header_for_path("Prefs/Preferences")
+        self.assertEqual(1, len(header.extension_blocks()))
+        data_blocks = header.data_blocks()
+        self.assertEqual(117, len(data_blocks))
+        self.assertEqual(list(range(1, 118)),
+                         [volume.data_block_at(b).seq_num() for b in data_blocks])
+        self.assertEqual(56628, len(volume.file_data("Prefs/Preferences")))
+
+    def test_open_file(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        data = bytes(volume.file_data("Prefs/Preferences"))
+        with volume.open("prefs/preferences") as reader:
+            self.assertEqual(data[0:10], reader.read(10))
+            self.assertEqual(10, reader.tell())
+            # read across the header/extension block boundary
+            reader.seek(72 * 488 - 5)
+            self.assertEqual(data[72 * 488 - 5:72 * 488 + 600], reader.read(605))
+            reader.seek(-4, io.SEEK_END)
+            self.assertEqual(data[-4:], reader.read())
+            self.assertEqual(b'', reader.read(10))
+
+            buffer = bytearray(1000)
+            reader.seek(100)
+            self.assertEqual(1000, reader.readinto(buffer))
+            self.assertEqual(data[100:1100], bytes(buffer))
+
+            reader.seek(0)
+            chunks = list(reader.chunks())
+            self.assertEqual(117, len(chunks))
+            self.assertTrue(all(isinstance(chunk, memoryview) for chunk in chunks))
+            self.assertEqual(data, b''.join(chunks))
+
+    def test_ffs_extents(self):
+        """consecutive FFS data blocks are read as a single chunk"""
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        disk[3] = logical.BOOT_BLOCK_FLAG_FFS
+        volume = logical.LogicalVolume(disk)
+        # turn failat into a 5 block FFS file in the blocks 100-102 and 200-201
+        header = volume.header_block_at(980)
+        sector = header.sector()
+        blocks = [100, 101, 102, 200, 201]
+        for i, blocknum in enumerate(blocks):
+            sector.set_u32_at(512 - logical.DATABLOCK_OFFSET - i * 4, blocknum)
+        sector.set_u32_at(logical.HEADER_BLOCK_OFFSET_HIGH_SEQ, len(blocks))
+        file_size = 4 * 512 + 17
+        sector.set_u32_at(512 + logical.HEADER_BLOCK_SIZE_OFFSET_BYTE_SIZE, file_size)
+        expected = bytes(disk.data[100 * 512:103 * 512]) + bytes(disk.data[200 * 512:200 * 512 + 529])
+
+        with volume.open("failat") as reader:
+            self.assertEqual([(0, 100, 3), (3, 200, 2)], list(reader.extents()))
+            chunks = list(reader.chunks())
+            self.assertEqual([3 * 512, 529], [len(chunk) for chunk in chunks])
+            self.assertEqual(expected, b''.join(chunks))
+            reader.seek(700)
+            self.assertEqual([3 * 512 - 700, 529], [len(chunk) for chunk in reader.chunks()])
+            reader.seek(1000)
+            self.assertEqual(expected[1000:2000], reader.read(1000))
+            reader.seek(0)
+            out = io.BytesIO()
+            self.assertEqual(file_size, reader.copy_to(out))
+            self.assertEqual(expected, out.getvalue())
+        self.assertEqual(expected, bytes(volume.file_data("failat")))
+
+    def test_open_directory(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        with self.assertRaises(Exception):
+            volume.open("c")
+
+    def test_format_volume(self):
+        disk = physical.DoubleDensityDisk()
+        volume = logical.LogicalVolume(disk)
+        volume.initialize(fs_type="OFS", name="Test")
+        root_block = volume.root_block()
+        self.assertEqual("Test", root_block.name())
+        self.assertEqual(logical.BLOCK_SEC_TYPE_ROOT, root_block.secondary_type())
+        self.assertEqual(72, root_block.hashtable_size())
+        self.assertEqual(root_block.stored_checksum(), root_block.computed_checksum())
+        self.assertTrue(root_block.is_empty())
+        self.assertEqual([881], root_block.bitmap_block_numbers())
+        self.assertEqual(physical.DDD_SECTORS_TOTAL - 4, volume.allocator().num_free_blocks())
+
+        # all the bitmap blocks of a larger volume have valid checksums
+        disk = physical.HardDisk(bytearray(20000 * physical.FLOPPY_BYTES_PER_SECTOR))
+        volume = logical.LogicalVolume(disk)
+        volume.initialize(fs_type="FFS")
+        bitmap_blocks = volume.root_block().bitmap_blocks()
+        self.assertEqual(5, len(bitmap_blocks))
+        for bitmap_block in bitmap_blocks:
+            self.assertEqual(bitmap_block.stored_checksum(), bitmap_block.computed_checksum())
+
+    def test_large_blocks(self):
+        for block_size, fs_type, file_size in [(1024, "OFS", 300000), (4096, "FFS", 4500000)]:
+            disk = physical.HardDisk(bytearray(2000 * block_size), block_size=block_size)
+            volume = logical.LogicalVolume(disk)
+            volume.initialize(fs_type=fs_type, is_international=True, use_dircache=True)
+            root_block = volume.root_block()
+            self.assertEqual(1000, root_block.blocknum)
+            self.assertEqual(block_size // 4 - 56, root_block.hashtable_size())
+            volume.makedir("dir")
+            data = bytes(i % 251 for i in range(file_size))
+            header = volume.write_file("dir/data.bin", data)
+            self.assertEqual(block_size // 4 - 56, header.hashtable_size())
+            self.assertEqual(block_size, header.block_size())
+            self.assertTrue(len(header.extension_blocks()) > 0)
+            self.assertEqual(header.stored_checksum(), header.computed_checksum())
+            self.assertEqual(data, bytes(volume.file_data("DIR/Data.bin")))
+            self.assertEqual(["data.bin"], [entry.name for entry in
+                                            volume.directory_entries(volume.header_for_path("dir"))])
+            self.assertTrue(fsck.check_volume(volume).is_clean())
+
+    def test_write_file(self):
+        for fs_type in ["OFS", "FFS"]:
+            disk = physical.DoubleDensityDisk()
+            volume = logical.LogicalVolume(disk)
+            volume.initialize(fs_type=fs_type)
+            volume.makedir("dir")
+            data = bytes(i % 251 for i in range(100000))
+            modified = datetime(2023, 11, 26, 11, 32)
+            header = volume.write_file("dir/data.bin", data, modified=modified)
+            self.assertTrue(header.is_file())
+            self.assertEqual(header.stored_checksum(), header.computed_checksum())
+            self.assertEqual(modified, header.last_modification_time())
+            self.assertTrue(len(header.extension_blocks()) > 0)
+            self.assertEqual(data, bytes(volume.file_data("dir/data.bin")))
+            # data blocks are contiguous
+            data_blocks = header.data_blocks()
+            self.assertEqual(list(range(data_blocks[0], data_blocks[0] + len(data_blocks))),
+                             data_blocks)
+            # reopened from the written data
+            volume2 = logical.LogicalVolume(disk)
+            self.assertEqual(data, bytes(volume2.file_data("DIR/DATA.BIN")))
+            self.assertEqual(physical.DDD_SECTORS_TOTAL - 5 - volume.blocks_for_file(len(data)),
+                             volume2.allocator().num_free_blocks())
+
+            # replace the file
+            volume.write_file("dir/data.bin", b'hello')
+            self.assertEqual(b'hello', bytes(volume.file_data("dir/data.bin")))
+            self.assertEqual(physical.DDD_SECTORS_TOTAL - 5 - volume.blocks_for_file(5),
+                             volume.allocator().num_free_blocks())
+            volume.write_file("empty", b'')
+            self.assertEqual(b'', bytes(volume.file_data("empty")))
+
+    def test_write_file_errors(self):
+        disk = physical.DoubleDensityDisk()
+        volume = logical.LogicalVolume(disk)
+        volume.initialize(fs_type="FFS")
+        volume.makedir("dir")
+        with self.assertRaises(Exception):
+            volume.write_file("dir", b'data')
+        with self.assertRaises(Exception):
+            volume.write_file("nodir/file", b'data')
+        with self.assertRaises(Exception):
+            volume.write_file("x" * 31, b'data')
+        with self.assertRaises(Exception):
+            volume.write_file("big", bytes(physical.DDD_IMAGE_SIZE))
+
+    def test_import_tree(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, "c"))
+            os.makedirs(os.path.join(tmpdir, "s", "sub"))
+            files = {"c/cmd%d" % i: bytes([i]) * (i * 100) for i in range(20)}
+            files["s/startup-sequence"] = b'echo hello\n'
+            files["s/sub/deep"] = b'deep'
+            for path, data in files.items():
+                with open(os.path.join(tmpdir, path), "wb") as outfile:
+                    outfile.write(data)
+
+            disk = physical.DoubleDensityDisk()
+            volume = logical.LogicalVolume(disk)
+            volume.initialize(fs_type="OFS")
+            volume.makedir("s")
+            self.assertEqual(len(files) + 3, volume.import_tree(tmpdir, "/"))
+
+            volume2 = logical.LogicalVolume(disk)
+            for path, data in files.items():
+                self.assertEqual(data, bytes(volume2.file_data(path)))
+            for path in ["/", "c", "s", "s/sub"]:
+                header = volume2.header_for_path(path)
+                self.assertEqual(header.stored_checksum(), header.computed_checksum())
+            bitmap_block = volume2.root_block().bitmap_blocks()[0]
+            self.assertEqual(bitmap_block.stored_checksum(), bitmap_block.computed_checksum())
+
+            # a file that already exists is detected before anything is written
+            disk.dirty.clear()
+            with self.assertRaises(Exception):
+                volume2.import_tree(tmpdir, "/")
+            self.assertEqual([], disk.dirty_sectors())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_import_tree_case_collision(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, "s"))
+            for name in ["a", "s/Foo", "s/foo"]:
+                with open(os.path.join(tmpdir, name), "wb") as outfile:
+                    outfile.write(b'data')
+            disk = physical.DoubleDensityDisk()
+            volume = logical.LogicalVolume(disk)
+            volume.initialize(fs_type="FFS")
+            disk.dirty.clear()
+            image = bytes(disk.data)
+            with self.assertRaises(Exception):
+                volume.import_tree(tmpdir, "/")
+            self.assertEqual(image, bytes(disk.data))
+            self.assertTrue(fsck.check_volume(logical.LogicalVolume(disk)).is_clean())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_extract_tree_invalid_names(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ["../../evil", "/abs"]:
+                volume = logical.LogicalVolume(physical.DoubleDensityDisk())
+                volume.initialize(fs_type="FFS")
+                volume.makedir("d")
+                header = volume.write_file("d/x", b'evil')
+                # names read from a crafted image can contain anything
+                header._set_name(name)
+                header.update_checksum()
+                volume.header_cache.clear()
+                dest = os.path.join(tmpdir, "a", "b", "dest")
+                with self.assertRaises(Exception):
+                    volume.extract_tree("/", dest)
+                self.assertFalse(os.path.exists(os.path.join(tmpdir, "a", "b", "evil")))
+                self.assertFalse(os.path.exists(os.path.join(dest, "d", "x")))
+            self.assertFalse(os.path.exists("/abs"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_extract_tree(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile, readonly=True)
+        volume = logical.LogicalVolume(disk)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(9, volume.extract_tree("s", tmpdir, max_workers=2))
+            names = sorted(os.listdir(os.path.join(tmpdir, "s")))
+            self.assertEqual(["CLI-Startup", "DPAT", "PCD", "SPAT", "Shell-Startup",
+                              "Startup-Sequence", "Startup-Sequence.HD", "StartupII"], names)
+            for name in names:
+                with open(os.path.join(tmpdir, "s", name), "rb") as infile:
+                    self.assertEqual(bytes(volume.file_data("s/" + name)), infile.read())
+            header = volume.header_for_path("s/Startup-Sequence")
+            self.assertEqual(header.last_modification_time().timestamp(),
+                             os.path.getmtime(os.path.join(tmpdir, "s", "Startup-Sequence")))
+
+            # a single file is extracted into the destination directory
+            self.assertEqual(1, volume.extract_tree("Prefs/Preferences", tmpdir))
+            self.assertEqual(56628, os.path.getsize(os.path.join(tmpdir, "Preferences")))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_scandir(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile, readonly=True)
+        volume = logical.LogicalVolume(disk)
+        entries = {entry.name: entry for entry in volume.scandir("s")}
+        self.assertEqual(8, len(entries))
+        entry = entries["Startup-Sequence"]
+        self.assertEqual("s/Startup-Sequence", entry.path)
+        self.assertTrue(entry.is_file())
+        self.assertFalse(entry.is_dir())
+        header = volume.header_for_path("s/Startup-Sequence")
+        self.assertEqual(header.blocknum, entry.blocknum)
+        self.assertEqual(header.file_size(), entry.size)
+        self.assertEqual(header.last_modification_time(), entry.last_modification_time())
+        self.assertEqual(header.blocknum, entry.header().blocknum)
+        self.assertTrue(all(e.is_dir() for e in volume.scandir("/") if e.name in ["c", "devs", "s"]))
+        with self.assertRaises(Exception):
+            volume.scandir("s/Startup-Sequence")
+
+        entries = list(volume.walk())
+        self.assertEqual(183, len([e for e in entries if e.is_file()]))
+        self.assertEqual(25, len([e for e in entries if e.is_dir()]))
+        self.assertEqual([path for path, record in volume.iter_tree()], [e.path for e in entries])
+
+    def test_find(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile, readonly=True)
+        volume = logical.LogicalVolume(disk)
+        query = logical.FindQuery(name="#?.library")
+        paths = sorted(entry.path for entry in volume.find(query))
+        self.assertEqual(9, len(paths))
+        self.assertTrue(all(path.startswith("libs/") for path in paths))
+
+        query = logical.FindQuery(pattern="libs/#?.library", min_size=12000)
+        self.assertEqual(["libs/info.library", "libs/mathieeedoubtrans.library"],
+                         sorted(entry.path for entry in volume.find(query)))
+        query = logical.FindQuery(pattern="s/~(startup#?)", entry_type='file')
+        self.assertEqual(["s/CLI-Startup", "s/DPAT", "s/PCD", "s/SPAT", "s/Shell-Startup"],
+                         sorted(entry.path for entry in volume.find(query)))
+        query = logical.FindQuery(entry_type='dir')
+        self.assertEqual(25, len(list(volume.find(query))))
+        query = logical.FindQuery(name="startup-sequence")
+        self.assertEqual(["s/Startup-Sequence"], [entry.path for entry in volume.find(query, "s")])
+
+        header = volume.header_for_path("s/Startup-Sequence")
+        modified = header.last_modification_time()
+        query = logical.FindQuery(pattern="s/#?", after=modified)
+        self.assertTrue("s/Startup-Sequence" not in [entry.path for entry in volume.find(query)])
+        query = logical.FindQuery(pattern="s/#?", before=modified)
+        self.assertTrue("s/Startup-Sequence" not in [entry.path for entry in volume.find(query)])
+        with self.assertRaises(Exception):
+            logical.FindQuery(entry_type='link')
+
+    def test_scandir_hash_chains(self):
+        for use_dircache in [False, True]:
+            disk = physical.DoubleDensityDisk()
+            volume = logical.LogicalVolume(disk)
+            volume.initialize(fs_type="FFS", is_international=use_dircache, use_dircache=use_dircache)
+            volume.makedir("dir")
+            # more entries than hash table slots
+            names = ["file%03d" % i for i in range(100)]
+            for name in names:
+                volume.write_file("dir/" + name, b'x')
+            self.assertEqual(sorted(names), sorted(entry.name for entry in volume.scandir("dir")))
+            self.assertEqual(["dir"] + ["dir/" + name for name in sorted(names)],
+                             sorted(entry.path for entry in volume.walk()))
+
+    def test_international_names(self):
+        for is_international in [False, True]:
+            disk = physical.DoubleDensityDisk()
+            volume = logical.LogicalVolume(disk)
+            volume.initialize(fs_type="FFS", is_international=is_international)
+            self.assertEqual(is_international, volume.is_international())
+            volume.write_file("\xe4rger", b'data')
+            self.assertEqual(b'data', volume.file_data("\xe4RGER"))
+            self.assertEqual(is_international, volume._child_exists(volume.root_block(), "\xc4RGER"))
+            header = volume.header_for_path("\xe4rger")
+            self.assertEqual(util.compute_hash("\xe4rger", 512, is_international),
+                             volume.root_block().record().hashtable.index(header.blocknum))
+            volume.delete("\xe4rger")
+            self.assertTrue(volume.root_block().is_empty())
+
+    def test_dircache(self):
+        disk = physical.DoubleDensityDisk()
+        volume = logical.LogicalVolume(disk)
+        volume.initialize(fs_type="FFS", is_international=True, use_dircache=True)
+        self.assertTrue(volume.uses_dircache())
+        self.assertEqual(1, len(volume.dircache_blocks(volume.root_block())))
+        self.assertEqual([], volume.directory_entries(volume.root_block()))
+
+        volume.makedir("dir")
+        names = ["file_with_a_long_name_%02d" % i for i in range(50)]
+        for i, name in enumerate(names):
+            volume.write_file("dir/" + name, bytes(i))
+        dir_header = volume.header_for_path("dir")
+        cache_blocks = volume.dircache_blocks(dir_header)
+        self.assertTrue(len(cache_blocks) > 1)
+        for blocknum in cache_blocks:
+            cache_block = logical.DirCacheBlock(volume, blocknum)
+            self.assertEqual([True], util.valid_checksums(cache_block.sector().data, 512))
+        entries = volume.directory_entries(dir_header)
+        self.assertEqual(sorted(names), sorted(entry.name for entry in entries))
+        sizes = {entry.name: entry.file_size for entry in entries}
+        self.assertEqual(7, sizes[names[7]])
+
+        # the root's entry of "dir" has the modification time of the directory
+        root_entries = volume.directory_entries(volume.root_block())
+        self.assertEqual(["dir"], [entry.name for entry in root_entries])
+        self.assertEqual(dir_header.last_modification_time(), root_entries[0].last_modification_time())
+        self.assertEqual(logical.BLOCK_SEC_TYPE_USERDIR, root_entries[0].secondary_type)
+
+        # replacing and deleting files updates the cache
+        volume.write_file("dir/" + names[7], bytes(1000))
+        for name in names[10:]:
+            volume.delete("dir/" + name)
+        entries = volume.directory_entries(dir_header)
+        self.assertEqual(sorted(names[0:10]), sorted(entry.name for entry in entries))
+        self.assertEqual(1000, {entry.name: entry.file_size for entry in entries}[names[7]])
+        self.assertTrue(len(volume.dircache_blocks(dir_header)) < len(cache_blocks))
+
+        # the same listing without the cache
+        cached = sorted((entry.name, entry.file_size, entry.blocknum) for entry in entries)
+        disk.data[3] = 1
+        self.assertFalse(volume.uses_dircache())
+        self.assertEqual(cached, sorted((entry.name, entry.file_size, entry.blocknum)
+                                        for entry in volume.directory_entries(dir_header)))
+        disk.data[3] = 5
+
+        free_blocks = volume.allocator().num_free_blocks()
+        dir_blocks = volume.tree_blocks(dir_header.record())
+        for blocknum in volume.dircache_blocks(dir_header):
+            self.assertTrue(blocknum in dir_blocks)
+        volume.delete("dir", recursive=True)
+        self.assertEqual(free_blocks + len(dir_blocks), volume.allocator().num_free_blocks())
+        self.assertEqual([], volume.directory_entries(volume.root_block()))
+
 
 if __name__ == '__main__':
     SUITE = []
@@ -5,7 +5,54 @@
 import unittest
 import xmlrunner
 import sys
+import io
+import mmap
+import os
+import shutil
+import struct
+import tempfile
 from amigados.adftools import physical
+from amigados.adftools import logical
+
+
+def set_rdb_checksum(data, offset):
+    """sets the checksum of the RDB block at offset, so the long words sum up to 0"""
+    num_longs = struct.unpack_from(">I", data, offset + 4)[0]
+    struct.pack_into(">I", data, offset + 8, 0)
+    longs = struct.unpack_from(">%dI" % num_longs, data, offset)
+    struct.pack_into(">I", data, offset + 8, -sum(longs) & 0xffffffff)
+
+
+def make_rdb_image(sectors_per_block=1):
+    """creates a hard disk image with a Rigid Disk Block and two partitions,
+    the second one contains the Workbench disk"""
+    bpc = 2 * 11  # 2 surfaces, 11 blocks per track
+    data = bytearray(82 * bpc * 512)
+    data[0:4] = b'RDSK'
+    struct.pack_into(">IIIII", data, 4, 64, 0, 7, 512, 0)
+    struct.pack_into(">I", data, physical.RDB_OFFSET_PARTITION_LIST, 1)
+    struct.pack_into(">III", data, physical.RDB_OFFSET_CYLINDERS, 82, 11, 2)
+    set_rdb_checksum(data, 0)
+
+    partitions = [(1, b'DH0', 1, 1, 0x444f5301), (2, b'DH1', 2, 81, 0x444f5300)]
+    for index, (blocknum, name, low_cyl, high_cyl, dos_type) in enumerate(partitions):
+        offset = blocknum * 512
+        data[offset:offset + 4] = b'PART'
+        struct.pack_into(">III", data, offset + 4, 64, 0, 7)
+        next_block = partitions[index + 1][0] if index + 1 < len(partitions) else 0xffffffff
+        struct.pack_into(">II", data, offset + physical.PART_OFFSET_NEXT, next_block,
+                         physical.PART_FLAG_BOOTABLE if index == 1 else 0)
+        data[offset + physical.PART_OFFSET_DRIVE_NAME] = len(name)
+        data[offset + physical.PART_OFFSET_DRIVE_NAME + 1:
+             offset + physical.PART_OFFSET_DRIVE_NAME + 1 + len(name)] = name
+        env = [16, 128, 0, 2, sectors_per_block, 11, 2, 0, 0, low_cyl, high_cyl, 30, 0, 0xffffff, 0x7ffffffe, 0, dos_type]
+        struct.pack_into(">17I", data, offset + physical.PART_OFFSET_ENVIRONMENT, *env)
+        set_rdb_checksum(data, offset)
+
+    with open("testdata/wbench1.3.adf", "rb") as infile:
+        adf = infile.read()
+    data[2 * bpc * 512:2 * bpc * 512 + len(adf)] = adf
+    return data
 
 
 class ADFToolsPhysicalTest(unittest.TestCase):  # pylint: disable-msg=R0904
@@ -55,6 +102,224 @@ class ADFToolsPhysicalTest(unittest.TestCase):  # pylint: disable-msg=R0904
 
         self.assertEqual(0x08154711, disk.i32_at(0))
 
+    def test_read_adf_image_mmap(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile, readonly=True)
+        self.assertTrue(isinstance(disk, physical.DoubleDensityDisk))
+        self.assertTrue(isinstance(disk.data, mmap.mmap))
+        self.assertEqual(physical.DDD_SECTORS_TOTAL, disk.num_sectors())
+        self.assertEqual(ord('D'), disk.sector(0)[0])
+        with self.assertRaises(TypeError):
+            disk.sector(0)[0] = 0
+
+    def test_read_adf_image_copy_on_write(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "test.adf")
+            shutil.copy("testdata/wbench1.3.adf", path)
+            with open(path, "rb") as infile:
+                disk = physical.read_adf_image(infile)
+            sector = disk.sector(2)
+            sector.set_u32_at(0, 0x08154711)
+            self.assertEqual(0x08154711, disk.u32_at(2 * physical.FLOPPY_BYTES_PER_SECTOR))
+            # the file itself is not modified
+            with open(path, "rb") as infile:
+                disk2 = physical.read_adf_image(infile)
+            self.assertNotEqual(0x08154711, disk2.u32_at(2 * physical.FLOPPY_BYTES_PER_SECTOR))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_dirty_sectors(self):
+        disk = physical.DoubleDensityDisk()
+        self.assertEqual([], disk.dirty_sectors())
+        disk.sector(3)[0] = 1
+        disk.sector(4).set_u32_at(4, 0x4711)
+        disk.sector(10).clear_data()
+        disk[physical.FLOPPY_BYTES_PER_SECTOR * 20 + 7] = 1
+        self.assertEqual([3, 4, 10, 20], disk.dirty_sectors())
+        self.assertEqual([(3 * 512, 5 * 512), (10 * 512, 11 * 512), (20 * 512, 21 * 512)],
+                         disk.dirty_ranges())
+
+    def test_write_dirty(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "test.adf")
+            shutil.copy("testdata/wbench1.3.adf", path)
+            with open(path, "rb") as infile:
+                disk = physical.read_adf_image(infile)
+            disk.sector(2).set_u32_at(0, 0x08154711)
+            disk.sector(1700).set_u32_at(8, 0x47110815)
+            with open(path, "r+b") as outfile:
+                num_bytes = disk.write_dirty(outfile, fsync=True)
+            self.assertEqual(2 * physical.FLOPPY_BYTES_PER_SECTOR, num_bytes)
+            self.assertEqual([], disk.dirty_sectors())
+            self.assertEqual(physical.DDD_IMAGE_SIZE, os.path.getsize(path))
+
+            with open(path, "rb") as infile:
+                disk2 = physical.read_adf_image(infile)
+            self.assertEqual(0x08154711, disk2.sector(2).u32_at(0))
+            self.assertEqual(0x47110815, disk2.sector(1700).u32_at(8))
+            with open("testdata/wbench1.3.adf", "rb") as infile:
+                orig = infile.read()
+            self.assertEqual(orig[0:1024], disk2.data[0:1024])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_transaction_rollback(self):
+        disk = physical.DoubleDensityDisk()
+        disk.sector(5).set_u32_at(0, 1)
+        disk.begin()
+        with self.assertRaises(Exception):
+            disk.begin()
+        disk.sector(5).set_u32_at(0, 2)
+        disk.sector(6).set_u32_at(4, 3)
+        disk.write_at(7 * 512 + 510, b'abcd')
+        self.assertEqual([5, 6, 7, 8], disk.dirty_sectors())
+        self.assertEqual(sorted([5, 6, 7, 8]), sorted(disk.rollback()))
+        self.assertEqual(1, disk.sector(5).u32_at(0))
+        self.assertEqual(0, disk.sector(6).u32_at(4))
+        self.assertEqual(bytes(1024), bytes(disk.data[7 * 512:9 * 512]))
+        self.assertEqual([5], disk.dirty_sectors())
+        self.assertFalse(disk.in_transaction())
+
+        disk.begin()
+        disk.sector(5).set_u32_at(0, 2)
+        disk.commit()
+        self.assertEqual(2, disk.sector(5).u32_at(0))
+        with self.assertRaises(Exception):
+            disk.rollback()
+
+    def test_write_dirty_atomic(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "test.adf")
+            shutil.copy("testdata/wbench1.3.adf", path)
+            with open(path, "rb") as infile:
+                disk = physical.read_adf_image(infile)
+            disk.sector(2).set_u32_at(0, 0x08154711)
+            self.assertEqual(512, disk.write_dirty_atomic(path))
+            self.assertFalse(os.path.exists(path + physical.JOURNAL_SUFFIX))
+            self.assertFalse(physical.recover_journal(path))
+
+            # a journal left behind by an interrupted update is applied ...
+            disk.sector(3).set_u32_at(0, 0x47110815)
+            disk.write_dirty_atomic(path)
+            shutil.copy(path, path + ".new")
+            shutil.copy("testdata/wbench1.3.adf", path)
+            disk.sector(2).set_u32_at(0, 0x08154711)
+            disk.sector(3).set_u32_at(0, 0x47110815)
+            # simulate the crash by writing the journal without applying it
+            real_write_dirty = disk.write_dirty
+            disk.write_dirty = lambda outfile, fsync: 1 / 0
+            with self.assertRaises(ZeroDivisionError):
+                disk.write_dirty_atomic(path)
+            disk.write_dirty = real_write_dirty
+            # tools that only read see the update, the file is left alone
+            pending = physical.read_adf_image_file(path, readonly=True)
+            self.assertEqual(0x47110815, pending.sector(3).u32_at(0))
+            self.assertEqual(0x08154711, physical.read_adf_image_file(path).sector(2).u32_at(0))
+            self.assertTrue(os.path.exists(path + physical.JOURNAL_SUFFIX))
+            with open("testdata/wbench1.3.adf", "rb") as original, open(path, "rb") as infile:
+                self.assertEqual(original.read(), infile.read())
+            self.assertTrue(physical.recover_journal(path))
+            with open(path, "rb") as infile, open(path + ".new", "rb") as expected:
+                self.assertEqual(expected.read(), infile.read())
+
+            # ... an incomplete one is discarded
+            with open(path + physical.JOURNAL_SUFFIX, "wb") as journal:
+                journal.write(physical.JOURNAL_MAGIC + bytes(100))
+            self.assertFalse(physical.recover_journal(path))
+            self.assertFalse(os.path.exists(path + physical.JOURNAL_SUFFIX))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_write_image(self):
+        disk = physical.DoubleDensityDisk()
+        disk[5] = 1
+        out = io.BytesIO()
+        disk.write_image(out)
+        self.assertEqual(physical.DDD_IMAGE_SIZE, len(out.getvalue()))
+        self.assertEqual(1, out.getvalue()[5])
+        self.assertEqual([], disk.dirty_sectors())
+
+    def test_no_rigid_disk_block(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile, readonly=True)
+        self.assertIsNone(physical.read_rigid_disk_block(disk))
+
+    def test_rigid_disk_block(self):
+        disk = physical.read_adf_image(io.BytesIO(make_rdb_image()))
+        rdb = physical.read_rigid_disk_block(disk)
+        self.assertEqual(0, rdb.blocknum)
+        self.assertEqual(82, rdb.cylinders)
+        partitions = rdb.partitions()
+        self.assertEqual(["DH0", "DH1"], [p.name for p in partitions])
+        dh1 = rdb.partition("dh1")
+        self.assertEqual(44, dh1.start_block())
+        self.assertEqual(physical.DDD_SECTORS_TOTAL, dh1.num_blocks())
+        self.assertEqual(512, dh1.block_size)
+        self.assertEqual(2, dh1.reserved)
+        self.assertTrue(dh1.is_bootable())
+        self.assertEqual("DOS\\0", dh1.dos_type_str())
+
+    def test_partition_volume(self):
+        disk = physical.read_adf_image(io.BytesIO(make_rdb_image()))
+        rdb = physical.read_rigid_disk_block(disk)
+        part_volume = rdb.partition_volume("DH1")
+        self.assertEqual(physical.DDD_SECTORS_TOTAL, part_volume.num_sectors())
+        volume = logical.LogicalVolume(part_volume)
+        self.assertTrue(volume.boot_block().is_dos())
+        self.assertEqual("Workbench1.3", volume.root_block().name())
+
+        # modifications are visible and tracked in the disk
+        part_volume.sector(3).set_u32_at(0, 0x4711)
+        self.assertEqual(0x4711, disk.sector(44 + 3).u32_at(0))
+        self.assertEqual([44 + 3], disk.dirty_sectors())
+        self.assertEqual([3], part_volume.dirty_sectors())
+
+    def test_partition_volume_large_blocks(self):
+        disk = physical.read_adf_image(io.BytesIO(make_rdb_image(sectors_per_block=8)))
+        rdb = physical.read_rigid_disk_block(disk)
+        self.assertEqual(4096, rdb.partition("DH1").block_size)
+        part_volume = rdb.partition_volume("DH1")
+        self.assertEqual(4096, part_volume.block_size)
+        self.assertEqual(physical.DDD_SECTORS_TOTAL // 8, part_volume.num_sectors())
+        self.assertEqual(4096, part_volume.sector(3).size_in_bytes())
+
+        # a block covers 8 sectors of the disk
+        part_volume.sector(3).set_u32_at(4092, 0x4711)
+        self.assertEqual(0x4711, disk.sector(44 + 3 * 8 + 7).u32_at(508))
+        self.assertEqual(list(range(44 + 24, 44 + 32)), disk.dirty_sectors())
+        self.assertEqual([3], part_volume.dirty_sectors())
+
+        before = bytes(part_volume.sector(5).data)
+        part_volume.begin()
+        part_volume.sector(5).write_at(0, b'\xff' * 4096)
+        self.assertEqual([5], part_volume.rollback())
+        self.assertEqual(before, bytes(part_volume.sector(5).data))
+        self.assertEqual([3], part_volume.dirty_sectors())
+
+    def test_unsupported_block_size(self):
+        with self.assertRaises(Exception):
+            physical.HardDisk(bytearray(4096), block_size=1000)
+        with self.assertRaises(Exception):
+            physical.HardDisk(bytearray(65536), block_size=65536)
+
+    def test_read_adf_image_stream(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(io.BytesIO(infile.read()))
+        self.assertTrue(isinstance(disk.data, bytearray))
+        self.assertEqual(ord('D'), disk[0])
+
+    def test_read_hdf_image(self):
+        disk = physical.read_adf_image(io.BytesIO(bytes(physical.FLOPPY_BYTES_PER_SECTOR * 4000)))
+        self.assertTrue(isinstance(disk, physical.HardDisk))
+        self.assertEqual(4000, disk.num_sectors())
+
+    def test_read_adf_image_wrong_size(self):
+        with self.assertRaises(Exception):
+            physical.read_adf_image(io.BytesIO(bytes(100)))
+
 
 if __name__ == '__main__':
     SUITE = []
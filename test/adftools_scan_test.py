@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""adftools_scan_test.py"""
+
+import unittest
+import xmlrunner
+import sys
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from amigados.adftools import logical
+from amigados.adftools import scan
+
+
+class ADFToolsScanTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for scan module"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_scan_image(self):
+        result = scan.scan_image("testdata/wbench1.3.adf")
+        self.assertEqual(901120, result['size'])
+        self.assertEqual(1, len(result['volumes']))
+        volume = result['volumes'][0]
+        self.assertEqual("Workbench1.3", volume['name'])
+        self.assertEqual("OFS", volume['filesystem'])
+        self.assertTrue("c" in volume['dirs'])
+        self.assertTrue({'path': "Prefs/Preferences", 'size': 56628} in volume['files'])
+
+    def test_scan_invalid_image(self):
+        path = os.path.join(self.tmpdir, "broken.adf")
+        with open(path, "wb") as outfile:
+            outfile.write(b'not a disk')
+        result = scan.scan_image(path)
+        self.assertEqual(path, result['image'])
+        self.assertTrue('error' in result)
+
+    def test_scan_images_resume(self):
+        for name in ["a.adf", "b.ADF", "c.txt"]:
+            shutil.copy("testdata/wbench1.3.adf", os.path.join(self.tmpdir, name))
+        checkpoint = os.path.join(self.tmpdir, "checkpoint")
+        with open(checkpoint, "w") as outfile:
+            outfile.write(os.path.join(self.tmpdir, "a.adf") + "\n")
+
+        outfile = io.StringIO()
+        self.assertEqual(1, scan.scan_images([self.tmpdir], outfile, checkpoint, max_workers=1))
+        results = [json.loads(line) for line in outfile.getvalue().splitlines()]
+        self.assertEqual([os.path.join(self.tmpdir, "b.ADF")], [r['image'] for r in results])
+        self.assertEqual(2, len(scan.read_checkpoint(checkpoint)))
+
+        # everything is done, nothing left to scan
+        self.assertEqual(0, scan.scan_images([self.tmpdir], io.StringIO(), checkpoint))
+
+
+    def test_find_in_images(self):
+        for name in ["a.adf", "b.adf"]:
+            shutil.copyfile("testdata/wbench1.3.adf", os.path.join(self.tmpdir, name))
+        query = logical.FindQuery(pattern="libs/info.library")
+        for use_index in [False, True]:
+            results = list(scan.find_in_images([self.tmpdir], query, use_index, max_workers=2))
+            self.assertEqual([os.path.join(self.tmpdir, "a.adf"), os.path.join(self.tmpdir, "b.adf")],
+                             [image for image, matches, error in results])
+            for image, matches, error in results:
+                self.assertIsNone(error)
+                self.assertEqual([(None, "libs/info.library", 16380)], matches)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "a.adf.adfindex")))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ADFToolsScanTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+      xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+      unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
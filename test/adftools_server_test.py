@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""adftools_server_test.py"""
+
+import unittest
+import xmlrunner
+import sys
+import json
+import threading
+import urllib.error
+import urllib.request
+
+from amigados.adftools import logical
+from amigados.adftools import physical
+from amigados.adftools import server
+
+
+class ADFToolsServerTest(unittest.TestCase):  # pylint: disable-msg=R0904
+    """Test class for server module"""
+
+    def setUp(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile, readonly=True)
+        self.volume = logical.LogicalVolume(disk)
+        self.volume_fs = server.VolumeFS(self.volume, readahead=8192)
+
+    def test_stat_and_listdir(self):
+        info = self.volume_fs.stat("/Prefs/Preferences")
+        self.assertFalse(info['is_dir'])
+        self.assertEqual(56628, info['size'])
+        self.assertEqual(self.volume.header_for_path("Prefs/Preferences").last_modification_time().timestamp(),
+                         info['mtime'])
+        self.assertTrue(self.volume_fs.stat("/").get('is_dir'))
+        names = sorted(entry['name'] for entry in self.volume_fs.listdir("/s"))
+        self.assertEqual(8, len(names))
+        self.assertTrue("Startup-Sequence" in names)
+        with self.assertRaises(FileNotFoundError):
+            self.volume_fs.stat("/missing")
+        with self.assertRaises(NotADirectoryError):
+            self.volume_fs.listdir("/s/Startup-Sequence")
+
+    def test_read(self):
+        data = bytes(self.volume.file_data("Prefs/Preferences"))
+        # sequential reads are served from the readahead buffer
+        result = b''
+        while True:
+            chunk = self.volume_fs.read("/Prefs/Preferences", len(result), 1024)
+            if len(chunk) == 0:
+                break
+            result += chunk
+        self.assertEqual(data, result)
+        self.assertTrue(self.volume_fs.buffer_hits > self.volume_fs.reads // 2)
+        # random access
+        self.assertEqual(data[40000:40100], self.volume_fs.read("/prefs/preferences", 40000, 100))
+        self.assertEqual(data[56600:], self.volume_fs.read("/Prefs/Preferences", 56600, 1000))
+        with self.assertRaises(IsADirectoryError):
+            self.volume_fs.read("/s", 0, 10)
+
+    def test_http_server(self):
+        http_server = server.http_server(self.volume_fs, port=0, quiet=True)
+        thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            base_url = "http://127.0.0.1:%d" % http_server.server_address[1]
+            data = bytes(self.volume.file_data("s/Startup-Sequence"))
+            with urllib.request.urlopen(base_url + "/s/Startup-Sequence") as response:
+                self.assertEqual(data, response.read())
+
+            request = urllib.request.Request(base_url + "/s/Startup-Sequence",
+                                             headers={'Range': "bytes=10-19"})
+            with urllib.request.urlopen(request) as response:
+                self.assertEqual(206, response.status)
+                self.assertEqual(data[10:20], response.read())
+
+            with urllib.request.urlopen(base_url + "/s") as response:
+                entries = json.loads(response.read())
+            self.assertEqual(8, len(entries))
+
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(base_url + "/missing")
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+    def test_http_links(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            disk = physical.read_adf_image(infile)
+        volume = logical.LogicalVolume(disk)
+        header = volume.header_for_path("s/Startup-Sequence")
+        header.sector().set_u32_at(header.block_size() + logical.HEADER_BLOCK_SIZE_OFFSET_SECTYPE,
+                                   logical.BLOCK_SEC_TYPE_SOFTLINK & 0xffffffff)
+        header.update_checksum()
+        volume_fs = server.VolumeFS(logical.LogicalVolume(disk))
+        info = volume_fs.stat("/s/Startup-Sequence")
+        self.assertFalse(info['is_dir'] or info['is_file'])
+
+        http_server = server.http_server(volume_fs, port=0, quiet=True)
+        thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            base_url = "http://127.0.0.1:%d" % http_server.server_address[1]
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(base_url + "/s/Startup-Sequence")
+            self.assertEqual(501, context.exception.code)
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ADFToolsServerTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+      xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+      unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
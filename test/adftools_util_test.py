@@ -4,6 +4,7 @@
 
 import unittest
 import xmlrunner
+import struct
 import sys
 from datetime import datetime
 
@@ -30,6 +31,105 @@ class ADFToolsUtilTest(unittest.TestCase):  # pylint: disable-msg=R0904
         self.assertEqual(692, minutes_past_midnight)
         self.assertEqual(0, ticks)
 
+    def test_headerblock_checksum(self):
+        block = bytearray(512)
+        block[0:4] = b'\x00\x00\x00\x02'
+        block[508:512] = b'\xff\xff\xff\xfd'
+        block[20:24] = b'\xff\xff\xff\xff'  # ignored
+        self.assertEqual(1, util.headerblock_checksum(block, 512))
+        self.assertEqual(4, util.headerblock_checksum(block, 512, exclude_offset=0))
+
+    def test_bootblock_checksum_carry(self):
+        block = bytearray(1024)
+        block[0:4] = b'\xff\xff\xff\xff'
+        block[8:12] = b'\x00\x00\x00\x02'
+        # 0xffffffff + 2 overflows, the carry is added back
+        self.assertEqual(~2 & 0xffffffff, util.bootblock_checksum(block, 1024))
+
+    def test_image_checksums(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            data = infile.read()
+        checksums = util.headerblock_checksums(data, 512)
+        self.assertEqual(1760, len(checksums))
+        for blocknum in [880, 980, 1015]:
+            block = data[blocknum * 512:(blocknum + 1) * 512]
+            self.assertEqual(util.headerblock_checksum(block, 512), checksums[blocknum])
+
+        valid = util.valid_checksums(data, 512)
+        self.assertEqual(1760, len(valid))
+        self.assertTrue(valid[880])  # root block
+        self.assertTrue(valid[980])  # file header
+        self.assertTrue(valid[1015])  # bitmap block
+
+
+    def test_compute_hash(self):
+        self.assertEqual(8, util.compute_hash("c", 512))
+        self.assertEqual(util.compute_hash("Devs", 512), util.compute_hash("DEVS", 512))
+        self.assertEqual(util.compute_hash("Devs", 512), util.compute_hash("devs", 512, True))
+        # only the international hash treats the Latin-1 letters case-insensitively
+        self.assertNotEqual(util.compute_hash("\xe4", 512), util.compute_hash("\xc4", 512))
+        self.assertEqual(util.compute_hash("\xe4", 512, True), util.compute_hash("\xc4", 512, True))
+        # the division sign is not a letter
+        self.assertNotEqual(util.compute_hash("\xf7", 512, True), util.compute_hash("\xd7", 512, True))
+        self.assertTrue(isinstance(util.compute_hash("c", 4096), int))
+
+    def test_upper_name(self):
+        self.assertEqual("S-STARTUP", util.upper_name("s-startup"))
+        self.assertEqual("\xe4BC", util.upper_name("\xe4bc"))
+        self.assertEqual("\xc4BC", util.upper_name("\xe4bc", True))
+
+    def test_hash_names(self):
+        names = ["c", "Devs", "S", "Startup-Sequence", "\xe4\xf6\xfc"]
+        for international in [False, True]:
+            for block_size in [512, 4096]:
+                self.assertEqual([util.compute_hash(name, block_size, international) for name in names],
+                                 util.hash_names(names, block_size, international))
+
+    def test_hash_root_entries(self):
+        with open("testdata/wbench1.3.adf", "rb") as infile:
+            data = infile.read()
+        root = data[880 * 512:881 * 512]
+        hashtable = struct.unpack(">72I", root[24:24 + 72 * 4])
+        num_entries = 0
+        for index, blocknum in enumerate(hashtable):
+            while blocknum != 0:
+                block = data[blocknum * 512:(blocknum + 1) * 512]
+                name = block[433:433 + block[432]].decode('latin-1')
+                self.assertEqual(index, util.compute_hash(name, 512))
+                num_entries += 1
+                blocknum = struct.unpack(">I", block[496:500])[0]
+        self.assertTrue(num_entries > 10)
+
+
+    def test_amigados_time_key(self):
+        for days, minutes, ticks in [(4245, 760, 745), (0, 0, 0), (16000, 1439, 2999)]:
+            dt = util.amigados_time_to_datetime(days, minutes, ticks)
+            self.assertEqual((days, minutes, ticks), util.amigados_time_key(dt))
+
+    def test_compile_pattern(self):
+        def matches(pattern, name):
+            return util.compile_pattern(pattern).fullmatch(util.upper_name(name)) is not None
+        self.assertTrue(matches("#?.library", "exec.LIBRARY"))
+        self.assertFalse(matches("#?.library", "exec.device"))
+        self.assertTrue(matches("a?c", "abc"))
+        self.assertFalse(matches("a?c", "ac"))
+        self.assertTrue(matches("#a", "aaa"))
+        self.assertFalse(matches("#a", "aab"))
+        self.assertTrue(matches("#(ab)", "abab"))
+        self.assertTrue(matches("a(b|c)d", "acd"))
+        self.assertFalse(matches("a(b|c)d", "aed"))
+        self.assertTrue(matches("~(#?.info)", "disk"))
+        self.assertFalse(matches("~(#?.info)", "disk.info"))
+        self.assertTrue(matches("[a-c]x", "Bx"))
+        self.assertFalse(matches("[~a-c]x", "bx"))
+        self.assertTrue(matches("a%b", "ab"))
+        self.assertTrue(matches("'#a", "#a"))
+        self.assertTrue(matches("*.info", "disk.info"))
+        with self.assertRaises(Exception):
+            util.compile_pattern("(a|b")
+        self.assertTrue(util.has_wildcards("#?.info"))
+        self.assertFalse(util.has_wildcards("s/startup-sequence"))
+
 
 if __name__ == '__main__':
     SUITE = []